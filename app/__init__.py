@@ -1,65 +1,118 @@
 """
 Initialize the Flask application, configure extensions, and register blueprints.
+
+* Web only modules (routes, admin, OAuth, migrations) are imported inside create_app, so the standalone
+  collector (app.collector) can import the models and data retrieval without loading them
+* With LAZY_STARTUP, OAuth is set up on the first login, Flask-Migrate only for `flask` commands, and the
+  blueprints and admin views are registered when the first request comes in
+* The scheduled jobs only start with RUN_SCHEDULER, and never for `flask` commands other than `flask run`
+* Tables are not created at startup, `flask db upgrade` does (or CREATE_SCHEMA=1 runs db.create_all)
 """
+import threading
+import click
 from flask import Flask
 from config import Config
 from flask_login import LoginManager
-from authlib.integrations.flask_client import OAuth
-from flask_migrate import Migrate
 from .models import User, db
-from .routes import main_bp, api
-from .auth import auth_bp
-from .admin import init_admin
 from flask_apscheduler import APScheduler
 
-migrate = Migrate()
 login_manager = LoginManager()
-oauth = OAuth()
 scheduler = APScheduler()
 
+_views_lock = threading.Lock()
+
 @login_manager.user_loader
 def load_user(user_id):
     """Load user by ID."""
     return User.query.get(int(user_id))
 
-def create_app():
+def cli_command():
+    """ name of the `flask` command loading the app, None when it is not loaded by the flask CLI """
+    context = click.get_current_context(silent=True)
+    return context.info_name if context is not None else None
+
+def load_views(app):
+    """ register the blueprints, admin views and WebSocket route, once """
+    if app.extensions.get('views_loaded'):
+        return
+    with _views_lock:
+        if app.extensions.get('views_loaded'):
+            return
+        from .routes import main_bp, api
+        from .auth import auth_bp
+        from .admin import init_admin
+
+        init_admin(app)
+        app.register_blueprint(main_bp)
+        app.register_blueprint(auth_bp)
+        app.register_blueprint(api)
+
+        # optional WebSocket flavour of the live metrics stream
+        from .streaming import init_websocket
+        init_websocket(app)
+        app.extensions['views_loaded'] = True
+
+def lazy_views(app):
+    """ WSGI app loading the views before the first request is dispatched """
+    wsgi_app = app.wsgi_app
+
+    def load_and_dispatch(environ, start_response):
+        load_views(app)
+        return wsgi_app(environ, start_response)
+
+    return load_and_dispatch
+
+def start_background(app):
+    """ warm the hot tier and start the ingest watch, collection, rollup and retention jobs """
+    from .tasks import schedule_logging, schedule_rollups, schedule_ingest_watch
+    from .alerting import init_alerting
+    from .hot_tier import init_hot_tier
+
+    scheduler.init_app(app)
+    with app.app_context():
+        # recent samples are served from memory, loaded before the jobs start feeding the tier
+        init_hot_tier(app)
+
+        # rows committed by the lease holder or a standalone collector reach the caches of every process
+        schedule_ingest_watch(scheduler)
+        if app.config.get('RUN_COLLECTOR', True):
+            # alerts are evaluated where rows are collected, so each one is raised once
+            init_alerting(app)
+            schedule_logging(scheduler)
+        schedule_rollups(scheduler)
+        # start jobs
+        scheduler.start()
+
+def create_app(config_class=Config):
     """Create and configure the Flask app."""
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
+    lazy = app.config.get('LAZY_STARTUP', True)
+    command = cli_command()
 
     # Initialize extensions
     login_manager.init_app(app)
-    oauth.init_app(app)
     db.init_app(app)
-    migrate.init_app(app, db)
-    init_admin(app)
-    scheduler.init_app(app)
-
-    # Configure OAuth provider
-    oauth.register(
-        name='google',
-        client_id=app.config['GOOGLE_CLIENT_ID'],
-        client_secret=app.config['GOOGLE_CLIENT_SECRET'],
-        authorize_url='https://accounts.google.com/o/oauth2/auth',
-        access_token_url='https://oauth2.googleapis.com/token',
-        server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-        client_kwargs={'scope': 'openid email profile'}
-    )
-
-    # intialize scheduler
-    with app.app_context():
-        db.create_all()
-        # calling scheduler here once app is created
-        from .tasks import schedule_logging
+    if not lazy or command is not None:
+        from flask_migrate import Migrate
+        from .cli import metrics_cli
+        Migrate().init_app(app, db)
+        app.cli.add_command(metrics_cli)
+    if not lazy:
+        from .auth import init_oauth
+        init_oauth(app)
 
-        schedule_logging(scheduler)
-        # start jobs
-        scheduler.start()
+    if app.config.get('CREATE_SCHEMA', False):
+        with app.app_context():
+            db.create_all()
 
-    # Register blueprints
-    app.register_blueprint(main_bp)
-    app.register_blueprint(auth_bp)
-    app.register_blueprint(api)
+    # Register blueprints, for `flask routes` too
+    if lazy and command != 'routes':
+        app.wsgi_app = lazy_views(app)
+    else:
+        load_views(app)
 
+    if app.config.get('RUN_SCHEDULER', True) and command in (None, 'run'):
+        start_background(app)
 
     return app
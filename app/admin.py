@@ -2,18 +2,38 @@
 Initialize Flask-Admin and configure models.
 """
 from functools import wraps
-from flask_admin import Admin
+from flask_admin import Admin, AdminIndexView
 from flask_admin.contrib.sqla import ModelView
 from flask_login import current_user
 from flask import redirect, url_for
-from .models import db, User
+from .models import db, User, Server
 
-admin = Admin()
+def current_user_is_admin():
+    """ whether the request comes from a logged in admin """
+    return current_user.is_authenticated and current_user.type == 'Admin'
+
+class AdminOnlyMixin:
+    """ admin views only logged in admins may open, others are sent to the unauthorized page """
+
+    def is_accessible(self):
+        return current_user_is_admin()
+
+    def inaccessible_callback(self, name, **kwargs):
+        return redirect(url_for('main.unauthorized'))
+
+class AdminIndex(AdminOnlyMixin, AdminIndexView):
+    pass
+
+class AdminModelView(AdminOnlyMixin, ModelView):
+    pass
 
 def init_admin(app):
-    """Initialize the admin interface."""
-    admin.init_app(app)
-    admin.add_view(ModelView(User, db.session, name='Users'))
+    """Initialize the admin interface, one per app so create_app can run more than once."""
+    admin = Admin(app, index_view=AdminIndex())
+    admin.add_view(AdminModelView(User, db.session, name='Users'))
+    # server hosts are fetched by the collector, so only admins may add or change them
+    admin.add_view(AdminModelView(Server, db.session, name='Servers'))
+    return admin
 
 def is_admin(f):
     @wraps(f)
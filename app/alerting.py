@@ -0,0 +1,416 @@
+"""
+Alert rules evaluated on every batch of committed metric rows.
+
+* Rules come from ALERT_RULES_PATH, a JSON list (DEFAULT_RULES when unset), each with a name, a metric_logs
+  column, a kind, a limit (value) and optional parameters:
+    threshold  the latest value is above value ("op": "<" for below)
+    rate       the value rises faster than value per second between the last two samples
+    zscore     the latest value is more than value standard deviations away from the mean of the previous
+               samples (the last `window` of them, every sample held by default)
+    ewma       the latest value is more than value standard deviations away from an exponentially
+               weighted moving average with weight alpha
+  rate, zscore and ewma rules watch rises with "op": ">", falls with "<" and both with "both" (the default
+  of zscore and ewma)
+* The last ALERT_WINDOW samples of every host are kept in numpy ring buffers (hosts x window, per column),
+  so each rule is a handful of array operations over every host and evaluation never re-queries metric_logs
+* Hysteresis: an alert fires once a rule breached for `for` evaluations in a row and resolves once the
+  value is back within value - hysteresis; a firing alert is notified once, then again every
+  ALERT_REPEAT_SECONDS while it keeps firing (0 never repeats), and its resolution is notified once
+* Notifications go to the sinks named in ALERT_SINKS: log, webhook (ALERT_WEBHOOK_URL), email (ALERT_EMAIL_*)
+  and memory (kept in the process, for tests); webhook and email are sent from a background thread
+* Rules run where rows are collected (the scheduler lease holder or the standalone collector), so a
+  restarted or newly elected collector starts with empty windows
+"""
+import json
+import logging
+import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.message import EmailMessage
+import numpy as np
+import requests
+from .instrumentation import ALERT_NOTIFICATIONS, ALERTS_FIRING
+from .models import METRIC_COLUMNS
+from . import ingest
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('threshold', 'rate', 'zscore', 'ewma')
+
+# used when ALERT_RULES_PATH is not set
+DEFAULT_RULES = [
+    {"name": "disk_full", "column": "disk_usage", "kind": "threshold", "value": 90, "hysteresis": 5},
+    {"name": "memory_exhausted", "column": "memory_usage", "kind": "threshold", "value": 95, "hysteresis": 5, "for": 2},
+]
+
+DEFAULT_WINDOW = 60
+# fewest previous samples a zscore or ewma rule needs before it judges a host
+MIN_SAMPLES = 10
+
+EPOCH = datetime(1970, 1, 1)
+
+class Rule:
+    """ one alert rule with its per host hysteresis state, indexed like the ring buffers """
+
+    def __init__(self, name, column, kind, value, op=None, hysteresis=0.0, alpha=0.1, window=None, severity='warning',
+                 **options):
+        if column not in METRIC_COLUMNS:
+            raise ValueError(f"Rule {name}: unknown column {column}")
+        if kind not in KINDS:
+            raise ValueError(f"Rule {name}: unknown kind {kind}, expected one of {', '.join(KINDS)}")
+        op = op or ('both' if kind in ('zscore', 'ewma') else '>')
+        if op not in ('>', '<', 'both') or (kind == 'threshold' and op == 'both'):
+            raise ValueError(f"Rule {name}: op must be '>' or '<'" + ("" if kind == 'threshold' else " or 'both'"))
+        unknown = set(options) - {'for'}
+        if unknown:
+            raise ValueError(f"Rule {name}: unknown options {', '.join(sorted(unknown))}")
+        self.name = name
+        self.column = column
+        self.kind = kind
+        self.value = float(value)
+        self.op = op
+        self.hysteresis = float(hysteresis)
+        self.alpha = float(alpha)
+        self.window = window
+        self.severity = severity
+        self.required = int(options.get('for', 1))
+
+        self.streak = np.zeros(0, dtype=np.int64)
+        self.firing = np.zeros(0, dtype=bool)
+        self.notified_at = np.zeros(0)
+        self.ewma_mean = np.zeros(0)
+        self.ewma_var = np.zeros(0)
+        self.ewma_count = np.zeros(0, dtype=np.int64)
+
+    def grow(self, hosts):
+        """ make room for hosts hosts """
+        extra = hosts - len(self.firing)
+        if extra > 0:
+            self.streak = np.concatenate([self.streak, np.zeros(extra, dtype=np.int64)])
+            self.firing = np.concatenate([self.firing, np.zeros(extra, dtype=bool)])
+            self.notified_at = np.concatenate([self.notified_at, np.zeros(extra)])
+            self.ewma_mean = np.concatenate([self.ewma_mean, np.zeros(extra)])
+            self.ewma_var = np.concatenate([self.ewma_var, np.zeros(extra)])
+            self.ewma_count = np.concatenate([self.ewma_count, np.zeros(extra, dtype=np.int64)])
+
+    def measure(self, windows, hosts):
+        """
+        * (observed, measure) for the given host indices: the value shown in notifications, and the value compared
+          with the rule's limit (the level, rate or standard score), NaN when a host cannot be judged yet
+        * ewma rules fold the latest values into their moving averages here, after judging them
+        """
+        latest = windows.latest(self.column, hosts)
+        if self.kind == 'threshold':
+            return latest, latest
+
+        if self.kind == 'rate':
+            previous, elapsed = windows.previous(self.column, hosts)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                rate = np.where(elapsed > 0, (latest - previous) / elapsed, np.nan)
+            return rate, rate
+
+        if self.kind == 'zscore':
+            history = windows.history(self.column, hosts, self.window)
+            valid = ~np.isnan(history)
+            counts = valid.sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.where(valid, history, 0.0).sum(axis=1) / counts
+                std = np.sqrt(np.where(valid, (history - mean[:, None]) ** 2, 0.0).sum(axis=1) / counts)
+                score = np.where((counts >= MIN_SAMPLES) & (std > 0), (latest - mean) / std, np.nan)
+            return latest, score
+
+        mean, var, count = self.ewma_mean[hosts], self.ewma_var[hosts], self.ewma_count[hosts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            score = np.where((count >= MIN_SAMPLES) & (var > 0), (latest - mean) / np.sqrt(var), np.nan)
+        present = ~np.isnan(latest)
+        first = present & (count == 0)
+        diff = latest - mean
+        increment = self.alpha * diff
+        self.ewma_mean[hosts] = np.where(first, latest, np.where(present, mean + increment, mean))
+        self.ewma_var[hosts] = np.where(present & ~first, (1 - self.alpha) * (var + diff * increment), var)
+        self.ewma_count[hosts] = count + present
+        return latest, score
+
+    def directed(self, measure):
+        """ the measure turned so that breaching means exceeding limit() """
+        if self.op == 'both':
+            return np.abs(measure)
+        return measure if self.op == '>' else -measure
+
+    def limit(self):
+        # a threshold is a level, the other kinds compare a magnitude in the rule's direction
+        return -self.value if self.kind == 'threshold' and self.op == '<' else self.value
+
+    def evaluate(self, windows, hosts, now, repeat_seconds):
+        """ update the hysteresis state of the given hosts, returns (host index, state, observed) transitions """
+        observed, measure = self.measure(windows, hosts)
+        score = self.directed(measure)
+        judged = ~np.isnan(score)
+        breaching = judged & (score > self.limit())
+        holding = judged & (score > self.limit() - self.hysteresis)
+
+        streak = np.where(breaching, self.streak[hosts] + 1, np.where(judged, 0, self.streak[hosts]))
+        firing = self.firing[hosts]
+        fired = ~firing & (streak >= self.required)
+        # a host without a judgeable value keeps its state until it reports again
+        resolved = firing & judged & ~holding
+        repeated = firing & holding & (repeat_seconds > 0) & (now - self.notified_at[hosts] >= repeat_seconds)
+
+        self.streak[hosts] = streak
+        self.firing[hosts] = (firing & ~resolved) | fired
+        notify = fired | resolved | repeated
+        self.notified_at[hosts[notify]] = now
+
+        transitions = []
+        for i in np.flatnonzero(notify):
+            transitions.append((hosts[i], 'resolved' if resolved[i] else 'firing', float(observed[i])))
+        return transitions
+
+class Windows:
+    """ ring buffers of the last `size` timestamps and column values of every host """
+
+    def __init__(self, size=DEFAULT_WINDOW, columns=METRIC_COLUMNS):
+        self.size = size
+        self.columns = columns
+        self.hosts = {}
+        self.times = np.full((0, size), np.nan)
+        self.values = {column: np.full((0, size), np.nan) for column in columns}
+        # slot the next sample of each host goes to, and samples seen (capped at size)
+        self.head = np.zeros(0, dtype=np.int64)
+        self.count = np.zeros(0, dtype=np.int64)
+
+    def index(self, host):
+        """ the row of a host, added on first sight with capacity doubling """
+        row = self.hosts.get(host)
+        if row is None:
+            row = self.hosts[host] = len(self.hosts)
+            if row >= len(self.head):
+                extra = max(16, len(self.head))
+                self.times = np.vstack([self.times, np.full((extra, self.size), np.nan)])
+                for column in self.columns:
+                    self.values[column] = np.vstack([self.values[column], np.full((extra, self.size), np.nan)])
+                self.head = np.concatenate([self.head, np.zeros(extra, dtype=np.int64)])
+                self.count = np.concatenate([self.count, np.zeros(extra, dtype=np.int64)])
+        return row
+
+    def append(self, rows):
+        """ add committed rows (oldest first per host), returns the indices of the hosts that got new samples """
+        ordered = sorted(rows, key=lambda row: row['timestamp'])
+        hosts = np.fromiter((self.index(row['machine_name']) for row in ordered), dtype=np.int64, count=len(ordered))
+        times = np.fromiter(((row['timestamp'].replace(tzinfo=None) - EPOCH).total_seconds() for row in ordered),
+                            dtype=float, count=len(ordered))
+        # several rows of one host in a batch (high resolution mode) take consecutive slots
+        _, counts = np.unique(hosts, return_counts=True)
+        order = np.argsort(hosts, kind='stable')
+        rank = np.empty(len(hosts), dtype=np.int64)
+        rank[order] = np.arange(len(hosts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        slots = (self.head[hosts] + rank) % self.size
+
+        self.times[hosts, slots] = times
+        for column in self.columns:
+            self.values[column][hosts, slots] = np.array(
+                [np.nan if row.get(column) is None else row[column] for row in ordered], dtype=float)
+        updated = np.unique(hosts)
+        added = np.bincount(hosts, minlength=len(self.head))[updated]
+        self.head[updated] = (self.head[updated] + added) % self.size
+        self.count[updated] = np.minimum(self.count[updated] + added, self.size)
+        return updated
+
+    def slot(self, hosts, back):
+        """ slot of the sample `back` samples before the newest one """
+        return (self.head[hosts] - 1 - back) % self.size
+
+    def latest(self, column, hosts):
+        return self.values[column][hosts, self.slot(hosts, 0)]
+
+    def previous(self, column, hosts):
+        """ (value, seconds before the newest sample) of the sample before the newest one """
+        slots = self.slot(hosts, 1)
+        elapsed = self.times[hosts, self.slot(hosts, 0)] - self.times[hosts, slots]
+        return self.values[column][hosts, slots], np.where(self.count[hosts] > 1, elapsed, np.nan)
+
+    def history(self, column, hosts, window=None):
+        """ hosts x window matrix of the samples before the newest one, NaN where there are none """
+        window = min(window or self.size - 1, self.size - 1)
+        backs = np.arange(1, window + 1)
+        slots = (self.head[hosts, None] - 1 - backs[None, :]) % self.size
+        history = self.values[column][hosts[:, None], slots]
+        history[backs[None, :] >= self.count[hosts, None]] = np.nan
+        return history
+
+class LogSink:
+    name = 'log'
+    background = False
+
+    def send(self, alert):
+        log = logger.warning if alert['state'] == 'firing' else logger.info
+        log(f"Alert {alert['rule']} {alert['state']} on {alert['host']}: {alert['column']} {alert['observed']:.2f}")
+
+class WebhookSink:
+    """ POSTs every alert as JSON """
+
+    name = 'webhook'
+    background = True
+
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, alert):
+        requests.post(self.url, json=alert, timeout=self.timeout).raise_for_status()
+
+class EmailSink:
+    """ one plain text mail per alert through an SMTP relay """
+
+    name = 'email'
+    background = True
+
+    def __init__(self, host, port, sender, recipients, username=None, password=None, starttls=False):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = recipients
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+
+    def send(self, alert):
+        message = EmailMessage()
+        message['Subject'] = f"[{alert['state'].upper()}] {alert['rule']} on {alert['host']}"
+        message['From'] = self.sender
+        message['To'] = ', '.join(self.recipients)
+        message.set_content(json.dumps(alert, indent=2))
+        with smtplib.SMTP(self.host, self.port, timeout=10) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(message)
+
+class MemorySink:
+    """ keeps alerts in a list, for tests """
+
+    name = 'memory'
+    background = False
+
+    def __init__(self):
+        self.alerts = []
+
+    def send(self, alert):
+        self.alerts.append(alert)
+
+class AlertEngine:
+    """ the rules, the host windows they read and the sinks they notify """
+
+    def __init__(self, rules, sinks, window=DEFAULT_WINDOW, repeat_seconds=0):
+        self.rules = rules
+        self.sinks = sinks
+        self.windows = Windows(window)
+        self.repeat_seconds = repeat_seconds
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def on_rows(self, rows):
+        """ ingest listener: fold committed rows into the windows and evaluate every rule for the hosts in them """
+        if not rows:
+            return []
+        now = datetime.now(timezone.utc).timestamp()
+        alerts = []
+        with self.lock:
+            hosts = self.windows.append(rows)
+            names = {index: name for name, index in self.windows.hosts.items()}
+            for rule in self.rules:
+                rule.grow(len(self.windows.head))
+                for index, state, observed in rule.evaluate(self.windows, hosts, now, self.repeat_seconds):
+                    ALERTS_FIRING.set(1 if state == 'firing' else 0, rule=rule.name, host=names[index])
+                    alerts.append({
+                        'rule': rule.name,
+                        'host': names[index],
+                        'column': rule.column,
+                        'kind': rule.kind,
+                        'severity': rule.severity,
+                        'state': state,
+                        'observed': observed,
+                        'limit': rule.value,
+                        'at': datetime.fromtimestamp(now, timezone.utc).isoformat(timespec='seconds'),
+                    })
+        self.dispatch(alerts)
+        return alerts
+
+    def dispatch(self, alerts):
+        for alert in alerts:
+            for sink in self.sinks:
+                if sink.background:
+                    if self.executor is None:
+                        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='alert-sink')
+                    self.executor.submit(deliver, sink, alert)
+                else:
+                    deliver(sink, alert)
+
+def deliver(sink, alert):
+    """ send one alert, a failing sink is logged and never affects ingestion """
+    try:
+        sink.send(alert)
+        ALERT_NOTIFICATIONS.inc(sink=sink.name, state=alert['state'])
+    except Exception as e:
+        logger.error(f"Could not send alert {alert['rule']} to {sink.name}: {str(e)}")
+
+def load_rules(config):
+    """ Rule objects from ALERT_RULES_PATH, DEFAULT_RULES when it is not set """
+    path = config.get('ALERT_RULES_PATH')
+    if path:
+        with open(path) as f:
+            entries = json.load(f)
+    else:
+        entries = DEFAULT_RULES
+    rules = [Rule(**entry) for entry in entries]
+    names = [rule.name for rule in rules]
+    if len(set(names)) != len(names):
+        raise ValueError("Alert rule names must be unique")
+    return rules
+
+def build_sinks(config):
+    """ the sinks named in ALERT_SINKS (comma separated) """
+    sinks = []
+    for name in filter(None, (name.strip() for name in config.get('ALERT_SINKS', 'log').split(','))):
+        if name == 'log':
+            sinks.append(LogSink())
+        elif name == 'memory':
+            sinks.append(MemorySink())
+        elif name == 'webhook':
+            if not config.get('ALERT_WEBHOOK_URL'):
+                raise ValueError("The webhook alert sink needs ALERT_WEBHOOK_URL")
+            sinks.append(WebhookSink(config['ALERT_WEBHOOK_URL']))
+        elif name == 'email':
+            if not config.get('ALERT_EMAIL_HOST') or not config.get('ALERT_EMAIL_TO'):
+                raise ValueError("The email alert sink needs ALERT_EMAIL_HOST and ALERT_EMAIL_TO")
+            sinks.append(EmailSink(
+                config['ALERT_EMAIL_HOST'], config.get('ALERT_EMAIL_PORT', 25),
+                config.get('ALERT_EMAIL_FROM') or 'resourceradar@localhost',
+                [address.strip() for address in config['ALERT_EMAIL_TO'].split(',')],
+                username=config.get('ALERT_EMAIL_USER'), password=config.get('ALERT_EMAIL_PASSWORD'),
+                starttls=config.get('ALERT_EMAIL_STARTTLS', False),
+            ))
+        else:
+            raise ValueError(f"Unknown alert sink: {name}")
+    return sinks
+
+# the engine of this process, set by init_alerting
+engine = None
+
+def init_alerting(app):
+    """ build the alert engine from the app config and evaluate it on every committed batch, None when disabled """
+    global engine
+    if not app.config.get('ALERTING', True):
+        return None
+    engine = AlertEngine(load_rules(app.config), build_sinks(app.config),
+                         window=app.config.get('ALERT_WINDOW', DEFAULT_WINDOW),
+                         repeat_seconds=app.config.get('ALERT_REPEAT_SECONDS', 0))
+    # only the rows this process collects, the process collecting the others raises their alerts
+    ingest.register(evaluate_rows, local=True)
+    return engine
+
+def evaluate_rows(rows):
+    if engine is not None:
+        engine.on_rows(rows)
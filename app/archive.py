@@ -0,0 +1,249 @@
+"""
+Bulk export and import of raw metric history.
+
+* Samples are read per server off the storage backend's streaming cursor, chunk_size rows at a time, and
+  written to one file per server and day:
+    machine_name=<server>/date=<YYYY-MM-DD>/part-0.parquet   Parquet, zstd compressed (needs pyarrow)
+    machine_name=<server>/date=<YYYY-MM-DD>/part-0.csv.gz    gzip CSV with a header row
+  so memory stays bounded by one chunk however long the history is
+* Every file holds timestamp, machine_name and the metric_logs columns, and can be read on its own
+* export_metrics writes a directory, iter_export_tar streams the same files as an uncompressed tar
+  (each file is spooled to a temporary file first, tar needs its size up front)
+* import_metrics bulk-loads directories, single files or such tars through the storage backend's batched
+  write, then recompacts the rollup tiers from the oldest imported sample; rows are appended as they are,
+  importing the same archive twice stores every sample twice
+"""
+import csv
+import gzip
+import io
+import logging
+import os
+import tarfile
+import tempfile
+import time
+from datetime import datetime
+from urllib.parse import quote, unquote
+import numpy as np
+from .models import METRIC_COLUMNS
+from .rollups import compact_rollups
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# file extension of every archive format
+FORMATS = {'parquet': '.parquet', 'csv': '.csv.gz'}
+COLUMNS = ('timestamp', 'machine_name') + METRIC_COLUMNS
+DEFAULT_CHUNK_SIZE = 50000
+
+class CSVWriter:
+    """ one gzip CSV partition """
+
+    def __init__(self, fileobj):
+        self.text = io.TextIOWrapper(gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6), newline='')
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, server, rows):
+        self.writer.writerows((row[0], server) + tuple('' if value is None else value for value in row[1:])
+                              for row in rows)
+
+    def close(self):
+        # closes the gzip stream, never the file it was given
+        self.text.close()
+
+class ParquetWriter:
+    """ one Parquet partition, a row group per chunk """
+
+    def __init__(self, fileobj):
+        pa, pq = require_pyarrow()
+        self.pa = pa
+        self.schema = pa.schema([('timestamp', pa.timestamp('us')), ('machine_name', pa.string())] +
+                                [(column, pa.float64()) for column in METRIC_COLUMNS])
+        self.writer = pq.ParquetWriter(fileobj, self.schema, compression='zstd')
+
+    def write(self, server, rows):
+        columns = list(zip(*rows))
+        arrays = [self.pa.array(np.array(columns[0], dtype='datetime64[us]')),
+                  self.pa.array([server] * len(rows), type=self.pa.string())]
+        arrays += [self.pa.array(values, type=self.pa.float64()) for values in columns[1:]]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+WRITERS = {'parquet': ParquetWriter, 'csv': CSVWriter}
+
+def require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet archives need pyarrow, install it or use the csv format")
+    return pyarrow, pyarrow.parquet
+
+def partition_path(server, day, fmt):
+    """ relative path of a server's file for one day, the server name escaped to stay one path segment """
+    return f"machine_name={quote(server, safe='')}/date={day}/part-0{FORMATS[fmt]}"
+
+def iter_partitions(servers=None, start=None, end=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    * (server, day, rows) of the stored samples, rows as (timestamp, metric columns...) tuples in time order
+    * a server's day can come in several pieces, one per chunk read from the cursor
+    """
+    storage = get_storage()
+    servers = servers or sorted(storage.latest())
+    start = start or datetime(1970, 1, 1)
+    end = end or datetime(9999, 12, 31)
+    for server in servers:
+        for chunk in storage.iter_raw(server, list(METRIC_COLUMNS), start, end, epoch=False, chunk_size=chunk_size):
+            first = 0
+            for i in range(1, len(chunk) + 1):
+                if i == len(chunk) or str(chunk[i][0])[:10] != str(chunk[first][0])[:10]:
+                    yield server, str(chunk[first][0])[:10], chunk[first:i]
+                    first = i
+
+def write_partitions(fmt, open_file, servers=None, start=None, end=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    * write every partition to the file open_file(relative path) returns
+    * yields (relative path, file, row count) once a partition is complete, the caller closes the file
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown archive format {fmt}, expected one of {', '.join(FORMATS)}")
+    writer_class = WRITERS[fmt]
+    current, fileobj, writer, count = None, None, None, 0
+    for server, day, rows in iter_partitions(servers, start, end, chunk_size):
+        path = partition_path(server, day, fmt)
+        if path != current:
+            if writer is not None:
+                writer.close()
+                yield current, fileobj, count
+            current, fileobj, count = path, open_file(path), 0
+            writer = writer_class(fileobj)
+        writer.write(server, rows)
+        count += len(rows)
+    if writer is not None:
+        writer.close()
+        yield current, fileobj, count
+
+def export_metrics(directory, fmt='parquet', servers=None, start=None, end=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ write the stored samples under directory, returns {'files', 'rows'} """
+    def open_file(path):
+        path = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, 'wb')
+
+    files = rows = 0
+    started = time.perf_counter()
+    for _, fileobj, count in write_partitions(fmt, open_file, servers, start, end, chunk_size):
+        fileobj.close()
+        files += 1
+        rows += count
+    logger.info(f"Exported {rows} rows to {files} {fmt} files in {time.perf_counter() - started:.1f}s")
+    return {'files': files, 'rows': rows}
+
+class TarSink:
+    """ write-only file collecting what tarfile writes, handed out piece by piece """
+
+    def __init__(self):
+        self.pieces = []
+
+    def write(self, data):
+        self.pieces.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.pieces)
+        self.pieces = []
+        return data
+
+def iter_export_tar(fmt='parquet', servers=None, start=None, end=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ the export as an uncompressed tar stream, yielded as bytes after each partition """
+    sink = TarSink()
+    tar = tarfile.open(fileobj=sink, mode='w|')
+    for path, fileobj, _ in write_partitions(fmt, lambda path: tempfile.TemporaryFile(), servers, start, end,
+                                             chunk_size):
+        info = tarfile.TarInfo(path)
+        info.size = fileobj.tell()
+        info.mtime = int(time.time())
+        fileobj.seek(0)
+        tar.addfile(info, fileobj)
+        fileobj.close()
+        yield sink.take()
+    tar.close()
+    yield sink.take()
+
+def archive_format(name):
+    """ format of an archive file by its name, None for anything else """
+    for fmt, extension in FORMATS.items():
+        if name.endswith(extension):
+            return fmt
+    return None
+
+def read_parquet(fileobj, chunk_size):
+    _, pq = require_pyarrow()
+    for batch in pq.ParquetFile(fileobj).iter_batches(batch_size=chunk_size, columns=list(COLUMNS)):
+        columns = batch.to_pydict()
+        yield [dict(zip(COLUMNS, row)) for row in zip(*(columns[column] for column in COLUMNS))]
+
+def read_csv(fileobj, chunk_size):
+    reader = csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=fileobj, mode='rb'), newline=''))
+    header = next(reader)
+    if tuple(header) != COLUMNS:
+        raise ValueError(f"Unexpected CSV columns: {', '.join(header)}")
+    rows = []
+    for record in reader:
+        row = {'timestamp': datetime.fromisoformat(record[0]), 'machine_name': record[1]}
+        for column, value in zip(METRIC_COLUMNS, record[2:]):
+            row[column] = float(value) if value else None
+        rows.append(row)
+        if len(rows) >= chunk_size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+READERS = {'parquet': read_parquet, 'csv': read_csv}
+
+def iter_archive_files(paths):
+    """ (name, format, open binary file) of every archive file in the given files, directories and tars """
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                for name in sorted(names):
+                    if archive_format(name):
+                        with open(os.path.join(directory, name), 'rb') as fileobj:
+                            yield os.path.join(directory, name), archive_format(name), fileobj
+        elif tarfile.is_tarfile(path):
+            with tarfile.open(path) as tar:
+                for member in tar:
+                    if member.isfile() and archive_format(member.name):
+                        yield member.name, archive_format(member.name), tar.extractfile(member)
+        elif archive_format(path):
+            with open(path, 'rb') as fileobj:
+                yield path, archive_format(path), fileobj
+        else:
+            raise ValueError(f"{path} is not an archive directory, tar, Parquet or gzip CSV file")
+
+def import_metrics(paths, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    * bulk-load archive files through the storage backend, one batched write per chunk
+    * returns {'files', 'rows'}
+    """
+    storage = get_storage()
+    files = rows = 0
+    oldest = None
+    started = time.perf_counter()
+    for name, fmt, fileobj in iter_archive_files(paths):
+        for chunk in READERS[fmt](fileobj, chunk_size):
+            storage.write(chunk)
+            rows += len(chunk)
+            chunk_oldest = min(row['timestamp'] for row in chunk)
+            oldest = chunk_oldest if oldest is None else min(oldest, chunk_oldest)
+        files += 1
+        logger.debug(f"Imported {unquote(name)}")
+
+    if oldest is not None and storage.name == 'sql':
+        # the imported samples are older than what the tiers were compacted up to
+        compact_rollups(since=oldest)
+    logger.info(f"Imported {rows} rows from {files} files in {time.perf_counter() - started:.1f}s")
+    return {'files': files, 'rows': rows}
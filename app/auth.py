@@ -1,22 +1,51 @@
 """
 Authentication routes for login, logout, and OAuth callback.
+
+* The Google OAuth client is registered by create_app, or on the first login with LAZY_STARTUP
 """
+import threading
 from flask import Blueprint, redirect, url_for, current_app
 from flask_login import login_user, logout_user
 from .models import User
 
 auth_bp = Blueprint('auth', __name__)
 
+_oauth_lock = threading.Lock()
+
+def init_oauth(app):
+    """ register the Google OAuth client, its OpenID metadata is only fetched on the first login """
+    from authlib.integrations.flask_client import OAuth
+
+    oauth = OAuth()
+    oauth.init_app(app)
+    oauth.register(
+        name='google',
+        client_id=app.config['GOOGLE_CLIENT_ID'],
+        client_secret=app.config['GOOGLE_CLIENT_SECRET'],
+        authorize_url='https://accounts.google.com/o/oauth2/auth',
+        access_token_url='https://oauth2.googleapis.com/token',
+        server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+        client_kwargs={'scope': 'openid email profile'}
+    )
+    return oauth
+
+def google_client():
+    """ the app's Google OAuth client, registered on first use """
+    app = current_app._get_current_object()
+    with _oauth_lock:
+        oauth = app.extensions.get('authlib.integrations.flask_client') or init_oauth(app)
+    return oauth.google
+
 @auth_bp.route('/login')
 def login():
     """Redirect user to Google OAuth login."""
     redirect_uri = url_for('auth.callback', _external=True)
-    return current_app.extensions['authlib.integrations.flask_client'].google.authorize_redirect(redirect_uri)
+    return google_client().authorize_redirect(redirect_uri)
 
 @auth_bp.route('/callback')
 def callback():
     """Handle OAuth callback and log in the user."""
-    token = current_app.extensions['authlib.integrations.flask_client'].google.authorize_access_token()
+    token = google_client().authorize_access_token()
     user_info = token.get('userinfo')
     email = user_info['email']
 
@@ -0,0 +1,46 @@
+"""
+In-process cache of the latest metrics snapshot.
+
+* Loaded from the database once, then kept current by the rows store_metrics commits
+* Carries an ETag derived from its content, so every worker hands out the same tag for the same data
+"""
+import hashlib
+import json
+import threading
+import time
+
+class SnapshotCache:
+    """ latest values per server with a content ETag, reloaded through `loader` when empty or stale """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.etag = None
+        self.loaded_at = 0.0
+
+    def get(self, ttl=None):
+        """ return (snapshot, etag), loading it first when missing or older than ttl seconds """
+        with self.lock:
+            if self.snapshot is None or (ttl and time.monotonic() - self.loaded_at > ttl):
+                self._set(self.loader())
+            return self.snapshot, self.etag
+
+    def update(self, entries):
+        """ merge {server name: values} into the snapshot, skipped until the first load """
+        with self.lock:
+            if self.snapshot is not None:
+                snapshot = dict(self.snapshot)
+                snapshot.update(entries)
+                self._set(snapshot)
+
+    def invalidate(self):
+        """ drop the snapshot so the next get reloads it """
+        with self.lock:
+            self.snapshot = None
+            self.etag = None
+
+    def _set(self, snapshot):
+        self.snapshot = snapshot
+        self.etag = hashlib.sha1(json.dumps(snapshot, sort_keys=True, default=str).encode()).hexdigest()
+        self.loaded_at = time.monotonic()
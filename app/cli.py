@@ -0,0 +1,37 @@
+"""
+Flask CLI commands, registered next to Flask-Migrate's db group.
+
+* flask metrics export DIRECTORY   write the stored samples as Parquet or gzip CSV files per server and day
+* flask metrics import PATH...     bulk-load such directories, files or tars
+"""
+import click
+from flask.cli import AppGroup
+from .archive import DEFAULT_CHUNK_SIZE, FORMATS, export_metrics, import_metrics
+
+metrics_cli = AppGroup('metrics', help='Export and import metric history.')
+
+@metrics_cli.command('export')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='parquet', show_default=True)
+@click.option('--server', 'servers', multiple=True, help='Only this server, can be repeated.')
+@click.option('--start', type=click.DateTime(), help='First timestamp, UTC.')
+@click.option('--end', type=click.DateTime(), help='Last timestamp, UTC.')
+@click.option('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, show_default=True, help='Rows read at a time.')
+def export_command(directory, fmt, servers, start, end, chunk_size):
+    """ Write metric_logs samples to DIRECTORY, one file per server and day. """
+    try:
+        result = export_metrics(directory, fmt, list(servers) or None, start, end, chunk_size)
+    except (RuntimeError, ValueError) as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Exported {result['rows']} rows to {result['files']} files in {directory}")
+
+@metrics_cli.command('import')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, show_default=True, help='Rows written at a time.')
+def import_command(paths, chunk_size):
+    """ Bulk-load exported directories, Parquet or gzip CSV files, or tars of them. """
+    try:
+        result = import_metrics(paths, chunk_size)
+    except (RuntimeError, ValueError) as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Imported {result['rows']} rows from {result['files']} files")
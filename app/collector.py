@@ -0,0 +1,74 @@
+"""
+Standalone metrics collector.
+
+* Run with `python -m app.collector` next to the web app started with RUN_COLLECTOR=0
+* Loads only the config, the models and data retrieval: no blueprints, admin, OAuth or scheduler,
+  so it starts quickly and collection cycles never compete with request handling
+* Rows are handed to the web tier through the database, where its ingest watcher picks them up
+* --metrics-port exposes the collector's own Prometheus metrics, since they live in this process
+"""
+import argparse
+import logging
+import signal
+import threading
+import time
+from flask import Flask
+from config import Config
+from .data_retrieval import close_sessions, store_metrics
+from .host_health import collection_tick
+from .instrumentation import serve
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+def create_collector_app():
+    """ bare Flask app giving store_metrics its config and database session """
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    db.init_app(app)
+    return app
+
+def run(app, interval, stop, once=False):
+    """ collect every interval seconds, measured from the start of each cycle, until stop is set """
+    while not stop.is_set():
+        started = time.monotonic()
+        try:
+            store_metrics(app)
+        except Exception as e:
+            # a failed cycle is logged and retried next interval, the daemon keeps running
+            logger.exception(f"Collection cycle failed: {str(e)}")
+        if once:
+            break
+        stop.wait(max(0.0, interval - (time.monotonic() - started)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Collect Netdata metrics outside the web app")
+    parser.add_argument('--once', action='store_true', help="run a single collection cycle and exit")
+    parser.add_argument('--interval', type=float, help="seconds between cycles, COLLECTION_TICK_SECONDS by default")
+    parser.add_argument('--metrics-port', type=int, help="serve the collector's Prometheus metrics on this port")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    app = create_collector_app()
+    # imported here like in create_app, alerting pulls in numpy
+    from .alerting import init_alerting
+    init_alerting(app)
+    interval = args.interval or collection_tick(app.config)
+
+    if args.metrics_port:
+        serve(args.metrics_port)
+        logger.info(f"Serving collector metrics on :{args.metrics_port}/metrics")
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    logger.info(f"Collector started, collecting every {interval}s")
+    try:
+        run(app, interval, stop, once=args.once)
+    finally:
+        close_sessions()
+        logger.info("Collector stopped")
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,104 @@
 import logging
+import threading
+import time
 import requests
-from datetime import datetime
-from .models import MetricLogs, db
-from . import scheduler
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .models import METRIC_COLUMNS, Server, db
+from .leases import acquire_lease
+from .sharding import shard_servers
+from .ingest_queue import get_queue
+from .storage import get_storage
+from .metric_spec import SUBSCRIPTIONS, chart_filters, derive_samples, get_spec, subscribed_charts
+from .host_health import OPEN, collection_tick, get_health, health, host_interval
+from .instrumentation import (CYCLE_INTERVAL_SECONDS, CYCLE_SECONDS, CYCLE_TIMEOUTS, FETCH_ERRORS, FETCH_SECONDS,
+                              HOSTS_SKIPPED, LAST_CYCLE_SECONDS, profile_call, take_profile_request, timed_write)
+from . import ingest, scheduler
 
 logger = logging.getLogger(__name__)
 
+# fallback server list, used until servers are registered in the server table
 servers = [
     {"name": "server_1", "host": "secret"},
     {"name": "server_2", "host": "secret"}
 ]
 
+# netdata charts fetched for every server on each collection cycle
+CHARTS = ("system.cpu", "system.net", "system.ram", "disk_space./")
+
+# dimension order the metric computations expect for charts where position matters
+CHART_DIMENSIONS = {
+    "system.net": ("received", "sent"),
+    "system.ram": ("free", "used", "cached", "buffers"),
+    "disk_space./": ("avail", "used", "reserved for root"),
+}
+
+# defaults used when the app config does not set the collection limits
+DEFAULT_MAX_WORKERS = 32
+DEFAULT_PER_HOST_CONCURRENCY = 4
+DEFAULT_CYCLE_DEADLINE = 60
+DEFAULT_MAX_BACKFILL = 3600
+
+# high resolution mode: epoch second of the newest point stored per server and chart
+_high_water = {}
+_high_water_lock = threading.Lock()
+
+# one keep-alive session per netdata host, kept for the life of the process
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(host, pool_size=DEFAULT_PER_HOST_CONCURRENCY):
+    """ return the pooled keep-alive session for a host, creating it on first use """
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            # retry refused connections and gateway errors, but never a read timeout, which would stall the cycle
+            retries = Retry(total=2, connect=2, read=0, status=2, backoff_factor=0.1,
+                            status_forcelist=(502, 503, 504), allowed_methods=("GET",))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+        return session
+
+def close_sessions():
+    """ close every pooled session, e.g. when the server list changes """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+def fetch_error_kind(error):
+    """ timeout, http or parse, the kind label of the fetch error counter """
+    if isinstance(error, requests.Timeout):
+        return 'timeout'
+    if isinstance(error, (ValueError, KeyError, TypeError, IndexError)):
+        return 'parse'
+    return 'http'
+
+def host_unreachable(error):
+    """ True for failures of the host itself (refused, timed out, 5xx) rather than of one chart """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return isinstance(error, requests.HTTPError) and error.response is not None and error.response.status_code >= 500
+
+def fetch_failed(host, chart, error):
+    """ count a failed fetch, and note the host as unreachable so its other charts are skipped this cycle """
+    FETCH_ERRORS.inc(host=host, chart=chart, kind=fetch_error_kind(error))
+    if host_unreachable(error):
+        health.note_unreachable(host)
+
 def get_data(host, chart, points=1):
     """ Get raw data from Netdata Api and cleans it """
     try:
         url = f"{host}/api/v1/data?chart={chart}&points={points}&format=json"
-        response = requests.get(url, timeout=5)
-        data = response.json()
+        with FETCH_SECONDS.time(host=host, chart=chart):
+            response = get_session(host).get(url, timeout=5)
+            response.raise_for_status()
+            data = response.json()
 
         # get most recent data point and strip timestamp
         if data and 'data' in data and len(data['data']) > 0:
@@ -25,59 +107,409 @@ def get_data(host, chart, points=1):
         return None
 
     except Exception as e:
+        fetch_failed(host, chart, e)
         logger.error(f"Error retrieving {chart} from {host}: {str(e)}")
         return None
 
-def store_metrics():
-    """
-    * Call get_data and compute specific metrics for each server
-    * Then store to the respective MetricLog
-    """
-    with scheduler.app.app_context():
-        for server in servers:
-            # create metric log model for each server
-            metric_log = MetricLogs(machine_name=server['name'])
-            try:
-                # get total cpu usage
-                cpu_data = get_data(server["host"], "system.cpu")
-                if cpu_data:
-                    metric_log.cpu_usage = sum(cpu_data)
-
-                # get network usage, sent and received 
-                network_data = get_data(server["host"], "system.net")
-                if network_data:
-                    received = network_data[0]
-                    sent = abs(network_data[1])
-                    metric_log.network_received = received
-                    metric_log.network_sent = sent 
-
-                # get memory usage as percentage, excluding cache and buffers 
-                memory_data = get_data(server["host"], "system.ram")
-                if memory_data:
-                    used = memory_data[1]
-                    total = sum(memory_data)
-                    memory_percent_used = used / total * 100
-                    metric_log.memory_usage = memory_percent_used
-
-                # get disk usage as percentage, including disk space reserved for root
-                disk_data = get_data(server["host"], "disk_space./")
-                if disk_data:
-                    disk_total = sum(disk_data)
-                    disk_used = sum(disk_data[1:])
-                    disk_percent_used = disk_used / disk_total * 100
-                    metric_log.disk_usage = disk_percent_used
-
-                # log metrics in database
-                db.session.add(metric_log)
-                logger.info(f"{server['name']} metrics collected.")
-
-            except RuntimeError as e:
-                db.session.add(metric_log)
-                logger.error(f"Error collecting metrics for {server['name']}: {str(e)}")
-
-        try:
-            db.session.commit()
-            logger.info(f"Server metrics saved at {datetime.now()}")
-        except Exception as e:
-            db.session.rollback()
-            logger.error(f"Database Error: {str(e)}")                
+def get_series(host, chart, after):
+    """
+    * Get every point Netdata holds for a chart newer than the epoch second `after`
+    * Returns the rows oldest first as [timestamp, values...], or None on failure
+    """
+    try:
+        url = f"{host}/api/v1/data"
+        params = {"chart": chart, "after": int(after), "before": 0, "format": "json", "options": "seconds"}
+        with FETCH_SECONDS.time(host=host, chart=chart):
+            response = get_session(host).get(url, params=params, timeout=5)
+            response.raise_for_status()
+            data = response.json()
+
+        if data and 'data' in data:
+            return sorted((row for row in data['data'] if row[0] > after), key=lambda row: row[0])
+        return None
+
+    except Exception as e:
+        fetch_failed(host, chart, e)
+        logger.error(f"Error retrieving {chart} series from {host}: {str(e)}")
+        return None
+
+def get_allmetrics(host, filters):
+    """ the allmetrics answer of one host for the charts matching filters (names or Netdata patterns), {} on failure """
+    try:
+        url = f"{host}/api/v1/allmetrics"
+        with FETCH_SECONDS.time(host=host, chart='allmetrics'):
+            response = get_session(host).get(url, params={"format": "json", "filter": " ".join(filters)}, timeout=5)
+            response.raise_for_status()
+            return response.json()
+    except Exception as e:
+        fetch_failed(host, 'allmetrics', e)
+        logger.error(f"Error retrieving {', '.join(filters)} from {host}: {str(e)}")
+        return {}
+
+def get_charts(host, charts=CHARTS):
+    """
+    * Get the latest values of several charts from one host in a single allmetrics request
+    * Returns a dict of chart -> values in the same shape get_data returns, charts the host
+      did not report are left out
+    """
+    return chart_values(get_allmetrics(host, charts), charts)
+
+def chart_values(data, charts):
+    """ positional values of the given charts of an allmetrics answer, in CHART_DIMENSIONS order where it matters """
+    chart_data = {}
+    for chart in charts:
+        dimensions = (data.get(chart) or {}).get("dimensions")
+        if not dimensions:
+            continue
+        order = CHART_DIMENSIONS.get(chart)
+        if order and all(name in dimensions for name in order):
+            chart_data[chart] = [dimensions[name]["value"] for name in order]
+        else:
+            chart_data[chart] = [dimension["value"] for dimension in dimensions.values()]
+    return chart_data
+
+def dimension_values(data):
+    """ {chart: {dimension: value}} of an allmetrics answer, dimensions without a value left out """
+    return {chart: {name: dimension["value"] for name, dimension in (values.get("dimensions") or {}).items()
+                    if dimension.get("value") is not None}
+            for chart, values in data.items()}
+
+def fetch_server(host, batch=True, spec=()):
+    """
+    * Get every chart in CHARTS for one host
+    * In batch mode all charts come from one request, and only charts missing from it are fetched one by one
+    * The same request fetches the charts the metric spec subscribes to, returned under SUBSCRIPTIONS
+    * Once a request to the host failed, its remaining charts are not requested
+    """
+    started = time.monotonic()
+    chart_data = {}
+    if batch:
+        data = get_allmetrics(host, CHARTS + chart_filters(spec))
+        chart_data = chart_values(data, CHARTS)
+        subscribed = subscribed_charts(spec, dimension_values(data)) if spec else {}
+        if subscribed:
+            chart_data[SUBSCRIPTIONS] = subscribed
+    for chart in CHARTS:
+        if chart not in chart_data:
+            chart_data[chart] = None if health.failed_since(host, started) else get_data(host, chart)
+    return chart_data
+
+def fetch_subscriptions(host, spec):
+    """ the charts the spec subscribes to in their own allmetrics request, for when the built-in charts are not batched """
+    return subscribed_charts(spec, dimension_values(get_allmetrics(host, chart_filters(spec))))
+
+def compute_metrics(chart_data):
+    """
+    * Turn the raw chart values of one server into the MetricLogs columns
+    * Charts missing from chart_data (failed or timed out) are left out
+    """
+    metrics = {}
+
+    # get total cpu usage
+    cpu_data = chart_data.get("system.cpu")
+    if cpu_data:
+        metrics['cpu_usage'] = sum(cpu_data)
+
+    # get network usage, sent and received
+    network_data = chart_data.get("system.net")
+    if network_data:
+        metrics['network_received'] = network_data[0]
+        metrics['network_sent'] = abs(network_data[1])
+
+    # get memory usage as percentage, excluding cache and buffers
+    memory_data = chart_data.get("system.ram")
+    if memory_data:
+        used = memory_data[1]
+        total = sum(memory_data)
+        metrics['memory_usage'] = used / total * 100
+
+    # get disk usage as percentage, including disk space reserved for root
+    disk_data = chart_data.get("disk_space./")
+    if disk_data:
+        disk_total = sum(disk_data)
+        disk_used = sum(disk_data[1:])
+        metrics['disk_usage'] = disk_used / disk_total * 100
+
+    return metrics
+
+def collect_all(server_list, max_workers=DEFAULT_MAX_WORKERS, per_host_concurrency=DEFAULT_PER_HOST_CONCURRENCY,
+                deadline=DEFAULT_CYCLE_DEADLINE, batch=True, since=None, spec=()):
+    """
+    * Fetch every chart for every server concurrently on a bounded thread pool
+    * max_workers caps the fetches in flight overall, per_host_concurrency caps them per server
+    * In batch mode each server is one allmetrics request instead of one request per chart, which also
+      fetches the charts subscribed to by spec, otherwise they are one more allmetrics request per server
+    * With since (server name -> chart -> epoch second) every point newer than it is fetched per chart instead
+    * Charts still running when the cycle deadline passes are reported as timeouts
+    * Once a request to a host failed, its charts that have not started yet are reported as errors without a request
+    * Returns (chart data per server, report per server)
+    """
+    started = time.monotonic()
+    host_limits = {}
+    finished_at = {}
+    futures = {}
+    batch = batch and since is None
+
+    def fetch(server, charts):
+        with host_limits[server['name']]:
+            if batch:
+                values = fetch_server(server["host"], spec=spec)
+            elif health.failed_since(server["host"], started):
+                values = {charts[0]: None}
+            elif charts[0] == SUBSCRIPTIONS:
+                values = {SUBSCRIPTIONS: fetch_subscriptions(server["host"], spec)}
+            elif since is not None:
+                values = {charts[0]: get_series(server["host"], charts[0], since[server['name']][charts[0]])}
+            else:
+                values = {charts[0]: get_data(server["host"], charts[0])}
+        finished_at[(server['name'], charts)] = time.monotonic()
+        return values
+
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="collector")
+    try:
+        for server in server_list:
+            host_limits[server['name']] = threading.BoundedSemaphore(per_host_concurrency)
+            tasks = [CHARTS] if batch else [(chart,) for chart in CHARTS] + ([(SUBSCRIPTIONS,)] if spec else [])
+            for charts in tasks:
+                futures[pool.submit(fetch, server, charts)] = (server['name'], charts)
+
+        done, _ = wait(futures, timeout=deadline)
+    finally:
+        # do not block the cycle on stragglers, they finish on their own after their request timeout
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    results = {server['name']: {} for server in server_list}
+    report = {server['name']: {'latency': 0.0, 'timeouts': [], 'errors': []} for server in server_list}
+    for future, (name, charts) in futures.items():
+        host_report = report[name]
+        if future not in done:
+            CYCLE_TIMEOUTS.inc(len(charts), server=name)
+            host_report['timeouts'].extend(charts)
+            host_report['latency'] = deadline
+            continue
+
+        for chart, value in future.result().items():
+            if value is None:
+                host_report['errors'].append(chart)
+            results[name][chart] = value
+        host_report['latency'] = max(host_report['latency'], finished_at[(name, charts)] - started)
+
+    return results, report
+
+def log_cycle_report(report, cycle_time):
+    """ log per host latency and flag the hosts that dragged the cycle """
+    for name, host_report in sorted(report.items(), key=lambda item: item[1]['latency'], reverse=True):
+        if host_report['timeouts']:
+            logger.warning(f"{name} timed out on {', '.join(host_report['timeouts'])} "
+                           f"after {host_report['latency']:.2f}s")
+        elif host_report['errors']:
+            logger.warning(f"{name} failed on {', '.join(host_report['errors'])} "
+                           f"in {host_report['latency']:.2f}s")
+        else:
+            logger.debug(f"{name} collected in {host_report['latency']:.2f}s")
+    logger.info(f"Collection cycle for {len(report)} servers took {cycle_time:.2f}s")
+
+def utc_from_epoch(epoch):
+    """ naive UTC datetime, matching the CURRENT_TIMESTAMP default of MetricLogs.timestamp """
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).replace(tzinfo=None)
+
+def epoch_from_utc(timestamp):
+    """ epoch seconds of a MetricLogs timestamp, naive values being UTC """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+def build_row(name, timestamp, metrics):
+    """ one metric_logs row with every metric column present, as executemany needs uniform rows """
+    row = {'machine_name': name, 'timestamp': timestamp}
+    for column in METRIC_COLUMNS:
+        row[column] = metrics.get(column)
+    return row
+
+def safe_compute_metrics(name, chart_data):
+    """ compute_metrics that logs and returns no values when a chart has an unexpected shape """
+    try:
+        return compute_metrics(chart_data)
+    except (ArithmeticError, IndexError, TypeError) as e:
+        logger.error(f"Error collecting metrics for {name}: {str(e)}")
+        return {}
+
+def build_series_rows(name, chart_series):
+    """ align the per chart series of one server by timestamp and build a row per point """
+    points = {}
+    for chart, series in chart_series.items():
+        for point in series or []:
+            points.setdefault(point[0], {})[chart] = point[1:]
+    return [build_row(name, utc_from_epoch(epoch), safe_compute_metrics(name, charts))
+            for epoch, charts in sorted(points.items())]
+
+def load_high_water_marks(server_list, max_backfill):
+    """
+    * Epoch second to collect each chart from, per server, in high resolution mode
+    * Starts at the newest stored row of a server, but never further back than max_backfill seconds
+    """
+    floor = time.time() - max_backfill
+    with _high_water_lock:
+        missing = [server['name'] for server in server_list if server['name'] not in _high_water]
+        if missing:
+            for name, timestamp in get_storage().newest_timestamps(missing).items():
+                _high_water[name] = dict.fromkeys(CHARTS, epoch_from_utc(timestamp))
+        return {server['name']: {chart: max(_high_water.get(server['name'], {}).get(chart, floor), floor)
+                                 for chart in CHARTS}
+                for server in server_list}
+
+def advance_high_water_marks(results):
+    """
+    * move each chart's high water mark to the newest point it returned, once the rows are committed
+    * a chart that failed keeps its mark, so its gap is fetched again next cycle while the other charts move on
+    """
+    with _high_water_lock:
+        for name, chart_series in results.items():
+            marks = _high_water.setdefault(name, {})
+            for chart, series in chart_series.items():
+                if series and series[-1][0] > marks.get(chart, 0):
+                    marks[chart] = series[-1][0]
+
+def write_rows(rows, app=None):
+    """ store all rows of a cycle in one write (one executemany and a single commit on SQL), then notify ingest listeners """
+    if not rows:
+        return True
+    try:
+        storage = get_storage(app)
+        with ingest.writing() as written:
+            with timed_write(storage.name, rows):
+                storage.write(rows)
+            written.extend(rows)
+        logger.info(f"{len(rows)} server metrics saved at {datetime.now()}")
+    except Exception as e:
+        logger.error(f"Database Error: {str(e)}")
+        return False
+    return True
+
+def write_samples(samples, app=None):
+    """ store the derived samples of subscribed series in one write """
+    if not samples:
+        return True
+    try:
+        storage = get_storage(app)
+        with timed_write(storage.name, samples):
+            storage.write_samples(samples)
+        logger.info(f"{len(samples)} subscribed samples saved at {datetime.now()}")
+    except Exception as e:
+        logger.error(f"Database Error: {str(e)}")
+        return False
+    return True
+
+def get_servers():
+    """ enabled servers from the server table as {'name', 'host', 'interval'} dicts, the static list when none are registered """
+    registered = Server.query.filter_by(enabled=True).order_by(Server.name).all()
+    if not registered:
+        return list(servers)
+    return [{"name": server.name, "host": server.host, "interval": server.interval_seconds} for server in registered]
+
+def due_servers(server_list, config, now):
+    """ the servers whose interval has passed, leaving out hosts whose circuit breaker is open """
+    host_health = get_health(config)
+    tick = collection_tick(config)
+    due = []
+    for server in server_list:
+        host = server['host']
+        if not host_health.due(host, host_interval(config, server, host_health.cpu_usage(host)), tick, now):
+            continue
+        if host_health.circuit(host, now) == OPEN:
+            HOSTS_SKIPPED.inc(host=host)
+            logger.debug(f"Skipping {server['name']}, its circuit is open")
+            continue
+        due.append(server)
+    return due
+
+def record_health(server_list, results, rows, started):
+    """ a server counts as healthy when any chart came back, its newest cpu usage steers adaptive intervals """
+    cpu_usage = {row['machine_name']: row['cpu_usage'] for row in rows if row['cpu_usage'] is not None}
+    for server in server_list:
+        ok = any(value is not None for value in results[server['name']].values())
+        health.record(server['host'], ok, started, cpu_usage.get(server['name']))
+
+def store_metrics(app=None):
+    """
+    * Collect every chart from every server of this collector's shard that is due concurrently and compute
+      specific metrics for each server, hosts with an open circuit breaker are skipped
+    * Then store to the respective MetricLog, one row per server, or one row per Netdata point
+      since the last collection in high resolution mode
+    * Only the process holding the shard's lease collects, the others skip the cycle
+    * Runs in the given app, the web app's scheduler when none is given (the standalone collector passes its own)
+    * Returns the per server collection report, None when the cycle was skipped
+    """
+    app = app or scheduler.app
+    with app.app_context():
+        config = app.config
+        shard_index = config.get('COLLECTOR_SHARD_INDEX', 0)
+
+        # a lease outliving two cycles lets another process take over when this one dies
+        tick = collection_tick(config)
+        if not acquire_lease(f"collect_metrics:{shard_index}", config.get('LEASE_TTL') or 2 * tick):
+            logger.debug(f"Collection lease for shard {shard_index} is held elsewhere, skipping cycle")
+            return None
+
+        CYCLE_INTERVAL_SECONDS.set(tick)
+        if take_profile_request(app):
+            return profile_call(app, collect_cycle, app)
+        return collect_cycle(app)
+
+def collect_cycle(app):
+    """ one collection cycle of store_metrics, run in the app context once the lease is held """
+    config = app.config
+    high_resolution = config.get('HIGH_RESOLUTION', False)
+    servers = shard_servers(get_servers(), config.get('COLLECTOR_SHARD_INDEX', 0), config.get('COLLECTOR_SHARD_COUNT', 1))
+    started = time.monotonic()
+    servers = due_servers(servers, config, started)
+
+    # subscribed charts come with the batched allmetrics request, or in a request of their own per server
+    spec = get_spec(config)
+
+    since = None
+    if high_resolution:
+        since = load_high_water_marks(servers, config.get('HIGH_RESOLUTION_MAX_BACKFILL', DEFAULT_MAX_BACKFILL))
+
+    results, report = collect_all(
+        servers,
+        max_workers=config.get('COLLECTION_MAX_WORKERS', DEFAULT_MAX_WORKERS),
+        per_host_concurrency=config.get('COLLECTION_PER_HOST_CONCURRENCY', DEFAULT_PER_HOST_CONCURRENCY),
+        deadline=config.get('COLLECTION_CYCLE_DEADLINE', DEFAULT_CYCLE_DEADLINE),
+        batch=config.get('NETDATA_BATCH_FETCH', True),
+        since=since,
+        spec=spec
+    )
+    subscribed = {name: chart_data.pop(SUBSCRIPTIONS, None) for name, chart_data in results.items()}
+
+    rows = []
+    collected_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    for server in servers:
+        name = server['name']
+        if high_resolution:
+            rows.extend(build_series_rows(name, results[name]))
+        else:
+            # still log a row when charts fail so gaps show up for this server
+            rows.append(build_row(name, collected_at, safe_compute_metrics(name, results[name])))
+        logger.info(f"{name} metrics collected.")
+
+    record_health(servers, results, rows, started)
+    log_cycle_report(report, time.monotonic() - started)
+
+    # the queue journals the rows before returning, so they count as stored once put
+    queue = get_queue(app)
+    if queue is not None:
+        queue.put(rows)
+        written = True
+    else:
+        written = write_rows(rows, app)
+    if written and high_resolution:
+        advance_high_water_marks(results)
+
+    if spec:
+        write_samples(derive_samples(spec, subscribed, collected_at), app)
+
+    cycle_time = time.monotonic() - started
+    CYCLE_SECONDS.observe(cycle_time)
+    LAST_CYCLE_SECONDS.set(cycle_time)
+    return report
@@ -0,0 +1,78 @@
+"""
+* Downsample metric series so a chart gets a bounded number of points for any time range
+* Largest-Triangle-Three-Buckets keeps the visual shape (spikes and dips) of a series
+  while dropping the points that do not change how the line looks
+"""
+from datetime import datetime, timezone
+import numpy as np
+
+def epoch_seconds(timestamps) -> np.ndarray:
+    """ convert metric_logs timestamps (datetimes or SQLite strings, UTC) to float epoch seconds """
+    seconds = np.empty(len(timestamps), dtype=np.float64)
+    for i, timestamp in enumerate(timestamps):
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        seconds[i] = timestamp.timestamp()
+    return seconds
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    * Pick `threshold` point indices out of (x, y) with Largest-Triangle-Three-Buckets
+    * The first and last points are always kept, every other bucket keeps the point forming the
+      largest triangle with the previously kept point and the average of the next bucket
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # bucket edges for the n - 2 inner points, split into threshold - 2 buckets
+    edges = np.floor(np.linspace(1, n - 1, threshold - 1)).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # average of the next bucket, the last point for the final bucket
+        if bucket + 2 < len(edges):
+            next_start, next_end = edges[bucket + 1], edges[bucket + 2]
+            avg_x = x[next_start:next_end].mean()
+            avg_y = y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[n - 1], y[n - 1]
+
+        # doubled triangle areas between the previous point, each candidate and the next average
+        areas = np.abs((x[previous] - avg_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (avg_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+
+    return selected
+
+def lttb(series: dict, value_keys, max_points: int) -> dict:
+    """
+    * Downsample a historical_metrics style series ({'timestamps': [...], key: [...]}) to max_points
+    * Series with several value keys (network) share the picked timestamps, chosen on their sum
+    """
+    timestamps = series['timestamps']
+    if len(timestamps) <= max_points:
+        return series
+
+    x = epoch_seconds(timestamps)
+    y = np.zeros(len(timestamps), dtype=np.float64)
+    for key in value_keys:
+        y += np.asarray(series[key], dtype=np.float64)
+    # missing values (None) are picked on the line between their neighbours, and stay None in the result
+    missing = np.isnan(y)
+    if missing.any():
+        y[missing] = np.interp(x[missing], x[~missing], y[~missing]) if not missing.all() else 0.0
+
+    indices = lttb_indices(x, y, max_points)
+    downsampled = {'timestamps': [timestamps[i] for i in indices]}
+    for key in value_keys:
+        values = series[key]
+        downsampled[key] = [values[i] for i in indices]
+    return downsampled
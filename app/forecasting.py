@@ -0,0 +1,232 @@
+"""
+Capacity forecasts: when will each server's disk or memory usage reach a threshold.
+
+* The last FORECAST_LOOKBACK_DAYS of a metric are read for every server at once, in FORECAST_BUCKET_SECONDS
+  buckets (the same reads historical_metrics makes, hot tier and rollups included), into a hosts x buckets
+  array with NaN for missing buckets
+* Two trends are fitted to every host in one numpy pass over that array:
+    linear        least squares line, its time to threshold is solved directly
+    holt_winters  additive level, trend and FORECAST_SEASON_SECONDS season, stepped over the buckets for all
+                  hosts together and projected FORECAST_HORIZON_DAYS ahead; needs two seasons of samples
+* Hosts are ranked by the earliest projected time to threshold, those never reaching it within the horizon last
+* Results are cached until the next committed batch, or FORECAST_CACHE_TTL seconds in a worker that does not
+  see the batches
+"""
+import math
+import threading
+import time
+import warnings
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from . import ingest
+from .data_retrieval import get_servers
+from .metric_collector import metric_map, plan_query, read_bucketed
+
+# metrics that can be forecast, with the config key of their default threshold
+FORECAST_METRICS = {'disk': 'FORECAST_DISK_THRESHOLD', 'memory': 'FORECAST_MEMORY_THRESHOLD'}
+
+# smoothing factors of the level, trend and season
+ALPHA = 0.3
+BETA = 0.05
+GAMMA = 0.1
+
+# fewest buckets with a value a linear fit needs
+MIN_POINTS = 3
+
+def fit_linear(values, bucket):
+    """
+    * least squares slope (per second) and value at the last bucket of every row of values (hosts x buckets)
+    * NaN buckets are left out, rows with fewer than MIN_POINTS values get NaN
+    """
+    present = ~np.isnan(values)
+    n = present.sum(axis=1)
+    t = np.where(present, np.arange(values.shape[1]) * float(bucket), 0.0)
+    y = np.where(present, values, 0.0)
+    sum_t, sum_y = t.sum(axis=1), y.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (n * (t * y).sum(axis=1) - sum_t * sum_y) / (n * (t * t).sum(axis=1) - sum_t ** 2)
+        intercept = (sum_y - slope * sum_t) / n
+    slope = np.where(n >= MIN_POINTS, slope, np.nan)
+    return slope, intercept + slope * (values.shape[1] - 1) * bucket
+
+def linear_time_to(slope, fitted, threshold, horizon):
+    """ seconds from the last bucket until the linear trend reaches threshold, NaN when not within horizon seconds """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        seconds = np.where(fitted >= threshold, 0.0, (threshold - fitted) / slope)
+        return np.where(((slope > 0) | (fitted >= threshold)) & (seconds <= horizon), seconds, np.nan)
+
+def fit_holt_winters(values, season):
+    """
+    * additive Holt-Winters over every row of values (hosts x buckets) at once, season in buckets
+    * returns (level, trend, seasonal) after the last bucket, seasonal being hosts x season with
+      seasonal[:, k] belonging to bucket indices k modulo season; rows without a value in each of
+      the first two seasons get NaN
+    * a NaN bucket carries the previous level and trend forward without updating them
+    """
+    first, second = values[:, :season], values[:, season:2 * season]
+    with warnings.catch_warnings():
+        # hosts without a value in a season get a NaN mean
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(first, axis=1)
+        trend = (np.nanmean(second, axis=1) - mean) / season
+    # the first season's mean belongs to its middle bucket, the season is what is left once the trend is removed
+    offsets = np.arange(season) - (season - 1) / 2
+    seasonal = np.nan_to_num(first - (mean[:, None] + trend[:, None] * offsets))
+    level = mean + trend * (season - 1) / 2
+
+    for k in range(season, values.shape[1]):
+        observed = values[:, k]
+        present = ~np.isnan(observed)
+        previous = seasonal[:, k % season]
+        new_level = ALPHA * (observed - previous) + (1 - ALPHA) * (level + trend)
+        new_trend = BETA * (new_level - level) + (1 - BETA) * trend
+        seasonal[:, k % season] = np.where(present, GAMMA * (observed - new_level) + (1 - GAMMA) * previous, previous)
+        level = np.where(present, new_level, level + trend)
+        trend = np.where(present, new_trend, trend)
+    return level, trend, seasonal
+
+def holt_winters_time_to(level, trend, seasonal, last, threshold, horizon_buckets, bucket):
+    """ seconds from bucket index last until the projection first reaches threshold, NaN when not within horizon """
+    steps = np.arange(1, horizon_buckets + 1)
+    season = seasonal.shape[1]
+    projected = level[:, None] + trend[:, None] * steps + seasonal[:, (last + steps) % season]
+    reached = projected >= threshold
+    return np.where(reached.any(axis=1), (reached.argmax(axis=1) + 1) * float(bucket), np.nan)
+
+def fleet_values(metric_type, servers, start, buckets, bucket):
+    """ hosts x buckets array of a metric's bucket averages, NaN where a bucket has no value """
+    column = metric_map[metric_type]
+    end = start + timedelta(seconds=buckets * bucket - 1)
+    _, tier = plan_query(start, end, None, bucket, 'avg')
+    rows_by_server = read_bucketed(servers, [column], start, end, bucket, tier)
+    values = np.full((len(servers), buckets), np.nan)
+    start_epoch = np.datetime64(start, 's').astype(np.int64)
+    for i, server in enumerate(servers):
+        rows = rows_by_server.get(server) or []
+        if not rows:
+            continue
+        epochs = np.array([row['timestamp'] for row in rows], dtype='datetime64[s]').astype(np.int64)
+        index = (epochs - start_epoch) // bucket
+        averages = np.array([row[f'{column}_avg'] for row in rows], dtype=float)
+        inside = (index >= 0) & (index < buckets)
+        values[i, index[inside]] = averages[inside]
+    return values
+
+def seconds_or_none(value):
+    return None if math.isnan(value) else round(float(value))
+
+def eta(origin, seconds):
+    return None if math.isnan(seconds) else (origin + timedelta(seconds=float(seconds))).isoformat(timespec='seconds')
+
+def forecast(metric_type, config, threshold=None, now=None):
+    """
+    * time to threshold of a metric for every server, ranked most urgent first
+    * returns {'metric', 'threshold', 'generated_at', 'hosts': [...]}, each host with its latest bucket value,
+      the linear and holt_winters projections and the earliest of them as seconds_to_threshold
+    """
+    if metric_type not in FORECAST_METRICS:
+        raise ValueError(f"Forecasts are available for {', '.join(FORECAST_METRICS)}, not {metric_type}")
+    threshold = float(threshold if threshold is not None else config.get(FORECAST_METRICS[metric_type], 90))
+    bucket = int(config.get('FORECAST_BUCKET_SECONDS', 3600))
+    season = max(1, int(config.get('FORECAST_SEASON_SECONDS', 86400)) // bucket)
+    horizon = config.get('FORECAST_HORIZON_DAYS', 90) * 86400
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+
+    # whole buckets, the last one holding now
+    now_epoch = int((now - datetime(1970, 1, 1)).total_seconds())
+    end_epoch = (now_epoch // bucket + 1) * bucket
+    buckets = max(1, int(config.get('FORECAST_LOOKBACK_DAYS', 14) * 86400) // bucket)
+    start = datetime(1970, 1, 1) + timedelta(seconds=end_epoch - buckets * bucket)
+    last_bucket = start + timedelta(seconds=(buckets - 1) * bucket)
+
+    servers = [server['name'] for server in get_servers()]
+    values = fleet_values(metric_type, servers, start, buckets, bucket)
+    present = ~np.isnan(values)
+
+    slope, fitted = fit_linear(values, bucket)
+    linear = linear_time_to(slope, fitted, threshold, horizon)
+    if buckets >= 2 * season and season > 1:
+        level, trend, seasonal = fit_holt_winters(values, season)
+        seasonal_eta = holt_winters_time_to(level, trend, seasonal, buckets - 1, threshold, horizon // bucket, bucket)
+    else:
+        seasonal_eta = np.full(len(servers), np.nan)
+
+    # projections run from the start of the last bucket, report them from now
+    elapsed = (now - last_bucket).total_seconds()
+    linear = np.maximum(linear - elapsed, 0.0)
+    seasonal_eta = np.maximum(seasonal_eta - elapsed, 0.0)
+
+    # the newest bucket with a value, already at the threshold counts as reached
+    has_value = present.any(axis=1)
+    newest = np.where(has_value, buckets - 1 - present[:, ::-1].argmax(axis=1), 0)
+    current = np.where(has_value, values[np.arange(len(servers)), newest], np.nan)
+    reached = current >= threshold
+    linear = np.where(reached, 0.0, linear)
+    seasonal_eta = np.where(reached, 0.0, seasonal_eta)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        earliest = np.nanmin(np.stack([linear, seasonal_eta]), axis=0)
+
+    hosts = []
+    for i, server in enumerate(servers):
+        if not has_value[i]:
+            continue
+        hosts.append({
+            'server': server,
+            'current': round(float(current[i]), 2),
+            'samples': int(present[i].sum()),
+            'linear': {
+                'slope_per_day': None if math.isnan(slope[i]) else round(float(slope[i]) * 86400, 4),
+                'seconds_to_threshold': seconds_or_none(linear[i]),
+                'eta': eta(now, linear[i]),
+            },
+            'holt_winters': {
+                'seconds_to_threshold': seconds_or_none(seasonal_eta[i]),
+                'eta': eta(now, seasonal_eta[i]),
+            },
+            'seconds_to_threshold': seconds_or_none(earliest[i]),
+        })
+    # most urgent first, hosts never reaching the threshold last with the fullest first
+    hosts.sort(key=lambda host: (host['seconds_to_threshold'] is None, host['seconds_to_threshold'] or 0,
+                                 -host['current']))
+    return {'metric': metric_type, 'threshold': threshold, 'generated_at': now.isoformat(timespec='seconds'),
+            'hosts': hosts}
+
+class ForecastCache:
+    """ forecasts by query, emptied whenever new rows are committed """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        # bumped by every invalidation, so a forecast computed across one is not kept
+        self.generation = 0
+
+    def get(self, key, compute, ttl=None):
+        """ the cached value of key, computed outside the lock when missing or older than ttl seconds """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and not (ttl and time.monotonic() - entry[0] > ttl):
+                return entry[1]
+            generation = self.generation
+        value = compute()
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (time.monotonic(), value)
+        return value
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+forecast_cache = ForecastCache()
+
+@ingest.register
+def invalidate_forecasts(rows):
+    """ new samples change every trend, forecasts are recomputed on the next request """
+    forecast_cache.invalidate()
+
+def cached_forecast(metric_type, config, threshold=None):
+    """ forecast, computed at most once between committed batches for the same metric and threshold """
+    return forecast_cache.get((metric_type, threshold), lambda: forecast(metric_type, config, threshold),
+                              ttl=config.get('FORECAST_CACHE_TTL', 600))
@@ -0,0 +1,144 @@
+"""
+Per host health and scheduling for metric collection.
+
+* A circuit breaker per Netdata host: after CIRCUIT_FAILURE_THRESHOLD failed cycles in a row the host is
+  skipped, then probed with a single collection once CIRCUIT_BACKOFF_SECONDS have passed; every failed
+  probe doubles the wait, up to CIRCUIT_MAX_BACKOFF_SECONDS, and one successful collection closes it again
+* Refused connections, timeouts and 5xx answers are noted as they happen, so the remaining charts of a
+  host that just failed are skipped in the same cycle instead of each waiting out its own timeout
+* Each host is collected on its own interval: the server's interval_seconds, COLLECTION_INTERVAL_SECONDS
+  otherwise; with ADAPTIVE_INTERVALS hot hosts are collected more often and idle ones less often.
+  The collection job runs every COLLECTION_TICK_SECONDS and only collects the hosts that are due
+"""
+import logging
+import threading
+import time
+from .instrumentation import HOST_CIRCUIT_OPEN
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# defaults used when the app config does not set the breaker limits
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_BACKOFF = 60.0
+DEFAULT_MAX_BACKOFF = 3600.0
+
+class HostState:
+    """ what is known about one host, times are time.monotonic() values """
+
+    def __init__(self):
+        self.failures = 0
+        self.backoff = 0.0
+        self.open_until = None
+        self.last_attempt = None
+        self.last_failure = None
+        self.cpu_usage = None
+
+class HostHealth:
+    """ circuit breakers and collection times of every host, keyed by host URL """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, backoff=DEFAULT_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF):
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def state(self, host):
+        """ the host's state, created on first use, called with the lock held """
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState()
+        return state
+
+    def note_unreachable(self, host):
+        """ a request to the host just failed at the transport level """
+        with self.lock:
+            self.state(host).last_failure = time.monotonic()
+
+    def failed_since(self, host, since):
+        """ True when a request to the host failed at or after the monotonic time since """
+        with self.lock:
+            state = self.hosts.get(host)
+            return state is not None and state.last_failure is not None and state.last_failure >= since
+
+    def circuit(self, host, now=None):
+        """ closed, open (skip the host) or half_open (the next collection is a probe) """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None or state.open_until is None:
+                return CLOSED
+            return OPEN if now < state.open_until else HALF_OPEN
+
+    def due(self, host, interval, tick, now=None):
+        """ True when the host's last collection started at least interval seconds ago, within half a tick """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            state = self.hosts.get(host)
+            return state is None or state.last_attempt is None or now - state.last_attempt >= interval - tick / 2
+
+    def cpu_usage(self, host):
+        with self.lock:
+            state = self.hosts.get(host)
+            return None if state is None else state.cpu_usage
+
+    def record(self, host, ok, started, cpu_usage=None):
+        """ the outcome of collecting the host in a cycle that started at the monotonic time started """
+        with self.lock:
+            state = self.state(host)
+            state.last_attempt = started
+            if ok:
+                if state.open_until is not None:
+                    logger.info(f"{host} is reachable again, closing its circuit")
+                state.failures = 0
+                state.backoff = 0.0
+                state.open_until = None
+                if cpu_usage is not None:
+                    state.cpu_usage = cpu_usage
+            else:
+                state.failures += 1
+                if state.failures >= self.failure_threshold:
+                    state.backoff = min(self.max_backoff, state.backoff * 2 if state.backoff else self.backoff)
+                    state.open_until = time.monotonic() + state.backoff
+                    logger.warning(f"{host} failed {state.failures} cycles in a row, "
+                                   f"skipping it for {state.backoff:.0f}s")
+            HOST_CIRCUIT_OPEN.set(0 if state.open_until is None else 1, host=host)
+
+    def reset(self):
+        with self.lock:
+            self.hosts.clear()
+
+# shared by every collection cycle of the process
+health = HostHealth()
+
+def get_health(config):
+    """ the process wide host health, with the breaker limits taken from the app config """
+    health.failure_threshold = config.get('CIRCUIT_FAILURE_THRESHOLD', DEFAULT_FAILURE_THRESHOLD)
+    health.backoff = config.get('CIRCUIT_BACKOFF_SECONDS', DEFAULT_BACKOFF)
+    health.max_backoff = config.get('CIRCUIT_MAX_BACKOFF_SECONDS', DEFAULT_MAX_BACKOFF)
+    return health
+
+def collection_tick(config):
+    """ seconds between runs of the collection job, COLLECTION_INTERVAL_SECONDS unless set """
+    return config.get('COLLECTION_TICK_SECONDS') or config.get('COLLECTION_INTERVAL_SECONDS', 600)
+
+def host_interval(config, server, cpu_usage=None):
+    """
+    * Seconds between collections of a server: its own interval, or COLLECTION_INTERVAL_SECONDS
+    * With ADAPTIVE_INTERVALS, divided by HOST_INTERVAL_FACTOR while the last cpu usage is at least
+      HOST_HOT_CPU_PERCENT, multiplied by it while the cpu usage is at most HOST_IDLE_CPU_PERCENT
+    """
+    interval = server.get('interval') or config.get('COLLECTION_INTERVAL_SECONDS', 600)
+    if not config.get('ADAPTIVE_INTERVALS', False) or cpu_usage is None:
+        return interval
+    factor = config.get('HOST_INTERVAL_FACTOR', 2)
+    if cpu_usage >= config.get('HOST_HOT_CPU_PERCENT', 80):
+        return interval / factor
+    if cpu_usage <= config.get('HOST_IDLE_CPU_PERCENT', 5):
+        return interval * factor
+    return interval
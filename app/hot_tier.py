@@ -0,0 +1,275 @@
+"""
+Recent samples of every server kept in memory, so the common last hour and last day queries skip the database.
+
+* One ring buffer per server: epoch microsecond timestamps and one float array per metric_logs column,
+  NaN where a value is missing
+* Every sample is written twice, at i and i + capacity, so the newest samples are always the contiguous
+  slice [head, head + count) and a time range is a zero-copy view found with searchsorted
+* Fed by an ingest listener with every committed batch, and warm-loaded with the last HOT_TIER_WARM_HOURS
+  of samples of every server in storage when the web app starts
+* A buffer knows from which time on it holds every sample (covered_from); ranges starting earlier, and every
+  range until a batch arrived in the last HOT_TIER_MAX_AGE seconds (a process without the ingest watch is
+  never fed, the warm load alone does not count), are left to the storage backend
+* A batch arriving after a longer gap first refills the buffers from storage, from a little before the
+  previous batch arrived, so the samples committed in between are not missing
+* HOT_TIER_POINTS samples per server; a server only gets a buffer while all of them fit in HOT_TIER_MEMORY_MB
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from . import ingest
+from .host_health import collection_tick
+from .models import METRIC_COLUMNS, db
+from .storage import get_storage
+from .storage.tsdb import bucket_rows, format_timestamps, optional, to_micros
+
+logger = logging.getLogger(__name__)
+
+COLUMN_INDEX = {column: i for i, column in enumerate(METRIC_COLUMNS)}
+
+class RingBuffer:
+    """ the newest `capacity` samples of one server, oldest first """
+
+    def __init__(self, capacity, covered_from):
+        self.capacity = capacity
+        self.times = np.zeros(2 * capacity, dtype=np.int64)
+        self.values = np.full((len(METRIC_COLUMNS), 2 * capacity), np.nan)
+        # position of the oldest sample, always below capacity
+        self.head = 0
+        self.count = 0
+        # epoch microseconds from which on every committed sample is held
+        self.covered_from = covered_from
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.values.nbytes
+
+    def view(self):
+        """ (timestamps, values) of every held sample, views into the buffer """
+        return self.times[self.head:self.head + self.count], self.values[:, self.head:self.head + self.count]
+
+    def append(self, times, values):
+        """
+        * add samples sorted by time: times as epoch microseconds, values as a (columns, samples) array
+        * samples already held are filled in with the values present (late high resolution points), older
+          ones that are missing move covered_from past them
+        """
+        held, _ = self.view()
+        if self.count and len(times) and times[0] <= held[-1]:
+            old = times <= held[-1]
+            positions = np.minimum(np.searchsorted(held, times[old]), self.count - 1)
+            found = held[positions] == times[old]
+            missing = times[old][~found]
+            if len(missing):
+                self.covered_from = max(self.covered_from, int(missing.max()) + 1)
+            self.fill(positions[found], values[:, old][:, found])
+            times, values = times[~old], values[:, ~old]
+        if not len(times):
+            return
+
+        # only the newest capacity samples can be kept
+        times, values = times[-self.capacity:], values[:, -self.capacity:]
+        positions = (self.head + self.count + np.arange(len(times))) % self.capacity
+        for offset in (0, self.capacity):
+            self.times[positions + offset] = times
+            self.values[:, positions + offset] = values
+
+        self.count += len(times)
+        if self.count > self.capacity:
+            self.head = (self.head + self.count - self.capacity) % self.capacity
+            self.count = self.capacity
+            # the evicted samples were older than the oldest one left
+            self.covered_from = max(self.covered_from, int(self.times[self.head]))
+
+    def fill(self, positions, values):
+        """ overwrite the held samples at view positions with the values that are not NaN, in both copies """
+        if not len(positions):
+            return
+        present = ~np.isnan(values)
+        for offset in (0, self.capacity):
+            slots = (self.head + positions) % self.capacity + offset
+            current = self.values[:, slots]
+            self.values[:, slots] = np.where(present, values, current)
+
+    def window(self, start, end):
+        """ (timestamps, values) between start and end epoch microseconds inclusive, views into the buffer """
+        times, values = self.view()
+        first, last = np.searchsorted(times, start, 'left'), np.searchsorted(times, end, 'right')
+        return times[first:last], values[:, first:last]
+
+class HotTier:
+    """ ring buffers of every server, keyed by machine name, disabled while capacity or budget is 0 """
+
+    def __init__(self, capacity=0, budget=0, max_age=0):
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.configure(capacity, budget, max_age)
+
+    def configure(self, capacity, budget, max_age):
+        """ set points per server, the memory budget in bytes and the seconds the tier stays fresh, emptying it """
+        with self.lock:
+            self.capacity = capacity
+            self.budget = budget
+            self.max_age = max_age
+            self.buffers.clear()
+            self.refused = set()
+            # monotonic and wall clock (naive UTC, like the row timestamps) time of the last batch
+            self.fed_at = None
+            self.fed_time = None
+
+    @property
+    def enabled(self):
+        return self.capacity > 0 and self.budget > 0
+
+    def nbytes(self):
+        with self.lock:
+            return sum(buffer.nbytes for buffer in self.buffers.values())
+
+    def buffer(self, server, covered_from):
+        """ the server's buffer, created while it fits the budget, None otherwise; called with the lock held """
+        buffer = self.buffers.get(server)
+        if buffer is None and server not in self.refused:
+            used = sum(existing.nbytes for existing in self.buffers.values())
+            buffer = RingBuffer(self.capacity, covered_from)
+            if used + buffer.nbytes > self.budget:
+                logger.warning(f"Hot tier budget of {self.budget / 2 ** 20:.0f} MiB is used up, "
+                               f"{server} is read from storage")
+                self.refused.add(server)
+                return None
+            self.buffers[server] = buffer
+        return buffer
+
+    def fresh(self):
+        """ True when a batch arrived recently enough for the tier to hold every committed sample, called with the lock held """
+        return self.fed_at is not None and (not self.max_age or time.monotonic() - self.fed_at <= self.max_age)
+
+    def append(self, rows):
+        """ add committed metric_logs rows, refilling the buffers from storage first when batches were missed """
+        by_server = {}
+        for row in rows:
+            by_server.setdefault(row['machine_name'], []).append(row)
+
+        with self.lock:
+            missed_since = self.fed_time if self.fed_at is not None and not self.fresh() else None
+            self.fed_at = time.monotonic()
+            self.fed_time = datetime.now(timezone.utc).replace(tzinfo=None)
+        if missed_since is not None:
+            self.refill(missed_since)
+
+        with self.lock:
+            for server, server_rows in by_server.items():
+                times = np.fromiter((to_micros(row['timestamp']) for row in server_rows), dtype=np.int64,
+                                    count=len(server_rows))
+                values = np.array([[row.get(column) for column in METRIC_COLUMNS] for row in server_rows],
+                                  dtype=float).T
+                order = np.argsort(times, kind='stable')
+                buffer = self.buffer(server, int(times[order[0]]))
+                if buffer is not None:
+                    buffer.append(times[order], values[:, order])
+
+    def refill(self, since):
+        """
+        * load the samples committed while this process was not fed, from max_age before the last batch on
+          (through the newest stored one, a host clock may run ahead of this one)
+        * samples older than that which were missed too (late high resolution points) move covered_from past
+          them; when storage cannot be read the buffers are dropped instead
+        """
+        with self.lock:
+            servers = sorted(self.buffers)
+        start = since - timedelta(seconds=self.max_age)
+        try:
+            columns_by_server = get_storage().raw(servers, list(METRIC_COLUMNS), start, datetime.max) if servers else {}
+        except Exception as e:
+            logger.error(f"Hot tier missed updates and could not refill, dropping its buffers: {str(e)}")
+            with self.lock:
+                self.buffers.clear()
+            return
+        logger.info(f"Hot tier missed updates, refilling {len(servers)} servers from {start}")
+        self.load(columns_by_server, start)
+
+    def load(self, columns_by_server, covered_from):
+        """ warm the tier from storage.raw results that hold every sample since covered_from """
+        with self.lock:
+            for server, columns in columns_by_server.items():
+                buffer = self.buffer(server, to_micros(covered_from))
+                if buffer is None:
+                    continue
+                times = np.array(columns['timestamp'], dtype='datetime64[us]').astype(np.int64)
+                values = np.array([columns[column] for column in METRIC_COLUMNS], dtype=float)
+                values = values.reshape(len(METRIC_COLUMNS), len(times))
+                buffer.append(times, values)
+
+    def windows(self, servers, columns, start_time, end_time):
+        """ {server: (timestamps, {column: values})} for the servers whose buffer holds the whole range """
+        if not self.fresh():
+            return {}
+        start, end = to_micros(start_time), to_micros(end_time)
+        found = {}
+        for server in servers:
+            buffer = self.buffers.get(server)
+            if buffer is not None and start >= buffer.covered_from:
+                times, values = buffer.window(start, end)
+                found[server] = (times, {column: values[COLUMN_INDEX[column]] for column in columns})
+        return found
+
+    def raw(self, servers, columns, start_time, end_time):
+        """ storage.raw results for the servers the tier can answer, the others are left out """
+        with self.lock:
+            return {server: {'timestamp': format_timestamps(times),
+                             **{column: optional(values[column]) for column in columns}}
+                    for server, (times, values) in self.windows(servers, columns, start_time, end_time).items()}
+
+    def bucketed(self, servers, columns, start_time, end_time, bucket):
+        """ storage.bucketed rows for the servers the tier can answer, the others are left out """
+        with self.lock:
+            return {server: bucket_rows(times, values, columns, bucket)
+                    for server, (times, values) in self.windows(servers, columns, start_time, end_time).items()}
+
+    def iter_raw(self, server, columns, start_time, end_time, epoch=True, chunk_size=5000):
+        """ storage.iter_raw chunks of the server, None when the tier cannot answer the range """
+        with self.lock:
+            found = self.windows([server], columns, start_time, end_time).get(server)
+            if found is None:
+                return None
+            times, values = found
+            formatted = (times // 1_000_000).tolist() if epoch else format_timestamps(times)
+            rows = list(zip(formatted, *(optional(values[column]) for column in columns)))
+        return [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+
+# shared by every request and the ingest listener of the process
+hot_tier = HotTier()
+
+@ingest.register
+def append_committed_rows(rows):
+    """ keep the hot tier current with every committed batch """
+    if hot_tier.enabled:
+        hot_tier.append(rows)
+
+def init_hot_tier(app):
+    """ size the hot tier from the app config and warm it with the most recent samples of every server """
+    config = app.config
+    capacity = config.get('HOT_TIER_POINTS', 8640)
+    budget = int(config.get('HOT_TIER_MEMORY_MB', 64) * 2 ** 20)
+    # a batch arrives every tick, picked up by the ingest watch up to INGEST_POLL_SECONDS later; a slow cycle,
+    # or one without rows while every circuit breaker is open, may take another tick
+    max_age = config.get('HOT_TIER_MAX_AGE') or 2 * collection_tick(config) + config.get('INGEST_POLL_SECONDS', 5)
+    hot_tier.configure(capacity, budget, max_age)
+    if not hot_tier.enabled:
+        return
+
+    with app.app_context():
+        if ingest.last_seen_id is None:
+            # note the newest row first, so rows other processes commit during the load still arrive
+            ingest.poll_committed_rows()
+        started = time.perf_counter()
+        end = datetime.now(timezone.utc).replace(tzinfo=None)
+        start = end - timedelta(hours=config.get('HOT_TIER_WARM_HOURS', 24))
+        # every server with stored rows, registered in the server table or not
+        storage = get_storage()
+        servers = sorted(storage.latest())
+        if servers:
+            hot_tier.load(storage.raw(servers, list(METRIC_COLUMNS), start, end), start)
+    logger.info(f"Hot tier warmed with {len(servers)} servers ({hot_tier.nbytes() / 2 ** 20:.1f} MiB) "
+                f"in {time.perf_counter() - started:.2f}s")
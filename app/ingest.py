@@ -0,0 +1,115 @@
+"""
+Hooks run after new metric rows are committed.
+
+* Modules that keep derived state (caches, live streams) register a listener here
+* Writers commit inside `writing`, which notifies the listeners with the rows of every successful commit
+* Rows committed by other processes (the lease holder, a standalone collector) are picked up by
+  poll_committed_rows, which every scheduler process runs; a poll skips the rows its own process wrote
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from sqlalchemy import select
+from .models import MetricLogs, METRIC_COLUMNS, db
+
+logger = logging.getLogger(__name__)
+
+listeners = []
+
+# listeners that only take the rows committed by this process, not the polled ones
+local_listeners = []
+
+# id of the newest metric_logs row seen by poll_committed_rows, None before the first poll
+last_seen_id = None
+
+# (machine_name, timestamp) of rows this process committed since its last poll, skipped by that poll
+own_rows = set()
+# held by writes and polls, so a poll never reads a row of this process before it is in own_rows
+_lock = threading.Lock()
+
+def register(listener, local=False):
+    """ add a callable taking the list of committed metric_logs rows, usable as a decorator """
+    target = local_listeners if local else listeners
+    if listener not in target:
+        target.append(listener)
+    return listener
+
+def notify(rows, polled=False):
+    """ hand committed rows to every listener, a failing listener never affects ingestion """
+    for listener in listeners if polled else listeners + local_listeners:
+        try:
+            listener(rows)
+        except Exception as e:
+            logger.error(f"Ingest listener {getattr(listener, '__name__', listener)} failed: {str(e)}")
+
+def newest_rows(rows, seen):
+    """
+    * the newest row of each server among rows, for listeners keeping the latest values
+    * servers whose newest row is older than the one in seen (server -> timestamp, updated here) are left
+      out, so a batch of late high resolution points never takes a server back in time
+    """
+    newest = {}
+    for row in rows:
+        current = newest.get(row['machine_name'])
+        if current is None or row['timestamp'] >= current['timestamp']:
+            newest[row['machine_name']] = row
+    for name, row in list(newest.items()):
+        if name in seen and row['timestamp'] < seen[name]:
+            del newest[name]
+        else:
+            seen[name] = row['timestamp']
+    return newest
+
+def row_key(row):
+    return row['machine_name'], row['timestamp']
+
+@contextmanager
+def writing():
+    """
+    * Wrap a metric_logs write of this process, the caller adds the rows it committed to the yielded list
+    * On success the rows are kept out of the next poll and handed to the listeners
+    """
+    written = []
+    with _lock:
+        yield written
+        if last_seen_id is not None:
+            own_rows.update(row_key(row) for row in written)
+    if written:
+        notify(written)
+
+def poll_committed_rows(limit=10000):
+    """
+    * Notify listeners of metric_logs rows committed by other processes since the last poll
+    * The first poll only records the newest id, older rows are already in the database snapshot
+      the listeners load on demand
+    * Returns the number of rows handed to listeners
+    """
+    global last_seen_id
+    table = MetricLogs.__table__
+    with _lock:
+        if last_seen_id is None:
+            last_seen_id = db.session.execute(select(db.func.max(table.c.id))).scalar() or 0
+            db.session.rollback()
+            return 0
+
+        columns = [table.c.id, table.c.machine_name, table.c.timestamp] + [table.c[metric] for metric in METRIC_COLUMNS]
+        result = db.session.execute(select(*columns).where(table.c.id > last_seen_id).order_by(table.c.id).limit(limit))
+        rows = [dict(row._mapping) for row in result]
+        # end the read transaction so the next poll sees new commits
+        db.session.rollback()
+        if not rows:
+            return 0
+
+        last_seen_id = rows[-1]['id']
+        polled = []
+        for row in rows:
+            del row['id']
+            key = row_key(row)
+            if key in own_rows:
+                # already handed to the listeners when this process committed it
+                own_rows.discard(key)
+            else:
+                polled.append(row)
+    if polled:
+        notify(polled, polled=True)
+    return len(polled)
@@ -0,0 +1,376 @@
+"""
+Write-ahead buffered ingestion of metric rows.
+
+* store_metrics puts each cycle's rows on the queue and returns, a single writer thread inserts them
+  in batches of INGEST_BATCH_SIZE rows or every INGEST_FLUSH_SECONDS, whichever comes first
+* Every put is appended to a journal file before it is queued, and the writer checkpoints the last
+  committed entry, so rows not yet committed when the process dies are replayed on the next start
+* The journal is emptied whenever the queue drains, and rewritten from the first uncommitted entry once
+  the committed entries ahead of it take INGEST_JOURNAL_COMPACT_MB, so it stays bounded under steady load
+* Memory holds at most INGEST_QUEUE_MAX_ROWS rows: a put waits up to INGEST_PUT_TIMEOUT seconds for room
+  (backpressure), then spills to the journal only and the writer reads it back once it catches up
+* A failing batch is retried row by row so one bad row never rolls back every server's sample,
+  while the storage is unavailable the rows stay queued and are retried
+"""
+import atexit
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from sqlalchemy.exc import OperationalError
+from .instrumentation import timed_write
+from .storage import get_storage
+from . import ingest
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks on Windows, only one process may use a journal there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# defaults used when the app config does not set the queue limits
+DEFAULT_MAX_ROWS = 50000
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_SECONDS = 1.0
+DEFAULT_PUT_TIMEOUT = 5.0
+DEFAULT_COMPACT_BYTES = 16 * 2 ** 20
+
+# seconds the writer waits before retrying while the storage is unavailable
+RETRY_SECONDS = 5.0
+
+class JournalLocked(Exception):
+    """ another process already writes through this journal """
+
+def encode_row(row):
+    return {**row, 'timestamp': row['timestamp'].isoformat()}
+
+def decode_row(row):
+    return {**row, 'timestamp': datetime.fromisoformat(row['timestamp'])}
+
+class IngestQueue:
+    """ bounded, journaled queue of metric_logs rows drained by one writer thread """
+
+    def __init__(self, app, journal_path, max_rows=DEFAULT_MAX_ROWS, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_SECONDS, put_timeout=DEFAULT_PUT_TIMEOUT, fsync=True,
+                 compact_bytes=DEFAULT_COMPACT_BYTES):
+        self.app = app
+        self.journal_path = journal_path
+        self.checkpoint_path = journal_path + '.checkpoint'
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.fsync = fsync
+        self.compact_bytes = compact_bytes
+
+        self.condition = threading.Condition()
+        # (sequence, rows, journal offset past the entry) journal entries held in memory, oldest first
+        self.pending = deque()
+        self.pending_rows = 0
+        # journal offset of the first entry not loaded into memory, None while nothing is spilled
+        self.spill_offset = None
+        # journal offset past the last committed entry, everything before it can be dropped
+        self.committed_offset = 0
+        self.stopping = False
+        self.thread = None
+
+        self.journal = open(journal_path, 'a+b')
+        try:
+            self.lock_journal(self.journal)
+        except OSError:
+            self.journal.close()
+            raise JournalLocked(journal_path)
+
+        self.committed = self.read_checkpoint()
+        self.sequence = self.committed
+        self.replay()
+
+    @staticmethod
+    def lock_journal(journal):
+        """ take the advisory lock keeping other processes off the journal, OSError when one holds it """
+        if fcntl is not None:
+            fcntl.flock(journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def read_checkpoint(self):
+        """ sequence of the last committed journal entry """
+        try:
+            with open(self.checkpoint_path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def write_checkpoint(self, sequence):
+        temporary = self.checkpoint_path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(str(sequence))
+        os.replace(temporary, self.checkpoint_path)
+
+    def replay(self):
+        """ queue the journal entries committed after the checkpoint, cutting off a torn last line """
+        self.journal.seek(0)
+        offset = 0
+        replayed = 0
+        for line in self.journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logger.warning(f"Discarding torn entry at the end of {self.journal_path}")
+                break
+            self.sequence = max(self.sequence, entry['seq'])
+            if entry['seq'] > self.committed:
+                replayed += len(entry['rows'])
+                if self.spill_offset is None and self.fits(len(entry['rows'])):
+                    self.enqueue(entry['seq'], [decode_row(row) for row in entry['rows']], offset + len(line))
+                elif self.spill_offset is None:
+                    self.spill_offset = offset
+            elif not replayed:
+                self.committed_offset = offset + len(line)
+            offset += len(line)
+        self.journal.truncate(offset)
+        if replayed:
+            logger.info(f"Replaying {replayed} uncommitted rows from {self.journal_path}")
+
+    def fits(self, count):
+        # an entry larger than the whole queue is still let into an empty queue
+        return not self.pending_rows or self.pending_rows + count <= self.max_rows
+
+    def enqueue(self, sequence, rows, end):
+        self.pending.append((sequence, rows, end))
+        self.pending_rows += len(rows)
+
+    def append(self, sequence, rows):
+        """ write one entry to the end of the journal, returns its offset """
+        self.journal.seek(0, os.SEEK_END)
+        offset = self.journal.tell()
+        self.journal.write(json.dumps({'seq': sequence, 'rows': [encode_row(row) for row in rows]}).encode() + b'\n')
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+        return offset
+
+    def put(self, rows, timeout=None):
+        """
+        * Journal the rows and queue them for the writer, durable once this returns
+        * Waits up to timeout seconds (INGEST_PUT_TIMEOUT by default) while the queue is full
+        * Returns True when the rows were queued in memory, False when they were spilled to the journal
+        """
+        if not rows:
+            return True
+        timeout = self.put_timeout if timeout is None else timeout
+        with self.condition:
+            deadline = time.monotonic() + timeout
+            while self.spill_offset is None and not self.fits(len(rows)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            self.sequence += 1
+            offset = self.append(self.sequence, rows)
+            if self.spill_offset is None and self.fits(len(rows)):
+                self.enqueue(self.sequence, rows, self.journal.tell())
+                self.condition.notify_all()
+                return True
+
+            if self.spill_offset is None:
+                self.spill_offset = offset
+                logger.warning(f"Ingest queue full ({self.pending_rows} rows), spilling to {self.journal_path}")
+            return False
+
+    def load_spilled(self):
+        """ move spilled journal entries back into memory while there is room, called with the lock held """
+        with open(self.journal_path, 'rb') as journal:
+            journal.seek(self.spill_offset)
+            for line in iter(journal.readline, b''):
+                entry = json.loads(line)
+                if not self.fits(len(entry['rows'])):
+                    return
+                self.spill_offset += len(line)
+                self.enqueue(entry['seq'], [decode_row(row) for row in entry['rows']], self.spill_offset)
+        self.spill_offset = None
+
+    def next_batch(self):
+        """
+        * Wait for a full batch or the flush interval, then return (entry count, rows) from the head
+          of the queue, the entries stay queued until they are committed
+        * Returns None once the queue is stopping and empty
+        """
+        with self.condition:
+            deadline = time.monotonic() + self.flush_interval
+            while not self.stopping:
+                if self.spill_offset is not None:
+                    self.load_spilled()
+                if self.pending_rows >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if self.pending:
+                        break
+                    # idle, the interval starts over with the next put
+                    deadline = time.monotonic() + self.flush_interval
+                    remaining = self.flush_interval
+                self.condition.wait(remaining)
+
+            if self.spill_offset is not None:
+                self.load_spilled()
+            if not self.pending:
+                return None if self.stopping else (0, [])
+
+            count, rows = 0, []
+            for _, entry_rows, _ in self.pending:
+                if rows and len(rows) + len(entry_rows) > self.batch_size:
+                    break
+                rows.extend(entry_rows)
+                count += 1
+            return count, rows
+
+    def write(self, rows):
+        """ store a batch in one write, row by row when that fails; False while the storage is unavailable """
+        with self.app.app_context():
+            storage = get_storage(self.app)
+            with ingest.writing() as written:
+                try:
+                    with timed_write(storage.name, rows):
+                        storage.write(rows)
+                except (OperationalError, OSError) as e:
+                    logger.warning(f"Storage unavailable, {len(rows)} rows stay queued: {str(e)}")
+                    return False
+                except Exception as e:
+                    logger.error(f"Batch write failed, retrying row by row: {str(e)}")
+                    rows = self.write_each(storage, rows)
+                written.extend(rows)
+        return True
+
+    def write_each(self, storage, rows):
+        """ store rows one at a time, dropping the ones the storage rejects, returns the written rows """
+        written = []
+        for row in rows:
+            try:
+                with timed_write(storage.name, [row]):
+                    storage.write([row])
+                written.append(row)
+            except Exception as e:
+                logger.error(f"Dropping metric row for {row.get('machine_name')}: {str(e)}")
+        return written
+
+    def committed_entries(self, count):
+        """
+        * drop committed entries from the queue and checkpoint them
+        * then empty the journal once nothing is left, or drop the committed entries from its start once
+          they take compact_bytes
+        """
+        with self.condition:
+            for _ in range(count):
+                sequence, rows, end = self.pending.popleft()
+                self.pending_rows -= len(rows)
+            self.committed = sequence
+            self.committed_offset = end
+            self.write_checkpoint(sequence)
+            if not self.pending and self.spill_offset is None:
+                self.journal.truncate(0)
+                self.committed_offset = 0
+            elif self.compact_bytes and self.committed_offset >= self.compact_bytes:
+                self.compact()
+            self.condition.notify_all()
+
+    def compact(self):
+        """
+        * rewrite the journal from the first uncommitted entry, called with the lock held
+        * the copy is locked and durable before it replaces the journal, a crash leaves either file complete
+        """
+        temporary = self.journal_path + '.tmp'
+        journal = open(temporary, 'w+b')
+        try:
+            self.lock_journal(journal)
+            self.journal.seek(self.committed_offset)
+            shutil.copyfileobj(self.journal, journal)
+            journal.flush()
+            if self.fsync:
+                os.fsync(journal.fileno())
+            os.replace(temporary, self.journal_path)
+        except OSError as e:
+            journal.close()
+            logger.error(f"Could not compact {self.journal_path}: {str(e)}")
+            return
+        self.journal.close()
+        self.journal = journal
+
+        dropped = self.committed_offset
+        self.pending = deque((sequence, rows, end - dropped) for sequence, rows, end in self.pending)
+        if self.spill_offset is not None:
+            self.spill_offset -= dropped
+        self.committed_offset = 0
+        logger.info(f"Compacted {self.journal_path}, dropped {dropped} bytes of committed entries")
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            count, rows = batch
+            if not count:
+                continue
+            if self.write(rows):
+                self.committed_entries(count)
+                logger.info(f"{len(rows)} server metrics saved at {datetime.now()}")
+            else:
+                with self.condition:
+                    if self.stopping:
+                        # rows stay in the journal and are replayed on the next start
+                        return
+                    self.condition.wait(RETRY_SECONDS)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='ingest-writer', daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self, timeout=10):
+        """ drain what can be written within timeout seconds, anything left is replayed on the next start """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.journal.close()
+
+    def backlog(self):
+        """ rows waiting in memory, and whether more are spilled to the journal """
+        with self.condition:
+            return self.pending_rows, self.spill_offset is not None
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_queue(app):
+    """
+    * The process wide ingest queue, started on first use when INGEST_QUEUE is enabled
+    * None when the queue is disabled or another process holds the journal, rows are then written directly
+    """
+    global _queue
+    if not app.config.get('INGEST_QUEUE', False):
+        return None
+    with _queue_lock:
+        if _queue is None:
+            path = app.config.get('INGEST_JOURNAL_PATH') or os.path.join(app.instance_path, 'ingest.journal')
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            try:
+                _queue = IngestQueue(
+                    app, path,
+                    max_rows=app.config.get('INGEST_QUEUE_MAX_ROWS', DEFAULT_MAX_ROWS),
+                    batch_size=app.config.get('INGEST_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+                    flush_interval=app.config.get('INGEST_FLUSH_SECONDS', DEFAULT_FLUSH_SECONDS),
+                    put_timeout=app.config.get('INGEST_PUT_TIMEOUT', DEFAULT_PUT_TIMEOUT),
+                    compact_bytes=int(app.config.get('INGEST_JOURNAL_COMPACT_MB', 16) * 2 ** 20),
+                ).start()
+            except JournalLocked:
+                logger.warning(f"Ingest journal {path} is held by another process, writing rows directly")
+                return None
+            atexit.register(_queue.close)
+        return _queue
@@ -0,0 +1,245 @@
+"""
+Self-instrumentation of the collector and the API, exposed in the Prometheus text format.
+
+* A small in-process registry of labelled counters, gauges and histograms, rendered at /metrics
+  (and by the standalone collector with --metrics-port)
+* Every process keeps its own values: scrape each web worker and collector, or use a single worker
+* A collection cycle can be profiled on demand: POST /metrics/profile leaves a request file next to
+  the profiles, the next cycle run by any process on the host consumes it and writes its report there
+"""
+import bisect
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# latency buckets in seconds, from a fast local query up to a request timeout
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = []
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """ a named family of values, one per combination of label values """
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self):
+        """ (suffix, label values, extra labels, value) lines of the exposition """
+        with self.lock:
+            return [('', key, (), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(self.labels, key, extra)} {format_value(value)}')
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """ observe how long the block took, also when it raises """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    samples.append(('_bucket', key, (('le', format_value(float(bound))),), cumulative))
+                samples.append(('_sum', key, (), total))
+                samples.append(('_count', key, (), cumulative))
+        return samples
+
+def render():
+    """ every registered metric in the Prometheus text exposition format """
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+# collection
+FETCH_SECONDS = Histogram('resourceradar_fetch_seconds', 'Netdata request latency', ['host', 'chart'])
+FETCH_ERRORS = Counter('resourceradar_fetch_errors_total', 'Failed Netdata requests by kind (timeout, http, parse)',
+                       ['host', 'chart', 'kind'])
+CYCLE_TIMEOUTS = Counter('resourceradar_cycle_timeouts_total', 'Charts still running at the collection cycle deadline',
+                         ['server'])
+CYCLE_SECONDS = Histogram('resourceradar_cycle_seconds', 'Duration of collection cycles')
+LAST_CYCLE_SECONDS = Gauge('resourceradar_last_cycle_seconds', 'Duration of the most recent collection cycle')
+CYCLE_INTERVAL_SECONDS = Gauge('resourceradar_cycle_interval_seconds', 'Configured seconds between collection cycles')
+HOST_CIRCUIT_OPEN = Gauge('resourceradar_host_circuit_open', 'Whether collection of a host is suspended (1) after failures',
+                          ['host'])
+HOSTS_SKIPPED = Counter('resourceradar_hosts_skipped_total', 'Hosts left out of a collection cycle by their circuit breaker',
+                        ['host'])
+
+# alerting
+ALERTS_FIRING = Gauge('resourceradar_alerts_firing', 'Whether an alert rule is firing (1) for a host', ['rule', 'host'])
+ALERT_NOTIFICATIONS = Counter('resourceradar_alert_notifications_total', 'Alert notifications sent by sink and state',
+                              ['sink', 'state'])
+
+# storage
+ROWS_WRITTEN = Counter('resourceradar_rows_written_total', 'Metric rows stored', ['backend'])
+WRITE_BATCH_ROWS = Histogram('resourceradar_write_batch_rows', 'Metric rows per commit', ['backend'], buckets=SIZE_BUCKETS)
+COMMIT_SECONDS = Histogram('resourceradar_commit_seconds', 'Duration of metric row commits', ['backend'])
+
+# API
+REQUEST_SECONDS = Histogram('resourceradar_request_seconds', 'API request latency until the response starts',
+                            ['endpoint', 'method', 'status'])
+
+@contextmanager
+def timed_write(backend, rows):
+    """ time one storage write and count its rows once it succeeded """
+    with COMMIT_SECONDS.time(backend=backend):
+        yield
+    ROWS_WRITTEN.inc(len(rows), backend=backend)
+    WRITE_BATCH_ROWS.observe(len(rows), backend=backend)
+
+def profile_directory(app):
+    return app.config.get('PROFILE_DIR') or os.path.join(app.instance_path, 'profiles')
+
+def request_profile(app):
+    """ ask the next collection cycle to run under the profiler """
+    directory = profile_directory(app)
+    os.makedirs(directory, exist_ok=True)
+    open(os.path.join(directory, 'requested'), 'w').close()
+
+def take_profile_request(app):
+    """ True once for a pending profile request, which is then consumed """
+    try:
+        os.remove(os.path.join(profile_directory(app), 'requested'))
+        return True
+    except FileNotFoundError:
+        return False
+
+def profile_call(app, func, *args, **kwargs):
+    """
+    * Run func under pyinstrument when PROFILER is 'pyinstrument' and it is installed, cProfile otherwise
+    * The report is written to a timestamped file in the profile directory, func's result is returned
+    """
+    report = io.StringIO()
+    if app.config.get('PROFILER') == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.warning("pyinstrument is not installed, profiling with cProfile")
+        else:
+            profiler = Profiler()
+            profiler.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.stop()
+                save_profile(app, profiler.output_text())
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(50)
+        save_profile(app, report.getvalue())
+
+def save_profile(app, text):
+    directory = profile_directory(app)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, datetime.now(timezone.utc).strftime('cycle-%Y%m%dT%H%M%S.txt'))
+    with open(path, 'w') as f:
+        f.write(text)
+    logger.info(f"Collection cycle profile written to {path}")
+
+def latest_profile(app):
+    """ text of the newest cycle profile, None when none was taken yet """
+    directory = profile_directory(app)
+    try:
+        profiles = sorted(name for name in os.listdir(directory) if name.startswith('cycle-'))
+    except FileNotFoundError:
+        return None
+    if not profiles:
+        return None
+    with open(os.path.join(directory, profiles[-1])) as f:
+        return f.read()
+
+def serve(port, host='0.0.0.0'):
+    """ expose render() on http://host:port/metrics from a daemon thread, for processes without Flask routes """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,53 @@
+"""
+Database leases so a scheduled job runs in exactly one process.
+
+* Every Gunicorn worker (and collector process) schedules the same jobs, but a job only does its
+  work while its process holds the job's lease
+* A lease is taken or renewed with one conditional UPDATE, so two processes can never both win,
+  and it expires on its own when the holder dies
+"""
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+# identifies this process as a lease owner
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def acquire_lease(name, ttl, owner=None):
+    """ take or renew the named lease for ttl seconds, True when this process holds it afterwards """
+    owner = owner or OWNER
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    params = {'name': name, 'owner': owner, 'now': now, 'expires_at': now + timedelta(seconds=ttl)}
+    try:
+        result = db.session.execute(text('''
+            UPDATE scheduler_lease
+            SET owner = :owner, expires_at = :expires_at
+            WHERE name = :name AND (owner = :owner OR expires_at < :now)
+        '''), params)
+        if result.rowcount == 0:
+            # no such lease yet; if another process creates it first the primary key rejects this one
+            db.session.execute(text('''
+                INSERT INTO scheduler_lease (name, owner, expires_at) VALUES (:name, :owner, :expires_at)
+            '''), params)
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Could not acquire lease {name}: {str(e)}")
+        return False
+
+def release_lease(name, owner=None):
+    """ give up the named lease early, e.g. on shutdown, so another process can take over right away """
+    db.session.execute(text('DELETE FROM scheduler_lease WHERE name = :name AND owner = :owner'),
+                       {'name': name, 'owner': owner or OWNER})
+    db.session.commit()
@@ -7,96 +7,286 @@
 * Network Usage: Amount of kilobits per second being sent over the network,sent and recived (kbit/s)
 * Disk Usage: Percent of space used on device (percentage)
 """
-from .models import db
-from sqlalchemy import text
+import math
+from flask import current_app
+from . import ingest
+from .cache import SnapshotCache
+from .downsampling import epoch_seconds, lttb
+from .hot_tier import hot_tier
+from .metric_spec import get_spec
+from .rollups import choose_tier
+from .storage import get_storage
 from datetime import datetime
 
-def get_connection():
-    conn = db.engine.connect()
-    return conn
+# map corresponding metric types
+metric_map = {
+    'cpu': 'cpu_usage',
+    'memory': 'memory_usage',
+    'disk': 'disk_usage',
+    'network': ['network_received', 'network_sent']
+}
+
+# ways historical_metrics can reduce a series to max_points
+DOWNSAMPLE_METHODS = ('avg', 'lttb')
+
+# timestamp of the newest row folded into the snapshot per server
+_latest_seen = {}
 
 def latest_metrics():
-    """ queries most recent data for both machines then returns a dictionary containing each servers data """
-    conn = get_connection()
-    query_result = conn.execute(text('''
-        SELECT *
-        FROM metric_logs
-        ORDER BY id DESC
-        LIMIT 2
-    ''')).mappings().all()
-
-    latest_metrics = [dict(row) for row in query_result]
-
-    conn.close()
+    """ queries most recent data for every machine then returns a dictionary containing each servers data """
     # create a dictionary for each servers data
     server_metrics = {}
-    for metric in latest_metrics:
-        name = metric['machine_name']
-        # if machine not yet in server metrics, add it
-        if name not in server_metrics:
-            server_metrics[name] = {
-                # need cpu_usage, memory_usage, network_usage, and disk_usage
-                'cpu_usage': round(metric['cpu_usage'], 2),
-                'network_received': round(metric['network_received'], 2),
-                'network_sent': round(metric['network_sent'], 2),
-                'disk_usage': round(metric['disk_usage'], 2),
-                'memory_usage': round(metric['memory_usage'], 2)
-            }
+    latest = get_storage().latest()
+    for name, metric in latest.items():
+        server_metrics[name] = format_latest(metric)
 
+    # committed rows older than the stored ones no longer replace them in the snapshot
+    _latest_seen.clear()
+    _latest_seen.update({name: datetime.fromisoformat(str(metric['timestamp'])) for name, metric in latest.items()})
     return server_metrics
 
-def historical_metrics(metric_type: str, server_id: str, start_time: datetime, end_time: datetime) -> dict:
-    """ allow custom querying over timespans and returns dict containing the relevant values """
-    conn = get_connection()
-    # map corresponding metric types
-    metric_map = {
-        'cpu': 'cpu_usage',
-        'memory': 'memory_usage',
-        'disk': 'disk_usage',
-        'network': ['network_received', 'network_sent']
+def format_latest(metric):
+    """ need cpu_usage, memory_usage, network_usage, and disk_usage, left empty when a collection failed """
+    return {
+        column: round(metric[column], 2) if metric[column] is not None else None
+        for column in ('cpu_usage', 'network_received', 'network_sent', 'disk_usage', 'memory_usage')
     }
 
-    # validate metric_type
-    if metric_type not in metric_map:
-        raise ValueError(f"Invalid metric type: {metric_type}")
+# latest snapshot served to the dashboards, kept current by store_metrics instead of re-queried per poll
+latest_cache = SnapshotCache(latest_metrics)
 
-    # now get correct SQL queries
-    if metric_type == 'network':
-        query = text(f'''
-            SELECT timestamp, network_received, network_sent
-            FROM metric_logs
-            WHERE machine_name = :server_id
-            AND timestamp BETWEEN :start_time AND :end_time
-            ORDER BY timestamp
-        ''')
+def cached_latest_metrics():
+    """ latest_metrics snapshot and its ETag, only touching the database when the cache is empty or stale """
+    return latest_cache.get(ttl=current_app.config.get('LATEST_CACHE_TTL', 60))
+
+@ingest.register
+def update_latest_cache(rows):
+    """ fold the newest committed row of each server into the latest snapshot """
+    newest = ingest.newest_rows(rows, _latest_seen)
+    latest_cache.update({name: format_latest(row) for name, row in newest.items()})
+
+def historical_metrics(metric_type: str, server_id: str, start_time: datetime, end_time: datetime,
+                       max_points: int = None, bucket: int = None, method: str = 'avg') -> dict:
+    """
+    allow custom querying over timespans and returns dict containing the relevant values
+    * bucket (seconds) returns the min/avg/max of every time bucket, aggregated in SQL
+    * max_points bounds the number of points: with method 'avg' it picks the bucket size,
+      with method 'lttb' it keeps the most visually significant raw points
+    """
+    validate_query([metric_type], max_points, bucket, method)
+    bucket, tier = plan_query(start_time, end_time, max_points, bucket, method)
+
+    if bucket:
+        series = bucketed_metrics(metric_type, server_id, start_time, end_time, bucket, tier)
+    else:
+        columns = read_raw([server_id], metric_columns(metric_type), start_time, end_time)[server_id]
+        series = raw_series(metric_type, columns)
+
+    if max_points and method == 'lttb':
+        return lttb(series, value_keys(metric_type), max_points)
+    return series
+
+def batch_historical_metrics(selectors: list, start_time: datetime, end_time: datetime,
+                             max_points: int = None, bucket: int = None, method: str = 'avg') -> dict:
+    """
+    answer several (server, metrics) selectors over one time range with a single storage read
+    * selectors: [{'server': name, 'metrics': ['cpu', 'network', ...]}, ...]
+    * returns {server: {metric: series}}, each series shaped like historical_metrics returns it
+    """
+    wanted = {}
+    for selector in selectors:
+        wanted.setdefault(selector['server'], [])
+        for metric_type in selector['metrics']:
+            if metric_type not in wanted[selector['server']]:
+                wanted[selector['server']].append(metric_type)
+    metric_types = {metric_type for metrics in wanted.values() for metric_type in metrics}
+    validate_query(metric_types, max_points, bucket, method)
+    if not wanted:
+        return {}
+
+    bucket, tier = plan_query(start_time, end_time, max_points, bucket, method)
+    columns = [column for metric_type in metric_map if metric_type in metric_types for column in metric_columns(metric_type)]
+    if bucket:
+        by_server = read_bucketed(list(wanted), columns, start_time, end_time, bucket, tier)
     else:
-        metric = metric_map[metric_type]
-        query = text(f'''
-            SELECT timestamp, {metric}
-            FROM metric_logs
-            WHERE machine_name = :server_id
-            AND timestamp BETWEEN :start_time AND :end_time
-            ORDER BY timestamp
-        ''')
-
-    # execute query
-    result = conn.execute(query, {
-        'server_id': server_id,
-        'start_time': start_time,
-        'end_time': end_time 
-    }).mappings().all()
-
-    conn.close()
-
-    # structure output
+        by_server = read_raw(list(wanted), columns, start_time, end_time)
+
+    response = {}
+    for server, metrics in wanted.items():
+        response[server] = {}
+        for metric_type in metrics:
+            if bucket:
+                series = bucket_series(metric_type, by_server[server], bucket)
+            else:
+                series = raw_series(metric_type, by_server[server])
+            if max_points and method == 'lttb':
+                series = lttb(series, value_keys(metric_type), max_points)
+            response[server][metric_type] = series
+    return response
+
+def validate_query(metric_types, max_points, bucket, method):
+    """ raise ValueError for an unknown metric type or out of range downsampling options """
+    for metric_type in metric_types:
+        # validate metric_type
+        if metric_type not in metric_map:
+            raise ValueError(f"Invalid metric type: {metric_type}")
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"Invalid downsampling method: {method}")
+    if max_points is not None and max_points < 3:
+        raise ValueError("max_points must be at least 3")
+    if bucket is not None and bucket < 1:
+        raise ValueError("bucket must be at least 1 second")
+
+def plan_query(start_time: datetime, end_time: datetime, max_points: int, bucket: int, method: str):
+    """
+    * (bucket seconds or None for raw points, rollup tier or None for metric_logs) to answer a query with
+    * long or old ranges are read from the coarsest rollup tier that still has enough detail
+    """
+    # coarsest spacing between points the caller can accept, 0 when every raw point is wanted
+    resolution = bucket or 0
+    if not resolution and max_points:
+        resolution = (end_time - start_time).total_seconds() / max_points
+
+    if bucket is None and max_points and method == 'avg':
+        bucket = max(1, math.ceil(resolution))
+
+    tier = choose_tier(start_time, resolution)
+    if tier is not None:
+        bucket = max(bucket or 0, tier.seconds)
+    return bucket, tier
+
+def read_raw(servers: list, columns: list, start_time: datetime, end_time: datetime) -> dict:
+    """ storage.raw columns of every server, from the hot tier for the servers it holds the whole range of """
+    result = hot_tier.raw(servers, columns, start_time, end_time)
+    missing = [server for server in servers if server not in result]
+    if missing:
+        result.update(get_storage().raw(missing, columns, start_time, end_time))
+    return result
+
+def read_bucketed(servers: list, columns: list, start_time: datetime, end_time: datetime, bucket: int,
+                  tier=None) -> dict:
+    """ storage.bucketed rows of every server, aggregated from the hot tier's raw samples when it holds the range """
+    result = hot_tier.bucketed(servers, columns, start_time, end_time, bucket)
+    missing = [server for server in servers if server not in result]
+    if missing:
+        result.update(get_storage().bucketed(missing, columns, start_time, end_time, bucket, tier))
+    return result
+
+def metric_columns(metric_type: str) -> list:
+    """ metric_logs columns behind a metric type """
+    return metric_map[metric_type] if metric_type == 'network' else [metric_map[metric_type]]
+
+def value_keys(metric_type: str) -> tuple:
+    """ keys of the value lists in a series of this metric type """
+    return ('sent', 'received') if metric_type == 'network' else ('values',)
+
+def raw_series(metric_type: str, columns: dict) -> dict:
+    """ structure raw {'timestamp': [...], column: [...]} storage columns as a historical_metrics series """
     if metric_type == 'network':
         return {
-            'timestamps': [row['timestamp'] for row in result],
-            'sent': [row['network_sent'] if row['network_sent'] is not None else 0 for row in result],
-            'received': [row['network_received'] if row['network_received'] is not None else 0 for row in result]
+            'timestamps': columns['timestamp'],
+            'sent': columns['network_sent'],
+            'received': columns['network_received']
         }
     else:
         return {
-            'timestamps': [row['timestamp']for row in result],
-            'values': [round(row[metric_map[metric_type]], 2) if row[metric_map[metric_type]] is not None else 0 for row in result]
+            'timestamps': columns['timestamp'],
+            # a missing value stays None, a gap rather than a zero sample
+            'values': [round(value, 2) if value is not None else None for value in columns[metric_map[metric_type]]]
         }
+
+def series_columns(metric_type: str, per_row: bool = False) -> tuple:
+    """ column names of a historical series, singular when every row is its own object (NDJSON) """
+    if metric_type == 'network':
+        return ('timestamp', 'sent', 'received') if per_row else ('timestamps', 'sent', 'received')
+    return ('timestamp', 'value') if per_row else ('timestamps', 'values')
+
+def series_rows(metric_type: str, series: dict) -> list:
+    """ turn a historical_metrics dict into (epoch second, values...) rows, matching series_columns """
+    epochs = epoch_seconds(series['timestamps']).astype(int).tolist()
+    return list(zip(epochs, *(series[key] for key in value_keys(metric_type))))
+
+def iter_historical_metrics(metric_type: str, server_id: str, start_time: datetime, end_time: datetime,
+                            epoch: bool = True, chunk_size: int = 5000):
+    """
+    stream the raw rows of historical_metrics off the cursor, chunk_size rows at a time
+    * rows are (timestamp, values...) in series_columns order
+    * epoch gives epoch second timestamps and raw values, otherwise timestamps and values
+      are shaped exactly like the historical_metrics lists
+    """
+    # validate metric_type before the generator starts, so a bad request fails before any output
+    if metric_type not in metric_map:
+        raise ValueError(f"Invalid metric type: {metric_type}")
+
+    columns = ['network_sent', 'network_received'] if metric_type == 'network' else [metric_map[metric_type]]
+    storage = get_storage()
+
+    def shape(row):
+        if epoch:
+            return tuple(row)
+        if metric_type == 'network':
+            return tuple(row)
+        return (row[0], round(row[1], 2) if row[1] is not None else None)
+
+    def chunks():
+        # recent ranges come from the hot tier, already in memory
+        hot = hot_tier.iter_raw(server_id, columns, start_time, end_time, epoch=epoch, chunk_size=chunk_size)
+        source = hot if hot is not None else storage.iter_raw(server_id, columns, start_time, end_time, epoch=epoch,
+                                                               chunk_size=chunk_size)
+        for chunk in source:
+            yield [shape(row) for row in chunk]
+
+    return chunks()
+
+def bucketed_metrics(metric_type: str, server_id: str, start_time: datetime, end_time: datetime, bucket: int,
+                     tier=None) -> dict:
+    """
+    min/avg/max of a metric per time bucket of `bucket` seconds, keyed like historical_metrics
+    * aggregated from the hot tier when it holds the range, otherwise read from raw samples, or re-aggregated
+      from a rollup tier when one is given and the backend has them
+    """
+    result = read_bucketed([server_id], metric_columns(metric_type), start_time, end_time, bucket, tier)
+    return bucket_series(metric_type, result[server_id], bucket)
+
+def bucket_series(metric_type: str, result, bucket: int) -> dict:
+    """ structure bucketed rows as a historical_metrics series with min/max alongside the averages """
+    def values(column, aggregate):
+        return [round(row[f'{column}_{aggregate}'], 2) if row[f'{column}_{aggregate}'] is not None else None
+                for row in result]
+
+    series = {'timestamps': [row['timestamp'] for row in result], 'bucket': int(bucket)}
+    if metric_type == 'network':
+        for key, column in (('sent', 'network_sent'), ('received', 'network_received')):
+            series[key] = values(column, 'avg')
+            series[f'{key}_min'] = values(column, 'min')
+            series[f'{key}_max'] = values(column, 'max')
+    else:
+        column = metric_map[metric_type]
+        series['values'] = values(column, 'avg')
+        series['min'] = values(column, 'min')
+        series['max'] = values(column, 'max')
+    return series
+
+def subscribed_series(server_id: str) -> list:
+    """ the subscribed series stored for a server, with the unit and description of their metric spec entry """
+    metrics = {metric.name: metric for metric in get_spec(current_app.config)}
+    catalog = []
+    for name in get_storage().series_names(server_id):
+        metric = metrics.get(name.split(':', 1)[0])
+        catalog.append({
+            'series': name,
+            'unit': metric.unit if metric else '',
+            'description': metric.description if metric else ''
+        })
+    return catalog
+
+def series_metrics(server_id: str, series: str, start_time: datetime, end_time: datetime,
+                   max_points: int = None) -> dict:
+    """ raw points of one subscribed series, shaped like historical_metrics, LTTB downsampled to max_points """
+    if max_points is not None and max_points < 3:
+        raise ValueError("max_points must be at least 3")
+    columns = get_storage().samples(server_id, series, start_time, end_time)
+    result = {'timestamps': columns['timestamp'], 'values': [round(value, 2) for value in columns['value']]}
+    if max_points:
+        result = lttb(result, ('values',), max_points)
+    return result
@@ -0,0 +1,191 @@
+"""
+Declarative subscriptions to Netdata charts beyond the built-in metric_logs columns.
+
+* METRIC_SPEC_PATH points at a JSON list of metrics, for example
+    {"name": "disk_used", "chart": "disk_space.*", "dimensions": ["avail", "used", "reserved for root"],
+     "expression": "(used + reserved_for_root) / total * 100", "unit": "%"}
+* chart may hold one '*' to match many charts (every mount, interface or cgroup); the part it matched
+  becomes the instance of the series, stored as name:instance (disk_used:/home)
+* expression is arithmetic over the dimensions (characters other than letters, digits and '_' replaced by '_'),
+  total (the sum of the dimensions), numbers, + - * / and abs, min, max; without one the metric is the total.
+  Without dimensions every dimension of the chart is summed into total
+* Each metric is derived for every matching chart of every host at once with numpy, so the Python work per
+  cycle grows with the number of metrics, not with hosts times metrics; numpy is only imported once a metric
+  is derived, the standalone collector starts without it
+* Derived samples are stored in the narrow metric_samples table, one row per server, series and timestamp
+"""
+import ast
+import json
+import logging
+import math
+import re
+
+logger = logging.getLogger(__name__)
+
+# key of the subscribed charts ({chart: {dimension: value}}) in the chart data fetch_server returns
+SUBSCRIPTIONS = 'subscriptions'
+
+# numpy ufunc of each function and operator expressions may use
+FUNCTIONS = {'abs': 'abs', 'min': 'minimum', 'max': 'maximum'}
+OPERATORS = {ast.Add: 'add', ast.Sub: 'subtract', ast.Mult: 'multiply', ast.Div: 'divide'}
+
+def identifier(dimension):
+    """ name a dimension goes by in expressions """
+    return re.sub(r'\W', '_', dimension)
+
+def compile_expression(expression, names):
+    """ parse an expression into an ast, raising ValueError for anything but arithmetic over names """
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"Invalid expression {expression!r}: {e.msg}")
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id not in names and node.id not in FUNCTIONS:
+                raise ValueError(f"Unknown name {node.id!r} in {expression!r}")
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords:
+                raise ValueError(f"Only {', '.join(FUNCTIONS)} can be called in {expression!r}")
+            if len(node.args) != 1 if node.func.id == 'abs' else len(node.args) < 2:
+                raise ValueError(f"Wrong number of arguments to {node.func.id} in {expression!r}")
+        elif isinstance(node, ast.BinOp):
+            if type(node.op) not in OPERATORS:
+                raise ValueError(f"Unsupported operator in {expression!r}")
+        elif isinstance(node, ast.UnaryOp):
+            if not isinstance(node.op, (ast.UAdd, ast.USub)):
+                raise ValueError(f"Unsupported operator in {expression!r}")
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)) or isinstance(node.value, bool):
+                raise ValueError(f"Only numbers are allowed in {expression!r}")
+        elif not isinstance(node, (ast.Expression, ast.Load, ast.operator, ast.unaryop)):
+            raise ValueError(f"Unsupported syntax in {expression!r}")
+    return tree.body
+
+def evaluate(node, variables):
+    """ evaluate a compiled expression over numpy columns, one numpy operation per node """
+    import numpy as np
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.Name):
+        return variables[node.id]
+    if isinstance(node, ast.UnaryOp):
+        operand = evaluate(node.operand, variables)
+        return -operand if isinstance(node.op, ast.USub) else operand
+    if isinstance(node, ast.BinOp):
+        return getattr(np, OPERATORS[type(node.op)])(evaluate(node.left, variables), evaluate(node.right, variables))
+    function = getattr(np, FUNCTIONS[node.func.id])
+    arguments = [evaluate(argument, variables) for argument in node.args]
+    return function(*arguments) if node.func.id == 'abs' else function.reduce(np.broadcast_arrays(*arguments))
+
+class Metric:
+    """ one spec entry: which charts it reads and how their dimensions reduce to a value """
+
+    def __init__(self, name, chart, dimensions=None, expression=None, unit='', description=''):
+        if not name or not re.fullmatch(r'[\w.]+', name):
+            raise ValueError(f"Invalid metric name {name!r}")
+        if not chart or chart.count('*') > 1:
+            raise ValueError(f"Metric {name} needs a chart with at most one '*'")
+        self.name = name
+        self.chart = chart
+        self.prefix, _, self.suffix = chart.partition('*')
+        self.wildcard = '*' in chart
+        self.dimensions = list(dimensions) if dimensions and dimensions != '*' else None
+        self.identifiers = [identifier(dimension) for dimension in self.dimensions or []]
+        self.expression = expression
+        self.unit = unit
+        self.description = description
+        self.tree = compile_expression(expression, set(self.identifiers) | {'total'}) if expression else None
+
+    def match(self, chart):
+        """ the instance a chart is for ('' without a wildcard), None when this metric does not read it """
+        if not self.wildcard:
+            return '' if chart == self.chart else None
+        if (len(chart) > len(self.prefix) + len(self.suffix) and chart.startswith(self.prefix)
+                and chart.endswith(self.suffix)):
+            return chart[len(self.prefix):len(chart) - len(self.suffix)]
+        return None
+
+    def series(self, instance):
+        return f"{self.name}:{instance}" if self.wildcard else self.name
+
+    def derive(self, charts):
+        """ the metric of every chart in charts (a list of {dimension: value}) as one float array, NaN when undefined """
+        import numpy as np
+        with np.errstate(all='ignore'):
+            if self.dimensions is None:
+                total = np.fromiter((sum(values.values()) if values else math.nan for values in charts),
+                                    dtype=float, count=len(charts))
+                variables = {'total': total}
+            else:
+                columns = np.array([[values.get(dimension, math.nan) for dimension in self.dimensions]
+                                    for values in charts], dtype=float).reshape(len(charts), len(self.dimensions))
+                variables = dict(zip(self.identifiers, columns.T))
+                # a chart missing every listed dimension has no total, rather than a total of 0
+                present = ~np.isnan(columns)
+                variables['total'] = np.where(present.any(axis=1), np.nansum(columns, axis=1), math.nan)
+            if self.tree is None:
+                return variables['total']
+            return np.broadcast_to(np.asarray(evaluate(self.tree, variables), dtype=float), (len(charts),))
+
+    def describe(self):
+        return {'name': self.name, 'chart': self.chart, 'unit': self.unit, 'description': self.description}
+
+def parse_spec(entries):
+    """ Metric objects from a list of spec dicts, raising ValueError on an invalid or duplicate entry """
+    metrics = []
+    names = set()
+    for entry in entries:
+        unknown = set(entry) - {'name', 'chart', 'dimensions', 'expression', 'unit', 'description'}
+        if unknown:
+            raise ValueError(f"Unknown keys in metric spec entry: {', '.join(sorted(unknown))}")
+        metric = Metric(**entry)
+        if metric.name in names:
+            raise ValueError(f"Metric {metric.name} is defined twice")
+        names.add(metric.name)
+        metrics.append(metric)
+    return metrics
+
+_spec_cache = {}
+
+def get_spec(config):
+    """ the metrics of METRIC_SPEC_PATH, read once per path, an empty spec when it is not set """
+    path = config.get('METRIC_SPEC_PATH')
+    if not path:
+        return []
+    if path not in _spec_cache:
+        with open(path) as f:
+            _spec_cache[path] = parse_spec(json.load(f))
+        logger.info(f"Loaded {len(_spec_cache[path])} subscribed metrics from {path}")
+    return _spec_cache[path]
+
+def chart_filters(spec):
+    """ allmetrics filter patterns fetching every chart the spec reads """
+    return tuple(dict.fromkeys(metric.chart for metric in spec))
+
+def subscribed_charts(spec, charts):
+    """ the charts of an allmetrics answer ({chart: {dimension: value}}) some metric of the spec reads """
+    return {chart: values for chart, values in charts.items() if any(metric.match(chart) is not None for metric in spec)}
+
+def derive_samples(spec, charts_by_server, timestamp):
+    """
+    * metric_samples rows for one cycle: charts_by_server is {server: {chart: {dimension: value}}}
+    * each metric is evaluated over the matching charts of every server in one vectorized pass,
+      undefined values (missing dimensions, division by zero) are left out
+    """
+    chart_names = {chart for charts in charts_by_server.values() if charts for chart in charts}
+    samples = []
+    for metric in spec:
+        instances = {chart: metric.match(chart) for chart in chart_names}
+        keys, charts = [], []
+        for server, server_charts in charts_by_server.items():
+            for chart, values in (server_charts or {}).items():
+                if instances[chart] is not None:
+                    keys.append((server, metric.series(instances[chart])))
+                    charts.append(values)
+        if not charts:
+            continue
+        for (server, series), value in zip(keys, metric.derive(charts).tolist()):
+            if math.isfinite(value):
+                samples.append({'machine_name': server, 'series': series, 'timestamp': timestamp, 'value': value})
+    return samples
@@ -1,12 +1,41 @@
 """
 Database models for the application.
 """
+import sqlite3
 from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import declared_attr
 from sqlalchemy.sql import func
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    * WAL journaling lets dashboard reads go on while the ingest writer commits
+    * Writers wait up to 5s for the lock instead of failing with "database is locked"
+    * Read-only connections (see storage.sql.read_engine) cannot switch the journal mode, they use the WAL
+      mode the writer already stored in the database file
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('PRAGMA journal_mode=WAL')
+    except sqlite3.OperationalError as e:
+        if 'readonly' not in str(e):
+            raise
+    # safe with WAL: a power loss can only drop the last commits, never corrupt the database
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+# metric columns of MetricLogs, also aggregated by the rollup tables
+METRIC_COLUMNS = ("cpu_usage", "memory_usage", "disk_usage", "network_received", "network_sent")
+
 class User(db.Model, UserMixin):
     """User model for authentication and role management."""
     id = db.Column(db.Integer, primary_key=True)
@@ -14,8 +43,34 @@ class User(db.Model, UserMixin):
     email = db.Column(db.String(150), unique=True, nullable=False)
     type = db.Column(db.String(50), nullable=False, default='User')  # 'Admin' or 'User'
 
+class Server(db.Model):
+    """Netdata host metrics are collected from, managed through Flask-Admin."""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(45), unique=True, nullable=False)
+    host = db.Column(db.String(255), nullable=False)
+    enabled = db.Column(db.Boolean, nullable=False, default=True)
+    # seconds between collections of this server, COLLECTION_INTERVAL_SECONDS when empty
+    interval_seconds = db.Column(db.Integer, nullable=True)
+
+    def __repr__(self):
+        return self.name
+
+class SchedulerLease(db.Model):
+    """Time limited lease held by the one process allowed to run a scheduled job."""
+    name = db.Column(db.String(100), primary_key=True)
+    owner = db.Column(db.String(255), nullable=False)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
 class MetricLogs(db.Model):
     """Model to store metrics logged from machines via Netdata API."""
+    __table_args__ = (
+        # serves the per server time range scans of the historical and latest metric queries, and keeps one
+        # row per sample: a late point of a chart is merged into its sample's row (see SQLStorage.write)
+        db.Index('ix_metric_logs_machine_name_timestamp', 'machine_name', 'timestamp', unique=True),
+        # rollup compaction and retention pruning scan every machine by time
+        db.Index('ix_metric_logs_timestamp', 'timestamp'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
     machine_name = db.Column(db.String(45), nullable=False)
@@ -24,3 +79,66 @@ class MetricLogs(db.Model):
     disk_usage = db.Column(db.Float, nullable=True)
     network_received = db.Column(db.Float, nullable=True)
     network_sent = db.Column(db.Float, nullable=True)
+
+class MetricSample(db.Model):
+    """One value of a subscribed metric series (see app.metric_spec), stored narrow so series need no columns."""
+    __tablename__ = 'metric_samples'
+    __table_args__ = (
+        db.Index('ix_metric_samples_machine_name_series_timestamp', 'machine_name', 'series', 'timestamp'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime(timezone=True), nullable=False)
+    machine_name = db.Column(db.String(45), nullable=False)
+    series = db.Column(db.String(255), nullable=False)
+    value = db.Column(db.Float, nullable=False)
+
+class MetricRollup(db.Model):
+    """Aggregated metrics of one machine over a fixed time bucket, compacted from finer data."""
+    __abstract__ = True
+
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            db.UniqueConstraint('machine_name', 'bucket_start', name=f'uq_{cls.__tablename__}_machine_name_bucket_start'),
+            # compaction and pruning scan every machine by time
+            db.Index(f'ix_{cls.__tablename__}_bucket_start', 'bucket_start'),
+        )
+
+    id = db.Column(db.Integer, primary_key=True)
+    machine_name = db.Column(db.String(45), nullable=False)
+    bucket_start = db.Column(db.DateTime(timezone=True), nullable=False)
+    sample_count = db.Column(db.Integer, nullable=False, default=0)
+    cpu_usage_min = db.Column(db.Float, nullable=True)
+    cpu_usage_avg = db.Column(db.Float, nullable=True)
+    cpu_usage_max = db.Column(db.Float, nullable=True)
+    memory_usage_min = db.Column(db.Float, nullable=True)
+    memory_usage_avg = db.Column(db.Float, nullable=True)
+    memory_usage_max = db.Column(db.Float, nullable=True)
+    disk_usage_min = db.Column(db.Float, nullable=True)
+    disk_usage_avg = db.Column(db.Float, nullable=True)
+    disk_usage_max = db.Column(db.Float, nullable=True)
+    network_received_min = db.Column(db.Float, nullable=True)
+    network_received_avg = db.Column(db.Float, nullable=True)
+    network_received_max = db.Column(db.Float, nullable=True)
+    network_sent_min = db.Column(db.Float, nullable=True)
+    network_sent_avg = db.Column(db.Float, nullable=True)
+    network_sent_max = db.Column(db.Float, nullable=True)
+
+class MetricRollup1m(MetricRollup):
+    """One minute rollups, compacted from metric_logs."""
+    __tablename__ = 'metric_rollup_1m'
+
+class MetricRollup1h(MetricRollup):
+    """One hour rollups, compacted from the one minute rollups."""
+    __tablename__ = 'metric_rollup_1h'
+
+class MetricRollup1d(MetricRollup):
+    """One day rollups, compacted from the one hour rollups."""
+    __tablename__ = 'metric_rollup_1d'
+
+class RollupState(db.Model):
+    """Newest metric_logs id already compacted into the rollup tiers, rows above it are still to be compacted."""
+    __tablename__ = 'rollup_state'
+    name = db.Column(db.String(50), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False)
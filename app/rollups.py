@@ -0,0 +1,238 @@
+"""
+Rollup tiers for long range queries.
+
+* Compact raw metric_logs rows into 1 minute, 1 hour and 1 day min/avg/max/count tables,
+  each tier built from the one below it
+* Raw rows are compacted by id: rollup_state holds the newest compacted id, and every row above it is merged
+  into the one minute tier, also rows written behind its newest bucket (high resolution backfill, journal replay)
+* A late high resolution point filling in a stored sample moves that row to a new id, so in high resolution
+  mode the recent one minute buckets are recomputed from the raw rows instead of merged twice
+* Prune every tier (and the raw table) past its configured retention
+* Pick the coarsest tier that still answers a historical query at the requested resolution
+"""
+import logging
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from sqlalchemy import text
+from .models import METRIC_COLUMNS, MetricRollup1m, MetricRollup1h, MetricRollup1d, RollupState, db
+
+logger = logging.getLogger(__name__)
+
+# seconds: bucket size, source: table the tier is compacted from, retention_key: config key in days
+RollupTier = namedtuple('RollupTier', ['name', 'seconds', 'table', 'source', 'retention_key'])
+
+# finest to coarsest
+TIERS = (
+    RollupTier('1m', 60, MetricRollup1m.__tablename__, 'metric_logs', 'ROLLUP_1M_RETENTION_DAYS'),
+    RollupTier('1h', 3600, MetricRollup1h.__tablename__, MetricRollup1m.__tablename__, 'ROLLUP_1H_RETENTION_DAYS'),
+    RollupTier('1d', 86400, MetricRollup1d.__tablename__, MetricRollup1h.__tablename__, 'ROLLUP_1D_RETENTION_DAYS'),
+)
+
+RAW_RETENTION_KEY = 'RAW_RETENTION_DAYS'
+
+# retention in days used when the app config does not set one, 0 keeps data forever
+DEFAULT_RETENTION_DAYS = {
+    RAW_RETENTION_KEY: 30,
+    'ROLLUP_1M_RETENTION_DAYS': 90,
+    'ROLLUP_1H_RETENTION_DAYS': 730,
+    'ROLLUP_1D_RETENTION_DAYS': 0,
+}
+
+SQL_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# rollup_state row of the raw table
+RAW_STATE = 'metric_logs'
+
+def utc_now():
+    """ naive UTC now, the same clock metric_logs timestamps use """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def retention(key):
+    """ retention of a tier as a timedelta, or None when it is kept forever """
+    days = current_app.config.get(key, DEFAULT_RETENTION_DAYS[key])
+    return timedelta(days=days) if days else None
+
+def bucket_expression(column, seconds):
+    """ SQL for the UTC start of the `seconds` long bucket a timestamp column falls in """
+    return f"datetime(CAST(strftime('%s', {column}) AS INTEGER) / {int(seconds)} * {int(seconds)}, 'unixepoch')"
+
+def aggregate_columns(from_raw):
+    """ the min/avg/max select list for every metric, from raw rows or from a finer tier """
+    columns = []
+    for metric in METRIC_COLUMNS:
+        if from_raw:
+            columns += [f'MIN({metric})', f'AVG({metric})', f'MAX({metric})']
+        else:
+            # averages of the finer buckets are weighted by how many samples each one holds
+            columns += [f'MIN({metric}_min)',
+                        f'SUM({metric}_avg * sample_count) / SUM(CASE WHEN {metric}_avg IS NOT NULL THEN sample_count END)',
+                        f'MAX({metric}_max)']
+    return columns
+
+def last_bucket_start(conn, table):
+    """ start of the newest bucket of a tier, as stored, or None when the tier is empty """
+    return conn.execute(text(f'SELECT MAX(bucket_start) FROM {table}')).scalar()
+
+def compact_tier(conn, tier, since=None):
+    """
+    * Aggregate the tier's source rows into buckets, from its newest bucket onwards
+    * The newest bucket is recomputed every run, so the still open bucket stays current
+    * since (a datetime) recomputes every bucket from there on, for rows written behind the newest bucket
+    * Returns the number of buckets written
+    """
+    from_raw = tier.source == 'metric_logs'
+    time_column = 'timestamp' if from_raw else 'bucket_start'
+    count = 'COUNT(*)' if from_raw else 'SUM(sample_count)'
+    start = last_bucket_start(conn, tier.table) or '0000-01-01 00:00:00'
+    if since is not None:
+        # from the start of the bucket since falls in
+        seconds = int((since - datetime(1970, 1, 1)).total_seconds()) // tier.seconds * tier.seconds
+        start = min(str(start), (datetime(1970, 1, 1) + timedelta(seconds=seconds)).strftime(SQL_TIME_FORMAT))
+
+    metric_columns = [f'{metric}_{aggregate}' for metric in METRIC_COLUMNS for aggregate in ('min', 'avg', 'max')]
+    updates = ', '.join(f'{column} = excluded.{column}' for column in ['sample_count'] + metric_columns)
+    result = conn.execute(text(f'''
+        INSERT INTO {tier.table} (machine_name, bucket_start, sample_count, {', '.join(metric_columns)})
+        SELECT machine_name, {bucket_expression(time_column, tier.seconds)}, {count}, {', '.join(aggregate_columns(from_raw))}
+        FROM {tier.source}
+        WHERE {time_column} >= :start
+        GROUP BY 1, 2
+        ON CONFLICT (machine_name, bucket_start) DO UPDATE SET {updates}
+    '''), {'start': str(start)})
+    return result.rowcount
+
+def compacted_id(conn):
+    """ newest metric_logs id the tiers were compacted with, None before the first compaction """
+    return conn.execute(text(f'SELECT last_id FROM {RollupState.__tablename__} WHERE name = :name'),
+                        {'name': RAW_STATE}).scalar()
+
+def merge_raw_rows(conn, tier, last_id, newest_id):
+    """
+    * Aggregate the raw rows with ids in (last_id, newest_id] and merge them into the tier's buckets,
+      adding to the buckets they fall in however old those are
+    * Buckets are merged rather than recomputed, their older raw rows may already be pruned
+    * Returns (buckets written, oldest timestamp merged)
+    """
+    params = {'last_id': last_id, 'newest_id': newest_id}
+    oldest = conn.execute(text('SELECT MIN(timestamp) FROM metric_logs WHERE id > :last_id AND id <= :newest_id'),
+                          params).scalar()
+    if oldest is None:
+        return 0, None
+
+    metric_columns = [f'{metric}_{aggregate}' for metric in METRIC_COLUMNS for aggregate in ('min', 'avg', 'max')]
+    updates = ['sample_count = sample_count + excluded.sample_count']
+    for metric in METRIC_COLUMNS:
+        updates += [
+            f'{metric}_min = COALESCE(MIN({metric}_min, excluded.{metric}_min), {metric}_min, excluded.{metric}_min)',
+            f'{metric}_avg = CASE WHEN {metric}_avg IS NULL THEN excluded.{metric}_avg '
+            f'WHEN excluded.{metric}_avg IS NULL THEN {metric}_avg '
+            f'ELSE ({metric}_avg * sample_count + excluded.{metric}_avg * excluded.sample_count) '
+            f'/ (sample_count + excluded.sample_count) END',
+            f'{metric}_max = COALESCE(MAX({metric}_max, excluded.{metric}_max), {metric}_max, excluded.{metric}_max)',
+        ]
+    result = conn.execute(text(f'''
+        INSERT INTO {tier.table} (machine_name, bucket_start, sample_count, {', '.join(metric_columns)})
+        SELECT machine_name, {bucket_expression('timestamp', tier.seconds)}, COUNT(*), {', '.join(aggregate_columns(True))}
+        FROM metric_logs
+        WHERE id > :last_id AND id <= :newest_id
+        GROUP BY 1, 2
+        ON CONFLICT (machine_name, bucket_start) DO UPDATE SET {', '.join(updates)}
+    '''), params)
+    return result.rowcount, datetime.fromisoformat(str(oldest))
+
+def compact_rollups(since=None, recompute_from=None):
+    """
+    * bring every rollup tier up to date, finest first so each tier reads fresh source rows
+    * raw rows written since the last run are merged into the one minute tier by id, so rows written
+      behind its newest bucket are not missed; the coarser tiers are then recomputed from the oldest of them
+    * recompute_from (a datetime) recomputes the one minute buckets from there on from the raw rows, which
+      must all still be stored, for samples filled in after they were compacted
+    * the first run compacts from each tier's newest bucket (or since) and starts tracking ids from there
+    """
+    written = {}
+    with db.engine.begin() as conn:
+        last_id = compacted_id(conn)
+        newest_id = conn.execute(text('SELECT MAX(id) FROM metric_logs')).scalar()
+        tiers = TIERS
+        if last_id is not None:
+            written[TIERS[0].name], oldest = merge_raw_rows(conn, TIERS[0], last_id, newest_id or last_id)
+            if oldest is not None and (since is None or oldest < since):
+                since = oldest
+            if recompute_from is not None:
+                written[TIERS[0].name] += compact_tier(conn, TIERS[0], recompute_from)
+            tiers = TIERS[1:]
+        if recompute_from is not None and (since is None or recompute_from < since):
+            since = recompute_from
+        for tier in tiers:
+            written[tier.name] = compact_tier(conn, tier, since)
+        if newest_id is not None:
+            conn.execute(text(f'''
+                INSERT INTO {RollupState.__tablename__} (name, last_id) VALUES (:name, :last_id)
+                ON CONFLICT (name) DO UPDATE SET last_id = excluded.last_id
+            '''), {'name': RAW_STATE, 'last_id': newest_id})
+    logger.info("Compacted rollups: " + ", ".join(f"{name} {count} buckets" for name, count in written.items()))
+    return written
+
+def prune_metrics(now=None):
+    """
+    * Delete raw rows, subscribed series samples and rollup buckets older than their retention
+    * Rows are only deleted once the next tier has compacted past them, and raw rows once compacted at all
+    * Returns the number of rows deleted per table
+    """
+    now = now or utc_now()
+    levels = [('metric_logs', 'timestamp', RAW_RETENTION_KEY)] + \
+             [(tier.table, 'bucket_start', tier.retention_key) for tier in TIERS]
+    deleted = {}
+    with db.engine.begin() as conn:
+        last_id = compacted_id(conn)
+        for i, (table, time_column, retention_key) in enumerate(levels):
+            keep = retention(retention_key)
+            if keep is None:
+                continue
+            cutoff = (now - keep).strftime(SQL_TIME_FORMAT)
+
+            # never drop rows the next tier has not compacted yet
+            if i + 1 < len(levels):
+                compacted_until = last_bucket_start(conn, levels[i + 1][0])
+                if compacted_until is None:
+                    continue
+                cutoff = min(cutoff, str(compacted_until))
+
+            if table == 'metric_logs':
+                # rows written behind the tiers since the last compaction are not in them yet
+                result = conn.execute(text('DELETE FROM metric_logs WHERE timestamp < :cutoff AND id <= :last_id'),
+                                      {'cutoff': cutoff, 'last_id': last_id or 0})
+            else:
+                result = conn.execute(text(f'DELETE FROM {table} WHERE {time_column} < :cutoff'), {'cutoff': cutoff})
+            deleted[table] = result.rowcount
+
+        # subscribed series have no rollups, they are kept as long as raw rows
+        keep = retention(RAW_RETENTION_KEY)
+        if keep is not None:
+            result = conn.execute(text('DELETE FROM metric_samples WHERE timestamp < :cutoff'),
+                                  {'cutoff': (now - keep).strftime(SQL_TIME_FORMAT)})
+            deleted['metric_samples'] = result.rowcount
+    logger.info("Pruned metrics: " + ", ".join(f"{table} {count} rows" for table, count in deleted.items()))
+    return deleted
+
+def choose_tier(start_time, resolution, now=None):
+    """
+    * Pick the rollup tier a historical query should read, or None for the raw metric_logs table
+    * resolution is the coarsest bucket, in seconds, the caller can accept (0 for raw points)
+    * A tier only qualifies when its retention still covers start_time; when no tier is fine enough,
+      the finest one covering the range is used
+    """
+    now = now or utc_now()
+
+    def covers(retention_key):
+        keep = retention(retention_key)
+        return keep is None or start_time >= now - keep
+
+    levels = [(None, 0, RAW_RETENTION_KEY)] + [(tier, tier.seconds, tier.retention_key) for tier in TIERS]
+    covering = [(tier, seconds) for tier, seconds, retention_key in levels if covers(retention_key)]
+    if not covering:
+        return TIERS[-1]
+
+    chosen = [tier for tier, seconds in covering if seconds <= resolution]
+    return chosen[-1] if chosen else covering[0][0]
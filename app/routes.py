@@ -1,16 +1,28 @@
 """
 Main application routes.
 """
+import logging
+import time
 from datetime import datetime
-from flask import Blueprint, render_template, request, flash, jsonify
+from flask import Blueprint, Response, current_app, g, render_template, request, flash, jsonify, stream_with_context
 from flask_login import login_required
 from .models import User, db
-from .metric_collector import latest_metrics, historical_metrics
+from .metric_collector import (batch_historical_metrics, cached_latest_metrics, historical_metrics,
+                               iter_historical_metrics, series_columns, series_metrics, series_rows, subscribed_series)
+from .archive import FORMATS, iter_export_tar, require_pyarrow
+from .forecasting import cached_forecast
+from .rollups import choose_tier
+from .serializers import JSON, NDJSON, encode, negotiate
+from .storage import QueryTimeout
 from .admin import is_admin
+from .streaming import format_sse, iter_events, live_stream_enabled
+from .instrumentation import CONTENT_TYPE, REQUEST_SECONDS, latest_profile, render, request_profile
 
 main_bp = Blueprint('main', __name__)
 api = Blueprint('api', __name__)
 
+logger = logging.getLogger(__name__)
+
 @main_bp.route('/')
 def index():
     """Render the login page."""
@@ -20,7 +32,8 @@ def index():
 @login_required
 def dashboard():
     """Render the dashboard page."""
-    return render_template('dashboard.html')
+    return render_template('dashboard.html', live_stream=live_stream_enabled(current_app.config),
+                           poll_seconds=current_app.config.get('DASHBOARD_POLL_SECONDS', 15))
 
 @main_bp.route('/historical_data')
 @login_required
@@ -61,30 +74,184 @@ def historical_data():
     """ get custom query and return jsonifyed data """
     try:
         data = request.json
-        print(f"Received historical data request: {data}")  # Debug print
+        logger.debug(f"Historical data request: {data}")
 
         metric = data['metric']
         server = data['server']
         start = datetime.fromisoformat(data['start_time'])
         end = datetime.fromisoformat(data['end_time'])
 
-        results = historical_metrics(metric, server, start, end)
+        # optional downsampling, bounding the points returned for long ranges
+        max_points = int(data['max_points']) if data.get('max_points') else None
+        bucket = int(data['bucket']) if data.get('bucket') else None
+        method = data.get('downsample', 'avg')
+
+        mimetype = negotiate(request.accept_mimetypes)
+        if max_points is None and bucket is None and choose_tier(start, 0) is None:
+            # raw rows, streamed straight off the cursor so big ranges never sit in memory
+            chunks = iter_historical_metrics(metric, server, start, end, epoch=mimetype != JSON)
+        else:
+            results = historical_metrics(metric, server, start, end, max_points=max_points, bucket=bucket, method=method)
+
+            if mimetype == JSON:
+                return jsonify(results)
+            chunks = [series_rows(metric, results)]
 
-        print(f"Results type: {type(results)}")
-        print(f"Results keys: {results.keys() if isinstance(results, dict) else 'not a dict'}")
+        body = encode(mimetype, series_columns(metric, per_row=mimetype == NDJSON), chunks)
+        return Response(stream_with_context(body), mimetype=mimetype)
+    except QueryTimeout as e:
+        return jsonify({'error': str(e)}), 504
+    except Exception as e:
+        logger.exception(f"Error in historical_data route: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
+@api.route('/api/historical_data/batch', methods=['POST'])
+@login_required
+def historical_data_batch():
+    """ get several servers and metrics over one time range in a single query, returned as {server: {metric: series}} """
+    try:
+        data = request.json
+
+        selectors = data['selectors']
+        start = datetime.fromisoformat(data['start_time'])
+        end = datetime.fromisoformat(data['end_time'])
+        max_points = int(data['max_points']) if data.get('max_points') else None
+        bucket = int(data['bucket']) if data.get('bucket') else None
+        method = data.get('downsample', 'avg')
+
+        results = batch_historical_metrics(selectors, start, end, max_points=max_points, bucket=bucket, method=method)
         return jsonify(results)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    except QueryTimeout as e:
+        return jsonify({'error': str(e)}), 504
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/api/series', methods=['GET'])
+@login_required
+def series_catalog():
+    """ list the subscribed series stored for ?server= """
+    server = request.args.get('server')
+    if not server:
+        return jsonify({'error': 'server is required'}), 400
+    return jsonify({'server': server, 'series': subscribed_series(server)})
+
+@api.route('/api/series_data', methods=['POST'])
+@login_required
+def series_data():
+    """ get the points of one subscribed series over a time range, optionally bounded by max_points """
+    try:
+        data = request.json
+        start = datetime.fromisoformat(data['start_time'])
+        end = datetime.fromisoformat(data['end_time'])
+        max_points = int(data['max_points']) if data.get('max_points') else None
+        return jsonify(series_metrics(data['server'], data['series'], start, end, max_points=max_points))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    except QueryTimeout as e:
+        return jsonify({'error': str(e)}), 504
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/api/forecast', methods=['GET'])
+@login_required
+def capacity_forecast():
+    """ rank every server by when ?metric= (disk or memory) is projected to reach ?threshold= (percent) """
+    try:
+        threshold = float(request.args['threshold']) if request.args.get('threshold') else None
+        return jsonify(cached_forecast(request.args.get('metric', 'disk'), current_app.config, threshold))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        import traceback
-        print(f"Error in historical_data route: {str(e)}")
-        print(traceback.format_exc())  # Print full traceback
         return jsonify({'error': str(e)}), 500
 
+@api.route('/api/admin/export', methods=['GET'])
+@login_required
+@is_admin
+def export_archive():
+    """ stream stored samples as a tar of Parquet (?format=parquet) or gzip CSV files per server and day """
+    try:
+        fmt = request.args.get('format', 'parquet')
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown archive format {fmt}, expected one of {', '.join(FORMATS)}")
+        if fmt == 'parquet':
+            require_pyarrow()
+        servers = request.args.getlist('server') or None
+        start = datetime.fromisoformat(request.args['start_time']) if request.args.get('start_time') else None
+        end = datetime.fromisoformat(request.args['end_time']) if request.args.get('end_time') else None
+    except (RuntimeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    filename = f"metrics-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{fmt}.tar"
+    return Response(stream_with_context(iter_export_tar(fmt, servers, start, end)), mimetype='application/x-tar',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 @api.route('/api/current_metrics', methods=['GET'])
 def current_metrics():
-    """ get the latest metrics for each server and return as json """
+    """ get the latest metrics for each server and return as json, or 304 when the client's copy is current """
     try:
-        current = latest_metrics()
-        return jsonify(current)
+        current, etag = cached_latest_metrics()
+        response = jsonify(current)
+        response.set_etag(etag)
+        # let browsers keep the body but revalidate it on every poll
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+    except QueryTimeout as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+
+
+@api.route('/api/stream', methods=['GET'])
+def metrics_stream():
+    """ push each server's new metrics as Server-Sent Events, resuming after Last-Event-ID """
+    if not live_stream_enabled(current_app.config):
+        # a threaded worker would hold one thread per client
+        return jsonify({'error': 'Live stream is disabled, poll /api/current_metrics'}), 503
+    snapshot, _ = cached_latest_metrics()
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    events = (format_sse(*event) for event in iter_events(snapshot, last_event_id))
+    return Response(events, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # stop reverse proxies from buffering the stream
+        'X-Accel-Buffering': 'no'
+    })
+
+
+@api.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@api.after_request
+def record_request_latency(response):
+    """ observe API latency up to the response starting, streamed bodies are not waited for """
+    started = g.pop('request_started', None)
+    if started is not None and request.endpoint not in ('api.prometheus_metrics', 'api.cycle_profile'):
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=request.endpoint or 'unknown',
+                                method=request.method, status=response.status_code)
+    return response
+
+def metrics_authorized():
+    """ open when METRICS_TOKEN is unset, otherwise the scraper must send it as a bearer token """
+    token = current_app.config.get('METRICS_TOKEN')
+    return not token or request.headers.get('Authorization') == f'Bearer {token}'
+
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """ this process's collector and API metrics in the Prometheus text format """
+    if not metrics_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(render(), content_type=CONTENT_TYPE)
+
+@api.route('/metrics/profile', methods=['GET', 'POST'])
+@login_required
+@is_admin
+def cycle_profile():
+    """ POST profiles the next collection cycle, GET returns the newest cycle profile as text, admins only """
+    if request.method == 'POST':
+        request_profile(current_app)
+        return jsonify({'requested': True}), 202
+    profile = latest_profile(current_app)
+    if profile is None:
+        return jsonify({'error': 'No cycle has been profiled yet'}), 404
+    return Response(profile, mimetype='text/plain')
@@ -0,0 +1,126 @@
+"""
+Response formats for historical metric series.
+
+* Every encoder takes the column names of a series and an iterator of row chunks, and yields the
+  encoded response piece by piece, so a large range is never held in memory as a whole
+* The format is picked from the request's Accept header:
+    application/json                          {"timestamps": [...], "values": [...]}, as before
+    application/vnd.resourceradar.columnar+json   the same columns with epoch second timestamps
+    application/x-ndjson                      one JSON object per row
+    application/vnd.apache.arrow.stream       Arrow IPC stream, one record batch per chunk (needs pyarrow)
+    application/x-msgpack                     a stream of msgpack maps, one columnar map per chunk (needs msgpack)
+"""
+import io
+import json
+import tempfile
+
+JSON = 'application/json'
+COLUMNAR = 'application/vnd.resourceradar.columnar+json'
+NDJSON = 'application/x-ndjson'
+ARROW = 'application/vnd.apache.arrow.stream'
+MSGPACK = 'application/x-msgpack'
+
+# bytes a spooled column may hold in memory before it moves to a temporary file
+SPOOL_MAX_SIZE = 1024 * 1024
+
+def available_formats():
+    """ mimetypes that can be served here, optional ones only when their package is installed """
+    formats = [JSON, COLUMNAR, NDJSON]
+    try:
+        import pyarrow  # noqa: F401
+        formats.append(ARROW)
+    except ImportError:
+        pass
+    try:
+        import msgpack  # noqa: F401
+        formats.append(MSGPACK)
+    except ImportError:
+        pass
+    return formats
+
+def negotiate(accept_mimetypes):
+    """ best format for a request's Accept header, JSON when nothing else matches """
+    return accept_mimetypes.best_match(available_formats(), default=JSON) or JSON
+
+def encode_columnar_json(columns, chunks):
+    """
+    * {"column": [...], ...} written incrementally
+    * The first column streams straight out, the others are spooled (to disk past SPOOL_MAX_SIZE)
+      and appended once the cursor is exhausted
+    """
+    spools = [tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+') for _ in columns[1:]]
+    try:
+        yield '{' + json.dumps(columns[0]) + ': ['
+        first = True
+        for chunk in chunks:
+            if not chunk:
+                continue
+            separator = '' if first else ', '
+            first = False
+            yield separator + ', '.join(json.dumps(row[0]) for row in chunk)
+            for i, spool in enumerate(spools, start=1):
+                spool.write(separator + ', '.join(json.dumps(row[i]) for row in chunk))
+
+        for column, spool in zip(columns[1:], spools):
+            yield '], ' + json.dumps(column) + ': ['
+            spool.seek(0)
+            while True:
+                block = spool.read(64 * 1024)
+                if not block:
+                    break
+                yield block
+        yield ']}'
+    finally:
+        for spool in spools:
+            spool.close()
+
+def encode_ndjson(columns, chunks):
+    """ one {"column": value, ...} line per row """
+    for chunk in chunks:
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in chunk)
+
+def encode_arrow(columns, chunks):
+    """ Arrow IPC stream with one record batch per chunk """
+    import pyarrow as pa
+
+    types = [pa.int64()] + [pa.float64()] * (len(columns) - 1)
+    schema = pa.schema(list(zip(columns, types)))
+    buffer = io.BytesIO()
+    writer = pa.ipc.new_stream(buffer, schema)
+
+    def drain():
+        # hand out what the writer produced so far and start the buffer over
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    yield drain()
+    for chunk in chunks:
+        if not chunk:
+            continue
+        arrays = [pa.array([row[i] for row in chunk], type=types[i]) for i in range(len(columns))]
+        writer.write_batch(pa.record_batch(arrays, schema=schema))
+        yield drain()
+    writer.close()
+    yield drain()
+
+def encode_msgpack(columns, chunks):
+    """ a stream of {"column": [...], ...} msgpack maps, one per chunk, read back with msgpack.Unpacker """
+    import msgpack
+
+    for chunk in chunks:
+        if chunk:
+            yield msgpack.packb({column: [row[i] for row in chunk] for i, column in enumerate(columns)})
+
+ENCODERS = {
+    JSON: encode_columnar_json,
+    COLUMNAR: encode_columnar_json,
+    NDJSON: encode_ndjson,
+    ARROW: encode_arrow,
+    MSGPACK: encode_msgpack,
+}
+
+def encode(mimetype, columns, chunks):
+    """ encoded response body for a series, as a generator of str or bytes pieces """
+    return ENCODERS[mimetype](columns, chunks)
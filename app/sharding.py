@@ -0,0 +1,35 @@
+"""
+Consistent hashing of servers across collector processes.
+
+* Each of COLLECTOR_SHARD_COUNT collectors owns the servers hashed to it on a ring of virtual nodes
+* Changing the shard count only moves about 1/N of the servers to a different collector
+"""
+import bisect
+import hashlib
+
+# points per shard on the ring, more points spread the servers more evenly
+VIRTUAL_NODES = 100
+
+def ring_hash(key):
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+class HashRing:
+    """ consistent hash ring of shard indexes 0..shard_count-1 """
+
+    def __init__(self, shard_count, virtual_nodes=VIRTUAL_NODES):
+        points = sorted((ring_hash(f"shard-{shard}-{node}"), shard)
+                        for shard in range(shard_count) for node in range(virtual_nodes))
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard_for(self, key):
+        """ shard owning a key: the first ring point at or after the key's hash """
+        index = bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+        return self.shards[index]
+
+def shard_servers(server_list, shard_index, shard_count):
+    """ the servers this collector shard is responsible for """
+    if shard_count <= 1:
+        return list(server_list)
+    ring = HashRing(shard_count)
+    return [server for server in server_list if ring.shard_for(server['name']) == shard_index]
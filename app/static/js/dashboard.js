@@ -14,8 +14,20 @@ document.addEventListener('DOMContentLoaded', function() {
     // Show loading message
     chartsContainer.innerHTML = '<div class="loading">Loading metrics data...</div>';
     
+    // Latest metrics per server, kept current by the live stream or by polling
+    let currentData = {};
+    // ETag of the last snapshot drawn, an unchanged poll is not redrawn
+    let currentEtag = null;
+
     // Fetch current metrics data
     fetchMetrics();
+    if (chartsContainer.dataset.liveStream === 'true' && window.EventSource) {
+        subscribeToMetrics();
+    } else {
+        // the browser revalidates with If-None-Match, the server answers 304 while nothing changed
+        const pollSeconds = parseInt(chartsContainer.dataset.pollSeconds, 10) || 15;
+        setInterval(fetchMetrics, pollSeconds * 1000);
+    }
     
     // Function to fetch metrics data
     function fetchMetrics() {
@@ -31,9 +43,17 @@ document.addEventListener('DOMContentLoaded', function() {
                     });
                 }
                 
+                const etag = response.headers.get('ETag');
+                if (etag && etag === currentEtag) {
+                    return null;
+                }
+                currentEtag = etag;
                 return response.json();
             })
             .then(data => {
+                if (data === null) {
+                    return;
+                }
                 console.log("Metrics data received:", data);
                 
                 // Hide any previous error
@@ -47,10 +67,13 @@ document.addEventListener('DOMContentLoaded', function() {
                 }
                 
                 // Create charts with the data
-                createDashboard(data);
+                currentData = data;
+                createDashboard(currentData);
             })
             .catch(error => {
                 console.error("Error fetching metrics:", error);
+                // redraw with the next successful poll
+                currentEtag = null;
                 
                 // Show error message
                 if (errorContainer) {
@@ -67,6 +90,33 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
     
+    // Function to receive new metrics as they are collected
+    function subscribeToMetrics() {
+        if (!window.EventSource) {
+            return;
+        }
+
+        // the browser reconnects on its own, resuming after the last event it received
+        const source = new EventSource('/api/stream');
+
+        source.addEventListener('snapshot', event => {
+            const data = JSON.parse(event.data);
+            if (Object.keys(data).length > 0) {
+                currentData = data;
+                createDashboard(currentData);
+            }
+        });
+
+        source.addEventListener('delta', event => {
+            // only the values that changed are sent
+            const delta = JSON.parse(event.data);
+            Object.keys(delta).forEach(serverName => {
+                currentData[serverName] = Object.assign({}, currentData[serverName], delta[serverName]);
+            });
+            createDashboard(currentData);
+        });
+    }
+
     // Function to create the dashboard
     function createDashboard(data) {
         // Clear the container
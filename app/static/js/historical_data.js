@@ -54,7 +54,9 @@ document.addEventListener('DOMContentLoaded', function() {
                 metric: metricType,
                 server: serverId,
                 start_time: startTime,
-                end_time: endTime
+                end_time: endTime,
+                // keep the chart responsive for long ranges, the server averages points into buckets
+                max_points: 1000
             })
         })
         .then(response => {
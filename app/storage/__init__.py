@@ -0,0 +1,36 @@
+"""
+Pluggable storage of metric samples.
+
+* STORAGE_BACKEND picks where samples are written and read:
+    sql   the metric_logs table and rollup tiers of the app database (default)
+    tsdb  compressed per server columnar chunks under TSDB_PATH (instance/tsdb by default)
+* Users, servers and leases always stay in the app database
+* The tsdb backend (and numpy with it) is only imported once it is configured
+"""
+import os
+import threading
+from flask import current_app
+from .base import StorageBackend
+from .sql import QueryTimeout, SQLStorage
+
+BACKENDS = ('sql', 'tsdb')
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_storage(app=None):
+    """ the configured storage backend, one instance per backend and path for the whole process """
+    app = app or current_app
+    name = app.config.get('STORAGE_BACKEND', 'sql')
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown storage backend: {name}")
+
+    with _backends_lock:
+        if name == 'sql':
+            return _backends.setdefault('sql', SQLStorage())
+        path = app.config.get('TSDB_PATH') or os.path.join(app.instance_path, 'tsdb')
+        key = (name, os.path.abspath(path))
+        if key not in _backends:
+            from .tsdb import TSDBStorage
+            _backends[key] = TSDBStorage(path, chunk_points=app.config.get('TSDB_CHUNK_POINTS', 1024))
+        return _backends[key]
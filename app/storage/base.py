@@ -0,0 +1,54 @@
+"""
+Interface every metric storage backend implements.
+
+* Rows going in are metric_logs style dicts: machine_name, timestamp (naive UTC datetime) and the METRIC_COLUMNS values
+* Subscribed series (app.metric_spec) are narrow samples: machine_name, series, timestamp and value
+* Timestamps coming out are strings as SQLite stores them ('YYYY-MM-DD HH:MM:SS.ffffff', UTC), values are
+  floats or None; raw reads are columnar ({'timestamp': [...], column: [...]}), bucketed reads are rows with
+  {column}_min/_avg/_max per column
+"""
+
+class StorageBackend:
+    """ where metric samples are written to and read back from """
+
+    name = None
+
+    def write(self, rows):
+        """ store rows durably, raising when they could not be stored """
+        raise NotImplementedError
+
+    def latest(self):
+        """ newest row of every server, {machine_name: row} with every metric column """
+        raise NotImplementedError
+
+    def newest_timestamps(self, servers):
+        """ {server: naive UTC datetime} of the newest stored row, for the servers that have any """
+        raise NotImplementedError
+
+    def raw(self, servers, columns, start_time, end_time):
+        """ {server: {'timestamp': [...], column: [...]}} of every stored sample between start_time and end_time, oldest first """
+        raise NotImplementedError
+
+    def bucketed(self, servers, columns, start_time, end_time, bucket, tier=None):
+        """
+        * {server: [rows]} with the min/avg/max of every column per `bucket` seconds, oldest first
+        * tier is the rollup tier the SQL backend reads from, other backends may ignore it
+        """
+        raise NotImplementedError
+
+    def iter_raw(self, server, columns, start_time, end_time, epoch=True, chunk_size=5000):
+        """ raw rows of one server as lists of at most chunk_size (timestamp, values...) tuples,
+            epoch second timestamps when epoch is true """
+        raise NotImplementedError
+
+    def write_samples(self, samples):
+        """ store narrow samples of subscribed series, raising when they could not be stored """
+        raise NotImplementedError
+
+    def samples(self, server, series, start_time, end_time):
+        """ {'timestamp': [...], 'value': [...]} of one subscribed series between start_time and end_time, oldest first """
+        raise NotImplementedError
+
+    def series_names(self, server):
+        """ sorted names of the subscribed series stored for a server """
+        raise NotImplementedError
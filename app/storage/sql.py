@@ -0,0 +1,262 @@
+"""
+Metric storage in the metric_logs table (and the rollup tables) of the app database.
+
+* Subscribed series go to the narrow metric_samples table
+* Writes go through the Flask-SQLAlchemy session, reads through a separate pool of read-only connections
+  to the same SQLite file; with WAL journaling they run in parallel with each other and with the writer
+* Every read is interrupted after DB_STATEMENT_TIMEOUT_SECONDS, raising QueryTimeout
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+from flask import current_app
+from sqlalchemy import and_, case, create_engine, func, or_, select, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import OperationalError
+from ..models import METRIC_COLUMNS, MetricLogs, MetricSample, db
+from .base import StorageBackend
+
+# SQLite virtual machine instructions between two checks of the statement deadline
+PROGRESS_INSTRUCTIONS = 10000
+
+_read_engine_lock = threading.Lock()
+
+class QueryTimeout(Exception):
+    """ a read ran longer than DB_STATEMENT_TIMEOUT_SECONDS and was interrupted """
+
+def create_read_engine(engine, config):
+    """
+    * a pool of read-only connections to the SQLite file behind engine
+    * in-memory and non SQLite databases are read through engine itself
+    """
+    url = engine.url
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:') \
+            or url.database.startswith('file:'):
+        return engine
+    # open the file once through the writer, so it exists and is in WAL mode before a reader opens it
+    with engine.connect():
+        pass
+    options = config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+    path = quote(os.path.abspath(url.database))
+    return create_engine(f'sqlite:///file:{path}?mode=ro&uri=true',
+                         pool_size=config.get('DB_READ_POOL_SIZE', 8),
+                         max_overflow=options.get('max_overflow', 8),
+                         pool_timeout=options.get('pool_timeout', 30))
+
+def read_engine():
+    """ the app's read engine, created on first use """
+    app = current_app._get_current_object()
+    engine = app.extensions.get('read_engine')
+    if engine is None:
+        with _read_engine_lock:
+            engine = app.extensions.get('read_engine')
+            if engine is None:
+                engine = app.extensions['read_engine'] = create_read_engine(db.engine, app.config)
+    return engine
+
+@contextmanager
+def get_connection(timeout=None):
+    """
+    * a pooled read connection, returned to the pool however the block exits
+    * statements are interrupted once timeout seconds (DB_STATEMENT_TIMEOUT_SECONDS by default, 0 for
+      none) have passed, raising QueryTimeout
+    """
+    if timeout is None:
+        timeout = current_app.config.get('DB_STATEMENT_TIMEOUT_SECONDS', 30)
+    with read_engine().connect() as conn:
+        dbapi_connection = conn.connection.dbapi_connection
+        deadline = time.monotonic() + timeout
+        if timeout and hasattr(dbapi_connection, 'set_progress_handler'):
+            dbapi_connection.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_INSTRUCTIONS)
+        try:
+            yield conn
+        except OperationalError as e:
+            if 'interrupted' in str(e.orig):
+                raise QueryTimeout(f"Query cancelled after {timeout}s") from e
+            raise
+        finally:
+            if timeout and hasattr(dbapi_connection, 'set_progress_handler'):
+                dbapi_connection.set_progress_handler(None, 0)
+
+def aggregate_sql(columns: list, tier=None):
+    """ (table, time column, min/avg/max select list) for bucketing columns from metric_logs or a rollup tier """
+    if tier is None:
+        return 'metric_logs', 'timestamp', ', '.join(
+            f'MIN({column}) AS {column}_min, AVG({column}) AS {column}_avg, MAX({column}) AS {column}_max'
+            for column in columns
+        )
+    return tier.table, 'bucket_start', ', '.join(
+        f'MIN({column}_min) AS {column}_min, '
+        f'SUM({column}_avg * sample_count) / SUM(CASE WHEN {column}_avg IS NOT NULL THEN sample_count END) AS {column}_avg, '
+        f'MAX({column}_max) AS {column}_max'
+        for column in columns
+    )
+
+def iter_raw_sql(columns: list, epoch=True):
+    """
+    * one server's samples in time order, the timestamp as epoch seconds or as stored
+    * ordered by the qualified column, the (machine_name, timestamp) index then yields the rows in order;
+      ordering by the epoch alias would sort the whole range before the first row comes out
+    """
+    time_column = "CAST(strftime('%s', metric_logs.timestamp) AS INTEGER)" if epoch else 'metric_logs.timestamp'
+    return text(f'''
+        SELECT {time_column} AS timestamp, {', '.join(columns)}
+        FROM metric_logs
+        WHERE metric_logs.machine_name = :server_id
+        AND metric_logs.timestamp BETWEEN :start_time AND :end_time
+        ORDER BY metric_logs.timestamp
+    ''')
+
+def upsert_sql():
+    """
+    * insert metric_logs rows, merging a row into the stored one of the same sample (machine_name, timestamp):
+      its values replace the stored ones, its missing values keep them
+    * a row that changes a stored sample moves it to a new id, so ingest polls and rollup compaction pick it up
+    """
+    table = MetricLogs.__table__
+    statement = insert(table)
+    excluded = statement.excluded
+    changed = or_(*(and_(excluded[column].isnot(None), excluded[column].is_distinct_from(table.c[column]))
+                    for column in METRIC_COLUMNS))
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.machine_name, table.c.timestamp],
+        set_={
+            **{column: func.coalesce(excluded[column], table.c[column]) for column in METRIC_COLUMNS},
+            'id': case((changed, select(func.max(table.c.id)).scalar_subquery() + 1), else_=table.c.id),
+        }
+    )
+
+def server_params(servers):
+    """ (IN clause, bind parameters) selecting the given servers """
+    params = {f'server_{i}': server for i, server in enumerate(servers)}
+    return ', '.join(f':{key}' for key in params), params
+
+def rows_by_server(servers, result):
+    grouped = {server: [] for server in servers}
+    for row in result:
+        grouped[row['machine_name']].append(row)
+    return grouped
+
+class SQLStorage(StorageBackend):
+    """ one metric_logs row per sample, hand written SQL for the reads """
+
+    name = 'sql'
+
+    def write(self, rows):
+        """ upsert all rows with one executemany and a single commit, late points fill in their stored sample """
+        try:
+            db.session.execute(upsert_sql(), rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def latest(self):
+        # walk the distinct machine names through the (machine_name, timestamp) index, then take the
+        # newest row of each one, so the cost grows with the number of servers rather than the table size
+        with get_connection() as conn:
+            query_result = conn.execute(text('''
+                WITH RECURSIVE machines(machine_name) AS (
+                    SELECT MIN(machine_name) FROM metric_logs
+                    UNION ALL
+                    SELECT (SELECT MIN(machine_name) FROM metric_logs WHERE machine_name > machines.machine_name)
+                    FROM machines
+                    WHERE machines.machine_name IS NOT NULL
+                )
+                SELECT metric_logs.*
+                FROM machines
+                JOIN metric_logs ON metric_logs.id = (
+                    SELECT id
+                    FROM metric_logs
+                    WHERE machine_name = machines.machine_name
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT 1
+                )
+            ''')).mappings().all()
+        return {row['machine_name']: dict(row) for row in query_result}
+
+    def newest_timestamps(self, servers):
+        newest = db.session.query(MetricLogs.machine_name, func.max(MetricLogs.timestamp)) \
+            .filter(MetricLogs.machine_name.in_(servers)) \
+            .group_by(MetricLogs.machine_name).all()
+        return dict(newest)
+
+    def raw(self, servers, columns, start_time, end_time):
+        in_clause, params = server_params(servers)
+        with get_connection() as conn:
+            result = conn.execute(text(f'''
+                SELECT machine_name, timestamp, {', '.join(columns)}
+                FROM metric_logs
+                WHERE machine_name IN ({in_clause})
+                AND timestamp BETWEEN :start_time AND :end_time
+                ORDER BY machine_name, timestamp
+            '''), {'start_time': start_time, 'end_time': end_time, **params}).mappings().all()
+        return {server: {key: [row[key] for row in rows] for key in ['timestamp'] + list(columns)}
+                for server, rows in rows_by_server(servers, result).items()}
+
+    def bucketed(self, servers, columns, start_time, end_time, bucket, tier=None):
+        """ aggregated in SQL from metric_logs, or re-aggregated from a rollup tier when one is given """
+        table, time_column, aggregates = aggregate_sql(columns, tier)
+        in_clause, params = server_params(servers)
+        with get_connection() as conn:
+            result = conn.execute(text(f'''
+                SELECT machine_name,
+                       datetime(CAST(strftime('%s', {time_column}) AS INTEGER) / :bucket * :bucket, 'unixepoch') AS timestamp,
+                       {aggregates}
+                FROM {table}
+                WHERE machine_name IN ({in_clause})
+                AND {time_column} BETWEEN :start_time AND :end_time
+                GROUP BY machine_name, CAST(strftime('%s', {time_column}) AS INTEGER) / :bucket
+                ORDER BY machine_name, 2
+            '''), {'bucket': int(bucket), 'start_time': start_time, 'end_time': end_time, **params}).mappings().all()
+        return rows_by_server(servers, result)
+
+    def iter_raw(self, server, columns, start_time, end_time, epoch=True, chunk_size=5000):
+        """
+        * streamed off a server side cursor, so a long range is never loaded as a whole
+        * no statement timeout, the consumer sets the pace at which rows are fetched
+        """
+        with get_connection(timeout=0) as conn:
+            result = conn.execution_options(stream_results=True).execute(iter_raw_sql(columns, epoch), {
+                'server_id': server,
+                'start_time': start_time,
+                'end_time': end_time
+            })
+            for partition in result.partitions(chunk_size):
+                yield [tuple(row) for row in partition]
+
+    def write_samples(self, samples):
+        try:
+            db.session.execute(MetricSample.__table__.insert(), samples)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def samples(self, server, series, start_time, end_time):
+        with get_connection() as conn:
+            result = conn.execute(text('''
+                SELECT timestamp, value
+                FROM metric_samples
+                WHERE machine_name = :server AND series = :series
+                AND timestamp BETWEEN :start_time AND :end_time
+                ORDER BY timestamp
+            '''), {'server': server, 'series': series, 'start_time': start_time, 'end_time': end_time}).all()
+        return {'timestamp': [row[0] for row in result], 'value': [row[1] for row in result]}
+
+    def series_names(self, server):
+        # skip through the (machine_name, series, timestamp) index one series at a time
+        with get_connection() as conn:
+            result = conn.execute(text('''
+                WITH RECURSIVE names(series) AS (
+                    SELECT MIN(series) FROM metric_samples WHERE machine_name = :server
+                    UNION ALL
+                    SELECT (SELECT MIN(series) FROM metric_samples WHERE machine_name = :server AND series > names.series)
+                    FROM names
+                    WHERE names.series IS NOT NULL
+                )
+                SELECT series FROM names WHERE series IS NOT NULL
+            '''), {'server': server}).scalars().all()
+        return list(result)
@@ -0,0 +1,498 @@
+"""
+Compact local time-series storage.
+
+* One directory per server under TSDB_PATH, holding an append-only chunk file and a small head file
+* New samples are appended uncompressed to the head; once it holds TSDB_CHUNK_POINTS samples it is
+  sealed into a chunk and emptied
+* A chunk stores the timestamps and every metric column as separate blocks, so a query only decodes
+  the columns it asks for:
+    timestamps  microseconds, delta-of-delta encoded (regular collection intervals become runs of zeros)
+    values      float64 XORed with the previous value, as in Gorilla (slowly changing values share their high bits),
+                or delta encoded scaled integers when every value has a few decimal places at most
+  each block byte-shuffled and zlib compressed, so encoding and decoding stay vectorized numpy operations
+* Chunk files are memory-mapped for reads, and chunks outside a query's range are skipped using their headers
+* One sample per timestamp: a row for a stored timestamp (a late high resolution point) fills in that sample,
+  rewriting the head, or the chunks from the one holding it onwards into a new file swapped in for the old one
+* Subscribed series (app.metric_spec) are kept in the app database, like with the sql backend
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime, timedelta
+from urllib.parse import quote, unquote
+import numpy as np
+from ..models import METRIC_COLUMNS
+from .base import StorageBackend
+from .sql import SQLStorage
+
+logger = logging.getLogger(__name__)
+
+# samples per sealed chunk, larger chunks compress better but leave more samples uncompressed in the head
+DEFAULT_CHUNK_POINTS = 1024
+
+# magic, sample count, first and last timestamp, byte length of the timestamp block and of each column block
+CHUNK_HEADER = struct.Struct(f'<4sIqq{1 + len(METRIC_COLUMNS)}I')
+CHUNK_MAGIC = b'TSC1'
+
+# one uncompressed head record per sample, NaN standing in for a missing value
+HEAD_DTYPE = np.dtype([('timestamp', '<i8')] + [(column, '<f8') for column in METRIC_COLUMNS])
+
+# most decimal places a chunk of values is stored as scaled integers with, and the integer standing in for NaN
+MAX_DECIMALS = 4
+MISSING_INTEGER = np.iinfo(np.int64).min
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+def to_micros(timestamp):
+    """ naive UTC datetime to epoch microseconds """
+    return (timestamp.replace(tzinfo=None) - EPOCH) // MICROSECOND
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=int(micros))
+
+def iso_strings(values, unit):
+    """ numpy datetimes as 'YYYY-MM-DD HH:MM:SS...' strings, the 'T' swapped for a space on the code points """
+    text = np.datetime_as_string(values.astype(f'datetime64[{unit}]'), unit=unit)
+    if len(text):
+        text.view(np.uint32).reshape(len(text), -1)[:, 10] = ord(' ')
+    return text.tolist()
+
+def format_timestamps(micros):
+    """ epoch microseconds as the 'YYYY-MM-DD HH:MM:SS.ffffff' strings SQLite stores """
+    return iso_strings(micros, 'us')
+
+def format_seconds(seconds):
+    """ epoch seconds as the 'YYYY-MM-DD HH:MM:SS' strings SQLite's datetime() returns """
+    return iso_strings(seconds, 's')
+
+def shuffle(words):
+    """ zlib compress 8 byte words with their bytes transposed, so equal high bytes end up next to each other """
+    return zlib.compress(words.astype('<u8').view(np.uint8).reshape(-1, 8).T.tobytes(), 6)
+
+def unshuffle(data, count):
+    return np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(8, count).T.copy().view('<u8').ravel()
+
+def zigzag(values):
+    """ signed to unsigned so small negative numbers stay small """
+    return (values << 1) ^ (values >> 63)
+
+def unzigzag(values):
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+def encode_timestamps(micros):
+    """ delta-of-delta of int64 timestamps """
+    deltas = np.diff(micros, prepend=np.int64(0))
+    return shuffle(zigzag(np.diff(deltas, prepend=np.int64(0))))
+
+def decode_timestamps(data, count):
+    return np.cumsum(np.cumsum(unzigzag(unshuffle(data, count))))
+
+def encode_values(values):
+    """
+    * One mode byte, then the block:
+        mode 0      float64 XORed with the previous value
+        mode d + 1  values with at most d decimal places (as Netdata reports them) as delta encoded
+                    integers scaled by 10**d, which compress far better than XORed floats
+    * Both decode to exactly the values encoded
+    """
+    missing = np.isnan(values)
+    present = values[~missing]
+    for decimals in range(MAX_DECIMALS + 1):
+        scale = 10.0 ** decimals
+        scaled = np.round(present * scale)
+        if np.all(np.abs(scaled) < 2 ** 52) and np.array_equal(scaled / scale, present):
+            integers = np.full(len(values), MISSING_INTEGER, dtype=np.int64)
+            integers[~missing] = scaled.astype(np.int64)
+            return bytes([decimals + 1]) + shuffle(zigzag(np.diff(integers, prepend=np.int64(0))))
+    bits = values.astype('<f8').view('<u8')
+    return bytes([0]) + shuffle(bits ^ np.concatenate(([np.uint64(0)], bits[:-1])))
+
+def decode_values(data, count):
+    mode = data[0]
+    if mode == 0:
+        return np.bitwise_xor.accumulate(unshuffle(data[1:], count)).view('<f8')
+    integers = np.cumsum(unzigzag(unshuffle(data[1:], count)))
+    values = integers / 10.0 ** (mode - 1)
+    values[integers == MISSING_INTEGER] = np.nan
+    return values
+
+def merge_records(stored, records):
+    """
+    * head records of both arrays merged by timestamp, sorted and one per timestamp
+    * values of records replace the stored ones, their NaN values keep them
+    """
+    combined = np.sort(np.concatenate([stored, records]), order='timestamp', kind='stable')
+    timestamps = combined['timestamp']
+    starts = np.flatnonzero(np.concatenate(([True], timestamps[1:] != timestamps[:-1])))
+    merged = combined[starts].copy()
+    positions = np.arange(len(combined))
+    for column in METRIC_COLUMNS:
+        values = combined[column]
+        # position of the last value present in each timestamp's group, -1 when there is none
+        last = np.maximum.reduceat(np.where(np.isnan(values), -1, positions), starts)
+        merged[column] = np.where(last >= starts, values[np.maximum(last, 0)], np.nan)
+    return merged
+
+def encode_chunk(records):
+    """ header and blocks of a chunk holding head records sorted by timestamp """
+    blocks = [encode_timestamps(records['timestamp'])] + [encode_values(records[column]) for column in METRIC_COLUMNS]
+    header = CHUNK_HEADER.pack(CHUNK_MAGIC, len(records), int(records['timestamp'][0]), int(records['timestamp'][-1]),
+                               *(len(block) for block in blocks))
+    return header + b''.join(blocks)
+
+def replace_file(path, data, source=None, length=0):
+    """
+    * write the first length bytes of the source file, then data, next to path and swap it in
+    * readers holding the old file keep reading it
+    """
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        if source is not None:
+            source.seek(0)
+            while length > 0:
+                copied = f.write(source.read(min(length, 2 ** 20)))
+                length -= copied
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+def optional(values):
+    """ numpy floats as python floats, NaN as None """
+    return [None if value != value else value for value in values.tolist()]
+
+def bucket_rows(timestamps, values, columns, bucket):
+    """
+    * rows shaped like SQLStorage.bucketed returns them, from epoch microsecond timestamps and {column: floats}
+    * min/avg/max per bucket of `bucket` seconds are numpy reductions, NaN values are ignored
+    """
+    bucket = int(bucket)
+    if not len(timestamps):
+        return []
+    keys = (timestamps // 1_000_000) // bucket
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+    out = {'timestamp': format_seconds(keys[starts] * bucket)}
+    for column in columns:
+        column_values = values[column][order]
+        valid = ~np.isnan(column_values)
+        counts = np.add.reduceat(valid.astype(np.int64), starts)
+        sums = np.add.reduceat(np.where(valid, column_values, 0.0), starts)
+        empty = counts == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[f'{column}_avg'] = optional(np.where(empty, np.nan, sums / counts))
+        out[f'{column}_min'] = optional(np.where(empty, np.nan, np.minimum.reduceat(np.where(valid, column_values, np.inf), starts)))
+        out[f'{column}_max'] = optional(np.where(empty, np.nan, np.maximum.reduceat(np.where(valid, column_values, -np.inf), starts)))
+    return [dict(zip(out, row)) for row in zip(*out.values())]
+
+class Series:
+    """ the chunk and head files of one server """
+
+    def __init__(self, directory, chunk_points=DEFAULT_CHUNK_POINTS):
+        self.directory = directory
+        self.chunk_points = chunk_points
+        self.chunks_path = os.path.join(directory, 'chunks.bin')
+        self.head_path = os.path.join(directory, 'head.bin')
+        # (first timestamp, last timestamp, offset of the first block, sample count, block lengths) per chunk
+        self.index = []
+        self.indexed_size = 0
+        # inode of the indexed chunk file, a rewritten file is indexed from scratch
+        self.inode = None
+        # readers refresh the index too, the lock keeps them from indexing the same chunks twice
+        self.lock = threading.Lock()
+
+    @property
+    def sealed_until(self):
+        """ last timestamp of the newest sealed chunk, samples up to it never come from the head """
+        index = self.index
+        return index[-1][1] if index else None
+
+    def open_chunks(self):
+        """ (chunk file opened for reading, its index, indexed size), None when there is none """
+        try:
+            f = open(self.chunks_path, 'rb')
+        except FileNotFoundError:
+            return None
+        return (f, *self.refresh_index(f))
+
+    def refresh_index(self, f=None):
+        """
+        * index chunks appended since the last call, stopping at a chunk that is still being written
+        * returns the index and the indexed size matching f, the index list is swapped for a new one
+          rather than changed in place, so callers can keep using it without the lock
+        """
+        if f is None:
+            opened = self.open_chunks()
+            if opened is None:
+                return [], 0
+            opened[0].close()
+            return opened[1:]
+        with self.lock:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.inode:
+                self.index, self.indexed_size, self.inode = [], 0, stat.st_ino
+            index, indexed_size, size = [], self.indexed_size, stat.st_size
+            f.seek(indexed_size)
+            while indexed_size + CHUNK_HEADER.size <= size:
+                magic, count, first, last, *lengths = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+                end = indexed_size + CHUNK_HEADER.size + sum(lengths)
+                if magic != CHUNK_MAGIC or end > size:
+                    break
+                index.append((first, last, indexed_size + CHUNK_HEADER.size, count, lengths))
+                indexed_size = end
+                f.seek(end)
+            if index:
+                self.index = self.index + index
+            self.indexed_size = indexed_size
+            return self.index, self.indexed_size
+
+    def read_head(self):
+        """ head records newer than the sealed chunks, ignoring a record that is only partly written """
+        try:
+            size = os.path.getsize(self.head_path)
+        except FileNotFoundError:
+            return np.empty(0, dtype=HEAD_DTYPE)
+        head = np.fromfile(self.head_path, dtype=HEAD_DTYPE, count=size // HEAD_DTYPE.itemsize)
+        if self.sealed_until is not None:
+            # a seal interrupted before the head was emptied leaves its samples in both places
+            head = head[head['timestamp'] > self.sealed_until]
+        return head
+
+    def blocks(self, columns, start, end):
+        """ (timestamps, {column: values}) per chunk overlapping [start, end], then the head, oldest first """
+        opened = self.open_chunks()
+        if opened is not None:
+            f, index, indexed_size = opened
+            with f:
+                chunks = [chunk for chunk in index if chunk[1] >= start and chunk[0] <= end]
+                if chunks:
+                    with mmap.mmap(f.fileno(), indexed_size, access=mmap.ACCESS_READ) as mapped:
+                        for chunk in chunks:
+                            yield self.decode_chunk(mapped, chunk, columns)
+        head = self.read_head()
+        if len(head):
+            head = np.sort(head, order='timestamp', kind='stable')
+            yield head['timestamp'], {column: head[column] for column in columns}
+
+    @staticmethod
+    def decode_chunk(mapped, chunk, columns):
+        """ (timestamps, {column: values}) of an indexed chunk of the mapped chunk file """
+        first, last, offset, count, lengths = chunk
+        bounds = np.concatenate(([offset], offset + np.cumsum(lengths)))
+        timestamps = decode_timestamps(mapped[bounds[0]:bounds[1]], count)
+        values = {}
+        for column in columns:
+            i = METRIC_COLUMNS.index(column) + 1
+            values[column] = decode_values(mapped[bounds[i]:bounds[i + 1]], count)
+        return timestamps, values
+
+    def read(self, columns, start, end):
+        """ every sample in [start, end] as (timestamps, {column: values}) arrays """
+        parts = []
+        for timestamps, values in self.blocks(columns, start, end):
+            mask = (timestamps >= start) & (timestamps <= end)
+            parts.append((timestamps[mask], {column: values[column][mask] for column in columns}))
+        if not parts:
+            return np.empty(0, dtype=np.int64), {column: np.empty(0) for column in columns}
+        return (np.concatenate([timestamps for timestamps, _ in parts]),
+                {column: np.concatenate([values[column] for _, values in parts]) for column in columns})
+
+    def last(self):
+        """ newest sample as a head record, None for an empty series """
+        head = self.read_head()
+        if len(head):
+            return np.sort(head, order='timestamp')[-1]
+        index, _ = self.refresh_index()
+        if not index:
+            return None
+        first, last, *_ = index[-1]
+        timestamps, values = self.read(list(METRIC_COLUMNS), last, last)
+        record = np.zeros(1, dtype=HEAD_DTYPE)[0]
+        record['timestamp'] = timestamps[-1]
+        for column in METRIC_COLUMNS:
+            record[column] = values[column][-1]
+        return record
+
+    def recover(self):
+        """ before the first write: cut off a partly written chunk left by a crash """
+        os.makedirs(self.directory, exist_ok=True)
+        _, indexed_size = self.refresh_index()
+        if os.path.exists(self.chunks_path) and os.path.getsize(self.chunks_path) > indexed_size:
+            logger.warning(f"Discarding a partly written chunk in {self.chunks_path}")
+            with open(self.chunks_path, 'r+b') as f:
+                f.truncate(indexed_size)
+
+    def append(self, records):
+        """
+        * add head records, returns the number of samples now in the head
+        * records for timestamps already stored fill in those samples instead
+        """
+        if self.sealed_until is not None:
+            late = records['timestamp'] <= self.sealed_until
+            if late.any():
+                self.merge_sealed(records[late])
+                records = records[~late]
+        head = self.read_head()
+        if len(head) and np.isin(records['timestamp'], head['timestamp']).any():
+            replace_file(self.head_path, merge_records(head, records).tobytes())
+        else:
+            with open(self.head_path, 'ab') as f:
+                f.write(records.tobytes())
+        return os.path.getsize(self.head_path) // HEAD_DTYPE.itemsize
+
+    def merge_sealed(self, records):
+        """ merge records older than the head into the chunks, rewriting them from the first one they touch """
+        f, index, indexed_size = self.open_chunks()
+        first_touched = next(i for i, chunk in enumerate(index) if chunk[1] >= records['timestamp'].min())
+        columns = list(METRIC_COLUMNS)
+        start = index[first_touched][2] - CHUNK_HEADER.size
+        with f:
+            with mmap.mmap(f.fileno(), indexed_size, access=mmap.ACCESS_READ) as mapped:
+                stored = []
+                for chunk in index[first_touched:]:
+                    timestamps, values = self.decode_chunk(mapped, chunk, columns)
+                    part = np.zeros(len(timestamps), dtype=HEAD_DTYPE)
+                    part['timestamp'] = timestamps
+                    for column in columns:
+                        part[column] = values[column]
+                    stored.append(part)
+            merged = merge_records(np.concatenate(stored), records)
+            chunks = [encode_chunk(merged[i:i + self.chunk_points]) for i in range(0, len(merged), self.chunk_points)]
+            # the chunks before the first one touched are copied as they are
+            replace_file(self.chunks_path, b''.join(chunks), f, start)
+        self.refresh_index()
+
+    def seal(self):
+        """ compress the head into a new chunk, then empty the head """
+        head = merge_records(self.read_head(), np.empty(0, dtype=HEAD_DTYPE))
+        if not len(head):
+            return
+        with open(self.chunks_path, 'ab') as f:
+            f.write(encode_chunk(head))
+            f.flush()
+            os.fsync(f.fileno())
+        self.refresh_index()
+        # the chunk is durable, a crash before this truncate only leaves head samples the reads skip
+        with open(self.head_path, 'r+b') as f:
+            f.truncate(0)
+
+class TSDBStorage(StorageBackend):
+    """ per server columnar chunks on local disk """
+
+    name = 'tsdb'
+
+    def __init__(self, path, chunk_points=DEFAULT_CHUNK_POINTS):
+        self.path = path
+        self.chunk_points = chunk_points
+        self.series_by_server = {}
+        self.recovered = set()
+        self.lock = threading.Lock()
+        self.series_lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def series(self, server):
+        series = self.series_by_server.get(server)
+        if series is None:
+            # a request thread and the writer must not each create their own Series, with its own index
+            with self.series_lock:
+                series = self.series_by_server.get(server)
+                if series is None:
+                    series = self.series_by_server[server] = Series(os.path.join(self.path, quote(server, safe='')),
+                                                                    self.chunk_points)
+        return series
+
+    def servers(self):
+        return sorted(unquote(name) for name in os.listdir(self.path)
+                      if os.path.isdir(os.path.join(self.path, name)))
+
+    def write(self, rows):
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(row['machine_name'], []).append(row)
+
+        with self.lock:
+            for server, server_rows in grouped.items():
+                records = np.zeros(len(server_rows), dtype=HEAD_DTYPE)
+                records['timestamp'] = [to_micros(row['timestamp']) for row in server_rows]
+                for column in METRIC_COLUMNS:
+                    records[column] = [row.get(column) if row.get(column) is not None else np.nan for row in server_rows]
+
+                series = self.series(server)
+                if server not in self.recovered:
+                    series.recover()
+                    self.recovered.add(server)
+                if series.append(records) >= self.chunk_points:
+                    series.seal()
+
+    def latest(self):
+        latest = {}
+        for server in self.servers():
+            record = self.series(server).last()
+            if record is not None:
+                latest[server] = {
+                    'machine_name': server,
+                    'timestamp': format_timestamps(np.array([record['timestamp']]))[0],
+                    **{column: optional(np.array([record[column]]))[0] for column in METRIC_COLUMNS}
+                }
+        return latest
+
+    def newest_timestamps(self, servers):
+        newest = {}
+        for server in servers:
+            record = self.series(server).last()
+            if record is not None:
+                newest[server] = from_micros(record['timestamp'])
+        return newest
+
+    def raw(self, servers, columns, start_time, end_time):
+        result = {}
+        for server in servers:
+            timestamps, values = self.series(server).read(columns, to_micros(start_time), to_micros(end_time))
+            result[server] = {'timestamp': format_timestamps(timestamps),
+                              **{column: optional(values[column]) for column in columns}}
+        return result
+
+    def bucketed(self, servers, columns, start_time, end_time, bucket, tier=None):
+        """ min/avg/max per bucket computed with numpy reductions over the raw samples, missing values ignored """
+        result = {}
+        for server in servers:
+            timestamps, values = self.series(server).read(columns, to_micros(start_time), to_micros(end_time))
+            result[server] = bucket_rows(timestamps, values, columns, bucket)
+        return result
+
+    def iter_raw(self, server, columns, start_time, end_time, epoch=True, chunk_size=5000):
+        start, end = to_micros(start_time), to_micros(end_time)
+        pending = []
+        for timestamps, values in self.series(server).blocks(columns, start, end):
+            mask = (timestamps >= start) & (timestamps <= end)
+            timestamps = timestamps[mask]
+            formatted = (timestamps // 1_000_000).tolist() if epoch else format_timestamps(timestamps)
+            pending.extend(zip(formatted, *(optional(values[column][mask]) for column in columns)))
+            while len(pending) >= chunk_size:
+                yield pending[:chunk_size]
+                pending = pending[chunk_size:]
+        if pending:
+            yield pending
+
+    # subscribed series are open ended and narrow, they stay in the metric_samples table of the app database
+    def write_samples(self, samples):
+        SQLStorage().write_samples(samples)
+
+    def samples(self, server, series, start_time, end_time):
+        return SQLStorage().samples(server, series, start_time, end_time)
+
+    def series_names(self, server):
+        return SQLStorage().series_names(server)
+
+    def disk_usage(self):
+        """ bytes used by every chunk and head file """
+        total = 0
+        for directory, _, files in os.walk(self.path):
+            total += sum(os.path.getsize(os.path.join(directory, name)) for name in files)
+        return total
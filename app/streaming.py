@@ -0,0 +1,180 @@
+"""
+Live push of new metrics to dashboards.
+
+* One shared Broadcaster per process keeps a bounded log of delta events, fed by store_metrics commits
+* Clients hold nothing but a cursor into that log: there is no per client thread or queue,
+  so idle connections cost one waiting greenlet each when served by an async worker (gevent)
+* Under threaded workers every client would hold a thread, so the stream is only served with LIVE_STREAM
+  ('auto' turns it on when gevent patched threading) and dashboards poll instead
+* Event ids carry a per process prefix, so a client resuming with Last-Event-ID after a restart,
+  or after falling out of the log, gets a fresh snapshot instead of a gap
+"""
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from . import ingest
+from .metric_collector import format_latest
+
+logger = logging.getLogger(__name__)
+
+# seconds between keep-alive comments on an idle stream, below common proxy idle timeouts
+HEARTBEAT_SECONDS = 15
+
+class Broadcaster:
+    """ fan-out of metric deltas to any number of waiting clients """
+
+    def __init__(self, history=1000):
+        self.prefix = uuid.uuid4().hex[:8]
+        self.condition = threading.Condition()
+        self.events = deque(maxlen=history)
+        self.sequence = itertools.count(1)
+        self.last_sequence = 0
+        # full latest values per server, the base deltas are computed against
+        self.state = {}
+
+    def event_id(self, sequence):
+        return f"{self.prefix}-{sequence}"
+
+    def parse_event_id(self, event_id):
+        """ sequence number of an id this process issued, None for unknown or foreign ids """
+        prefix, _, sequence = (event_id or '').partition('-')
+        if prefix != self.prefix or not sequence.isdigit():
+            return None
+        return int(sequence)
+
+    def publish(self, latest):
+        """
+        * Merge {server: values} into the state and publish only the fields that changed
+        * Returns the published delta, empty when nothing changed
+        """
+        with self.condition:
+            delta = {}
+            for name, values in latest.items():
+                previous = self.state.get(name, {})
+                changed = {key: value for key, value in values.items() if previous.get(key) != value}
+                if changed:
+                    delta[name] = changed
+                    self.state[name] = {**previous, **values}
+            if delta:
+                self.last_sequence = next(self.sequence)
+                self.events.append((self.last_sequence, delta))
+                self.condition.notify_all()
+            return delta
+
+    def snapshot(self, base):
+        """ (event id, full state) with the state merged over a base snapshot, e.g. the latest metrics cache """
+        with self.condition:
+            merged = dict(base)
+            merged.update(self.state)
+            return self.event_id(self.last_sequence), merged
+
+    def events_after(self, sequence):
+        """ events newer than sequence, or None when some of them already fell out of the log """
+        with self.condition:
+            if sequence > self.last_sequence:
+                return None
+            if self.events and self.events[0][0] > sequence + 1:
+                return None
+            if not self.events and sequence < self.last_sequence:
+                return None
+            return [event for event in self.events if event[0] > sequence]
+
+    def wait(self, sequence, timeout):
+        """ block until an event newer than sequence is published, or timeout seconds pass """
+        with self.condition:
+            if self.last_sequence <= sequence:
+                self.condition.wait(timeout)
+            return self.last_sequence > sequence
+
+broadcaster = Broadcaster()
+
+# timestamp of the newest row published per server
+_published = {}
+
+def async_worker():
+    """ True when gevent patched threading in this process, as the gevent worker class does """
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+def live_stream_enabled(config):
+    """ whether LIVE_STREAM serves the event stream: '1', '0', or 'auto' for async workers only """
+    setting = config.get('LIVE_STREAM', 'auto')
+    if setting == 'auto':
+        return async_worker()
+    return setting == '1'
+
+@ingest.register
+def publish_rows(rows):
+    """ publish the newest committed row of each server as a delta event """
+    newest = ingest.newest_rows(rows, _published)
+    broadcaster.publish({name: format_latest(row) for name, row in newest.items()})
+
+def iter_events(base_snapshot, last_event_id=None, heartbeat=HEARTBEAT_SECONDS, stop=None):
+    """
+    * Yield (event type, event id, payload) for one client, forever or until stop() is true
+    * Starts with a full snapshot unless last_event_id can be resumed from the log,
+      yields (None, None, None) as a keep-alive while idle
+    """
+    sequence = broadcaster.parse_event_id(last_event_id)
+    pending = broadcaster.events_after(sequence) if sequence is not None else None
+    if pending is None:
+        event_id, snapshot = broadcaster.snapshot(base_snapshot)
+        sequence = broadcaster.parse_event_id(event_id)
+        pending = []
+        yield 'snapshot', event_id, snapshot
+
+    while stop is None or not stop():
+        for event_sequence, delta in pending:
+            sequence = event_sequence
+            yield 'delta', broadcaster.event_id(event_sequence), delta
+
+        if not broadcaster.wait(sequence, heartbeat):
+            yield None, None, None
+        pending = broadcaster.events_after(sequence)
+        if pending is None:
+            # fell behind the log while blocked on a slow socket, start over from a snapshot
+            event_id, snapshot = broadcaster.snapshot(base_snapshot)
+            sequence = broadcaster.parse_event_id(event_id)
+            pending = []
+            yield 'snapshot', event_id, snapshot
+
+def format_sse(event, event_id, payload):
+    """ encode one event in the text/event-stream format, or a comment line as a keep-alive """
+    if event is None:
+        return f": keep-alive {int(time.time())}\n\n"
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def init_websocket(app):
+    """
+    * Serve the same events over a WebSocket at /api/ws when flask-sock is installed and the live stream is on
+    * Messages are JSON objects {"id", "event", "data"}, resume with ?last_event_id=
+    """
+    if not live_stream_enabled(app.config):
+        return None
+    try:
+        from flask_sock import Sock
+    except ImportError:
+        logger.info("flask-sock is not installed, the WebSocket stream is disabled")
+        return None
+
+    from flask import request
+    from .metric_collector import cached_latest_metrics
+
+    sock = Sock(app)
+
+    @sock.route('/api/ws')
+    def metrics_socket(ws):
+        snapshot, _ = cached_latest_metrics()
+        for event, event_id, payload in iter_events(snapshot, request.args.get('last_event_id'),
+                                                    stop=lambda: not ws.connected):
+            if event is None:
+                ws.send(json.dumps({"event": "keep-alive"}))
+            else:
+                ws.send(json.dumps({"id": event_id, "event": event, "data": payload}))
+
+    return sock
@@ -1,15 +1,91 @@
 import logging
+from datetime import datetime, timedelta
 from .data_retrieval import store_metrics
+from .host_health import collection_tick
+from .ingest import poll_committed_rows
+from .leases import acquire_lease
+from .rollups import compact_rollups, prune_metrics, utc_now
 
 logger = logging.getLogger(__name__)
 
 def schedule_logging(scheduler):
     """ configures the job being scheduled """
+    # servers have their own intervals, the job runs every tick and collects the ones that are due
+    interval = collection_tick(scheduler.app.config)
     scheduler.add_job(
         id='collect_metrics',
         func=store_metrics,
         trigger='interval',
-        minutes=10,
+        seconds=interval,
+        # a slow cycle delays the next one instead of overlapping it
+        max_instances=1,
+        coalesce=True,
         replace_existing=True
     )
-    logger.info("Scheduled metrics collection job")
+    logger.info(f"Scheduled metrics collection job every {interval}s")
+
+
+def schedule_rollups(scheduler):
+    """ configures the rollup compaction and retention jobs """
+    app = scheduler.app
+    interval = app.config.get('ROLLUP_INTERVAL_SECONDS', 60)
+
+    # every worker schedules these jobs, the lease holder is the only one that runs them
+    def compact():
+        with app.app_context():
+            if acquire_lease('compact_rollups', app.config.get('LEASE_TTL') or 2 * interval):
+                recompute_from = None
+                if app.config.get('HIGH_RESOLUTION', False):
+                    # late points only fill in samples within the backfill window of the last cycles
+                    backfill = app.config.get('HIGH_RESOLUTION_MAX_BACKFILL', 3600)
+                    recompute_from = utc_now() - timedelta(seconds=backfill + 2 * interval)
+                compact_rollups(recompute_from=recompute_from)
+
+    def prune():
+        with app.app_context():
+            if acquire_lease('prune_metrics', app.config.get('LEASE_TTL') or 2 * 3600):
+                prune_metrics()
+
+    scheduler.add_job(
+        id='compact_rollups',
+        func=compact,
+        trigger='interval',
+        seconds=interval,
+        # first run right away so existing raw history is compacted on startup
+        next_run_time=datetime.now(),
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+    scheduler.add_job(
+        id='prune_metrics',
+        func=prune,
+        trigger='interval',
+        hours=1,
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+    logger.info(f"Scheduled rollup compaction every {interval}s and hourly retention pruning")
+
+
+def schedule_ingest_watch(scheduler):
+    """ picks up rows written by other processes (the collection lease holder or the standalone collector), in every worker since each keeps its own caches """
+    app = scheduler.app
+    interval = app.config.get('INGEST_POLL_SECONDS', 5)
+
+    def watch():
+        with app.app_context():
+            poll_committed_rows()
+
+    scheduler.add_job(
+        id='watch_ingest',
+        func=watch,
+        trigger='interval',
+        seconds=interval,
+        next_run_time=datetime.now(),
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+    logger.info(f"Watching for collector rows every {interval}s")
@@ -0,0 +1,126 @@
+"""
+Benchmark the metric_logs read queries before and after the (machine_name, timestamp) and timestamp indexes.
+
+* Seeds a throwaway SQLite database with synthetic rows for a number of servers
+* Times historical_metrics for a one day range and latest_metrics, without the indexes
+  (and with the old ORDER BY id DESC LIMIT 2 latest query), then with them
+* Reports p50/p99 latency in milliseconds
+
+Usage:
+    python -m benchmarks.bench_metric_queries --rows 2000000 --servers 20
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+from sqlalchemy import text
+
+from app.models import MetricLogs, db
+from app.metric_collector import historical_metrics, latest_metrics
+from app.storage.sql import get_connection
+
+def legacy_latest_metrics():
+    """ the latest_metrics query before the index, kept here only for comparison """
+    with get_connection() as conn:
+        return conn.execute(text('SELECT * FROM metric_logs ORDER BY id DESC LIMIT 2')).mappings().all()
+
+def reset_engines(app):
+    """ drop the pooled connections of the write and read engines, so none keeps a schema from before a change """
+    db.engine.dispose()
+    read_engine = app.extensions.pop('read_engine', None)
+    if read_engine is not None and read_engine is not db.engine:
+        read_engine.dispose()
+
+def seed(path, rows, servers, interval):
+    """ write rows in timestamp order, round robin across servers, like the collector would """
+    start = datetime(2025, 1, 1)
+    conn = sqlite3.connect(path)
+    batch = []
+    for i in range(rows):
+        timestamp = start + timedelta(seconds=(i // servers) * interval)
+        batch.append((timestamp.strftime('%Y-%m-%d %H:%M:%S.%f'), f'server_{i % servers}',
+                      random.uniform(0, 100), random.uniform(0, 100), random.uniform(0, 100),
+                      random.uniform(0, 1000), random.uniform(0, 1000)))
+        if len(batch) == 50000:
+            conn.executemany('INSERT INTO metric_logs (timestamp, machine_name, cpu_usage, memory_usage, disk_usage, '
+                             'network_received, network_sent) VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+            batch = []
+    if batch:
+        conn.executemany('INSERT INTO metric_logs (timestamp, machine_name, cpu_usage, memory_usage, disk_usage, '
+                         'network_received, network_sent) VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+    conn.commit()
+    conn.close()
+    return start, start + timedelta(seconds=(rows // servers) * interval)
+
+def percentiles(samples):
+    """ p50 and p99 of the samples, in milliseconds """
+    ordered = sorted(samples)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return statistics.median(ordered) * 1000, p99 * 1000
+
+def time_calls(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+def run(rows, servers, interval, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+        db.init_app(app)
+
+        with app.app_context():
+            db.create_all()
+            # schema changes go through db.engine, the seeding connection only inserts
+            with db.engine.begin() as conn:
+                for index in MetricLogs.__table__.indexes:
+                    conn.execute(text(f'DROP INDEX {index.name}'))
+            reset_engines(app)
+            started = time.perf_counter()
+            first, last = seed(path, rows, servers, interval)
+            print(f"seeded {rows} rows for {servers} servers in {time.perf_counter() - started:.1f}s")
+
+            range_start = last - timedelta(days=1)
+
+            def historical():
+                server = f'server_{random.randrange(servers)}'
+                historical_metrics('cpu', server, range_start, last)
+
+            results.append(('historical_metrics, no index', time_calls(historical, repeat)))
+            results.append(('latest_metrics (id DESC LIMIT 2), no index', time_calls(legacy_latest_metrics, repeat)))
+            results.append(('latest_metrics, no index', time_calls(latest_metrics, max(1, repeat // 10))))
+
+            started = time.perf_counter()
+            for index in MetricLogs.__table__.indexes:
+                index.create(db.engine)
+            reset_engines(app)
+            print(f"built indexes in {time.perf_counter() - started:.1f}s")
+
+            results.append(('historical_metrics, index', time_calls(historical, repeat)))
+            results.append(('latest_metrics, index', time_calls(latest_metrics, repeat)))
+            reset_engines(app)
+
+    print(f"{'query':<46}{'p50 ms':>12}{'p99 ms':>12}")
+    for name, (p50, p99) in results:
+        print(f"{name:<46}{p50:>12.2f}{p99:>12.2f}")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--servers', type=int, default=20)
+    parser.add_argument('--interval', type=int, default=10, help='seconds between samples of a server')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    run(args.rows, args.servers, args.interval, args.repeat)
@@ -0,0 +1,87 @@
+"""
+Benchmark the sql and tsdb storage backends on the same synthetic samples.
+
+* Writes random walk samples (two decimal places, like Netdata values) for a number of servers
+  into a throwaway SQLite database and a throwaway tsdb directory
+* Reports disk use of each backend and p50/p99 latency of a long raw range and a bucketed range
+
+Usage:
+    python -m benchmarks.bench_storage --rows 2000000 --servers 20
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+
+from flask import Flask
+
+from app.metric_collector import historical_metrics
+from app.models import db
+from app.rollups import TIERS
+from app.storage import get_storage
+from benchmarks.bench_metric_queries import time_calls
+from benchmarks.synthetic import metric_rows
+
+def run(rows, servers, interval, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        apps = {}
+        for backend in ('sql', 'tsdb'):
+            app = Flask(__name__)
+            app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+            app.config['STORAGE_BACKEND'] = backend
+            app.config['TSDB_PATH'] = os.path.join(directory, 'tsdb')
+            # read every range from the raw samples, the rollup tiers are not part of this comparison
+            app.config['RAW_RETENTION_DAYS'] = 0
+            for tier in TIERS:
+                app.config[tier.retention_key] = 1
+            db.init_app(app)
+            apps[backend] = app
+
+        with apps['sql'].app_context():
+            db.create_all()
+        started = time.perf_counter()
+        last = None
+        for batch in metric_rows(rows, servers, interval):
+            for app in apps.values():
+                with app.app_context():
+                    get_storage().write(batch)
+            last = batch[-1]['timestamp']
+        print(f"wrote {rows} rows for {servers} servers to both backends in {time.perf_counter() - started:.1f}s")
+
+        range_start = last - timedelta(days=30)
+        for backend, app in apps.items():
+            with app.app_context():
+                if backend == 'sql':
+                    db.engine.dispose()
+                    size = os.path.getsize(path)
+                else:
+                    size = get_storage().disk_usage()
+                print(f"{backend:<6} disk use {size / 1024 / 1024:.1f} MiB")
+
+                def raw():
+                    historical_metrics('cpu', f'server_{random.randrange(servers)}', range_start, last)
+
+                def bucketed():
+                    historical_metrics('cpu', f'server_{random.randrange(servers)}', range_start, last, bucket=3600)
+
+                results.append((f'{backend}: 30 days raw', time_calls(raw, repeat)))
+                results.append((f'{backend}: 30 days hourly buckets', time_calls(bucketed, repeat)))
+                db.engine.dispose()
+
+    print(f"{'query':<46}{'p50 ms':>12}{'p99 ms':>12}")
+    for name, (p50, p99) in results:
+        print(f"{name:<46}{p50:>12.2f}{p99:>12.2f}")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--servers', type=int, default=20)
+    parser.add_argument('--interval', type=int, default=10, help='seconds between samples of a server')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    run(args.rows, args.servers, args.interval, args.repeat)
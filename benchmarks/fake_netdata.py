@@ -0,0 +1,116 @@
+"""
+Local fake Netdata API for benchmarks.
+
+* One HTTP server answers for any number of hosts: host i is http://127.0.0.1:<port>/host_<i>, so every host
+  still gets its own pooled session in data_retrieval
+* Serves /api/v1/data (latest point, or every point after `after`) and /api/v1/allmetrics for the collected charts
+* Each request waits latency +/- jitter seconds, and fails with a 500 with probability failure_rate
+
+Usage:
+    python -m benchmarks.fake_netdata --hosts 50 --latency 0.05 --jitter 0.02 --port 19999
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from app.data_retrieval import CHART_DIMENSIONS, CHARTS
+
+# dimension names per chart, in the order compute_metrics expects them
+DIMENSIONS = {
+    "system.cpu": ("guest_nice", "guest", "steal", "softirq", "irq", "user", "system", "nice", "iowait"),
+    **CHART_DIMENSIONS,
+}
+
+def chart_values(chart):
+    """ plausible values for every dimension of a chart """
+    if chart == "system.cpu":
+        return [round(random.uniform(0, 5), 2) for _ in DIMENSIONS[chart]]
+    if chart == "system.net":
+        return [round(random.uniform(0, 5000), 2), -round(random.uniform(0, 5000), 2)]
+    return [round(random.uniform(10, 1000), 2) for _ in DIMENSIONS[chart]]
+
+class FakeNetdata:
+    """ a running fake Netdata server, stop it with close() """
+
+    def __init__(self, hosts, latency=0.0, jitter=0.0, failure_rate=0.0, port=0, interval=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.interval = interval
+        self.requests = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, like Netdata, so pooled sessions reuse connections
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with fake.lock:
+                    fake.requests += 1
+                delay = fake.latency + random.uniform(-fake.jitter, fake.jitter)
+                if delay > 0:
+                    time.sleep(delay)
+                if random.random() < fake.failure_rate:
+                    self.reply(500, {"error": "injected failure"})
+                    return
+
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if url.path.endswith('/api/v1/allmetrics'):
+                    charts = query.get('filter', ' '.join(CHARTS)).split()
+                    self.reply(200, {chart: {"dimensions": {name: {"value": value} for name, value in
+                                                            zip(DIMENSIONS[chart], chart_values(chart))}}
+                                     for chart in charts if chart in DIMENSIONS})
+                elif url.path.endswith('/api/v1/data') and query.get('chart') in DIMENSIONS:
+                    chart = query['chart']
+                    now = int(time.time())
+                    # every point after `after`, at most the last hour, or just the latest one
+                    after = max(int(query['after']), now - 3600) if 'after' in query else now - 1
+                    timestamps = range(after + fake.interval, now + 1, fake.interval)
+                    self.reply(200, {"labels": ["time", *DIMENSIONS[chart]],
+                                     "data": [[timestamp, *chart_values(chart)] for timestamp in reversed(timestamps)]})
+                else:
+                    self.reply(404, {"error": "not found"})
+
+            def reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-netdata', daemon=True)
+        self.thread.start()
+        self.hosts = [{"name": f"host_{i}", "host": f"http://127.0.0.1:{self.server.server_port}/host_{i}"}
+                      for i in range(hosts)]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hosts', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- seconds added to the latency')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of requests answered with a 500')
+    parser.add_argument('--port', type=int, default=19999)
+    args = parser.parse_args()
+    fake = FakeNetdata(args.hosts, args.latency, args.jitter, args.failure_rate, args.port)
+    for host in fake.hosts:
+        print(host["host"])
+    try:
+        fake.thread.join()
+    except KeyboardInterrupt:
+        fake.close()
@@ -0,0 +1,270 @@
+"""
+Reproducible benchmark suite, with results that can be compared across commits.
+
+* collection: store_metrics cycle time against a local fake Netdata (latency, jitter and failures
+  injected) for a growing number of hosts
+* ingest: rows per second through write_rows, for the sql and tsdb backends
+* queries: historical_metrics (one day) and latest_metrics latency as metric_logs grows
+* archive: rows per second exported to and imported from Parquet and gzip CSV files
+* startup: create_app time (imports included, in a fresh interpreter) and first request time of a web
+  worker, with LAZY_STARTUP on and off
+* Results are written as JSON: {"meta": {commit, python, ...}, "results": {name: {value, unit, better}}}
+
+Usage:
+    python -m benchmarks.suite run --output base.json            # full run
+    python -m benchmarks.suite run --quick --output head.json    # smaller sizes, for a quick check
+    python -m benchmarks.suite compare base.json head.json --threshold 0.1
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from flask import Flask
+
+from app.archive import export_metrics, import_metrics
+from app.data_retrieval import store_metrics, write_rows
+from app.metric_collector import historical_metrics, latest_metrics
+from app.models import MetricLogs, Server, db
+from app.storage import get_storage
+from benchmarks.bench_metric_queries import percentiles, time_calls
+from benchmarks.fake_netdata import FakeNetdata
+from benchmarks.synthetic import metric_rows
+
+# sizes of the full run and of --quick
+HOST_COUNTS = {'full': (1, 10, 50, 100), 'quick': (1, 10)}
+INGEST_ROWS = {'full': 200_000, 'quick': 20_000}
+ARCHIVE_ROWS = {'full': 1_000_000, 'quick': 50_000}
+TABLE_SIZES = {'full': (10_000, 100_000, 1_000_000), 'quick': (10_000, 100_000)}
+STARTUP_RUNS = {'full': 10, 'quick': 3}
+
+# a web worker without the scheduler, printing its create_app and first request seconds
+STARTUP_SCRIPT = '''
+import sys, time
+started = time.perf_counter()
+from config import Config
+from app import create_app
+
+class BenchConfig(Config):
+    SQLALCHEMY_DATABASE_URI = sys.argv[1]
+    LAZY_STARTUP = sys.argv[2] == '1'
+    RUN_SCHEDULER = False
+
+app = create_app(BenchConfig)
+created = time.perf_counter()
+app.test_client().get('/')
+print(created - started, time.perf_counter() - created)
+'''
+
+def bench_app(directory, **config):
+    """ a bare Flask app on a throwaway database, with the ingest queue off so writes are measured inline """
+    app = Flask(__name__)
+    app.config.update({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(directory, 'bench.db')}",
+        'TSDB_PATH': os.path.join(directory, 'tsdb'),
+        'PROFILE_DIR': os.path.join(directory, 'profiles'),
+        'INGEST_QUEUE': False,
+        # every host is due on every cycle
+        'COLLECTION_INTERVAL_SECONDS': 0,
+        # read every range from the raw samples
+        'RAW_RETENTION_DAYS': 0,
+        **config,
+    })
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+def result(value, unit, better='lower'):
+    return {'value': round(value, 4), 'unit': unit, 'better': better}
+
+def bench_collection(results, host_counts, repeat, latency, jitter, failure_rate):
+    for hosts in host_counts:
+        fake = FakeNetdata(hosts, latency, jitter, failure_rate)
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                app = bench_app(directory)
+                with app.app_context():
+                    db.session.add_all(Server(name=host['name'], host=host['host']) for host in fake.hosts)
+                    db.session.commit()
+                # the first cycle opens the pooled connections, like a collector that just started
+                store_metrics(app)
+                samples = []
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    store_metrics(app)
+                    samples.append(time.perf_counter() - started)
+                with app.app_context():
+                    db.engine.dispose()
+        finally:
+            fake.close()
+        p50, p99 = percentiles(samples)
+        results[f'collection.cycle.hosts_{hosts}.p50'] = result(p50, 'ms')
+        results[f'collection.cycle.hosts_{hosts}.p99'] = result(p99, 'ms')
+        print(f"collection, {hosts} hosts: p50 {p50:.1f} ms, p99 {p99:.1f} ms")
+
+def bench_ingest(results, rows, batch_size=500):
+    for backend in ('sql', 'tsdb'):
+        with tempfile.TemporaryDirectory() as directory:
+            app = bench_app(directory, STORAGE_BACKEND=backend)
+            batches = [batch for batch in metric_rows(rows, 20, batch_size=batch_size)]
+            with app.app_context():
+                started = time.perf_counter()
+                for batch in batches:
+                    write_rows(batch, app)
+                elapsed = time.perf_counter() - started
+                db.engine.dispose()
+        results[f'ingest.{backend}.rows_per_second'] = result(rows / elapsed, 'rows/s', better='higher')
+        print(f"ingest, {backend}: {rows / elapsed:,.0f} rows/s in batches of {batch_size}")
+
+def bench_queries(results, table_sizes, repeat, servers=20):
+    with tempfile.TemporaryDirectory() as directory:
+        app = bench_app(directory)
+        with app.app_context():
+            storage = get_storage()
+            written = 0
+            generator = metric_rows(max(table_sizes), servers)
+            for size in table_sizes:
+                # grow the same table from one size to the next
+                last = None
+                while written < size:
+                    batch = next(generator)
+                    storage.write(batch)
+                    written += len(batch)
+                    last = batch[-1]['timestamp']
+                range_start = last - timedelta(days=1)
+
+                def historical():
+                    historical_metrics('cpu', f'server_{random.randrange(servers)}', range_start, last)
+
+                for name, func in (('historical', historical), ('latest', latest_metrics)):
+                    p50, p99 = time_calls(func, repeat)
+                    results[f'queries.{name}.rows_{size}.p50'] = result(p50, 'ms')
+                    results[f'queries.{name}.rows_{size}.p99'] = result(p99, 'ms')
+                    print(f"{name}_metrics, {size} rows: p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+            db.engine.dispose()
+
+def bench_archive(results, rows, servers=20):
+    with tempfile.TemporaryDirectory() as directory:
+        app = bench_app(directory)
+        with app.app_context():
+            storage = get_storage()
+            for batch in metric_rows(rows, servers):
+                storage.write(batch)
+            for fmt in ('parquet', 'csv'):
+                target = os.path.join(directory, fmt)
+                started = time.perf_counter()
+                export_metrics(target, fmt)
+                exported = rows / (time.perf_counter() - started)
+
+                db.session.execute(MetricLogs.__table__.delete())
+                db.session.commit()
+                started = time.perf_counter()
+                import_metrics([target])
+                imported = rows / (time.perf_counter() - started)
+                results[f'archive.{fmt}.export_rows_per_second'] = result(exported, 'rows/s', better='higher')
+                results[f'archive.{fmt}.import_rows_per_second'] = result(imported, 'rows/s', better='higher')
+                print(f"archive, {fmt}: export {exported:,.0f} rows/s, import {imported:,.0f} rows/s")
+            db.engine.dispose()
+
+def bench_startup(results, runs):
+    with tempfile.TemporaryDirectory() as directory:
+        uri = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for mode, lazy in (('eager', '0'), ('lazy', '1')):
+            samples = []
+            for _ in range(runs):
+                output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, uri, lazy], cwd=root, check=True,
+                                        capture_output=True, text=True).stdout
+                samples.append([float(value) * 1000 for value in output.split()])
+            create = statistics.median(sample[0] for sample in samples)
+            first = statistics.median(sample[1] for sample in samples)
+            results[f'startup.{mode}.create_app'] = result(create, 'ms')
+            results[f'startup.{mode}.first_request'] = result(first, 'ms')
+            print(f"startup, {mode}: create_app {create:.0f} ms, first request {first:.0f} ms")
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    size = 'quick' if args.quick else 'full'
+    random.seed(args.seed)
+    results = {}
+    bench_collection(results, HOST_COUNTS[size], args.repeat, args.latency, args.jitter, args.failure_rate)
+    bench_ingest(results, INGEST_ROWS[size])
+    bench_queries(results, TABLE_SIZES[size], args.repeat)
+    bench_archive(results, ARCHIVE_ROWS[size])
+    bench_startup(results, STARTUP_RUNS[size])
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': args.quick,
+            'seed': args.seed,
+            'fake_netdata': {'latency': args.latency, 'jitter': args.jitter, 'failure_rate': args.failure_rate},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"results written to {args.output}")
+    return report
+
+def compare(base, head, threshold):
+    """ print every shared result with its change, returns the names that got worse by more than threshold """
+    regressions = []
+    print(f"{'benchmark':<44}{'base':>14}{'head':>14}{'change':>10}")
+    for name in sorted(set(base['results']) & set(head['results'])):
+        old, new = base['results'][name], head['results'][name]
+        change = (new['value'] - old['value']) / old['value'] if old['value'] else 0.0
+        worse = change > threshold if new['better'] == 'lower' else change < -threshold
+        if worse:
+            regressions.append(name)
+        print(f"{name:<44}{old['value']:>14.2f}{new['value']:>14.2f}{change:>+10.1%}{'  REGRESSION' if worse else ''}")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the suite')
+    run_parser.add_argument('--quick', action='store_true', help='smaller host counts and table sizes')
+    run_parser.add_argument('--output', help='file to write the JSON results to')
+    run_parser.add_argument('--repeat', type=int, default=10)
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--latency', type=float, default=0.02, help='fake Netdata seconds per request')
+    run_parser.add_argument('--jitter', type=float, default=0.01, help='fake Netdata +/- seconds per request')
+    run_parser.add_argument('--failure-rate', type=float, default=0.01, help='share of fake Netdata requests failing')
+
+    compare_parser = commands.add_parser('compare', help='compare two result files, exits 1 on a regression')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('head')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.head) as f:
+            head = json.load(f)
+        regressions = compare(base, head, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions above {args.threshold:.0%}")
+            sys.exit(1)
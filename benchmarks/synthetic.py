@@ -0,0 +1,32 @@
+"""
+Synthetic metric_logs rows for benchmarks.
+
+* Random walk values with two decimal places, like Netdata reports them
+* Rows come in timestamp order, round robin across servers, in batches like the collector writes them
+"""
+import random
+
+from app.data_retrieval import build_row, utc_from_epoch
+from app.models import METRIC_COLUMNS
+
+# 2025-01-01 00:00:00 UTC
+START_EPOCH = 1735689600
+
+def metric_rows(rows, servers, interval=10, batch_size=50000, seed=1):
+    """ yield batches of at most batch_size rows, `rows` in total, one sample per server every interval seconds """
+    generator = random.Random(seed)
+    levels = {(server, column): generator.uniform(10, 90) for server in range(servers) for column in METRIC_COLUMNS}
+    batch = []
+    for i in range(rows):
+        server = i % servers
+        metrics = {}
+        for column in METRIC_COLUMNS:
+            level = min(100.0, max(0.0, levels[server, column] + generator.gauss(0, 1)))
+            levels[server, column] = level
+            metrics[column] = round(level, 2)
+        batch.append(build_row(f'server_{server}', utc_from_epoch(START_EPOCH + (i // servers) * interval), metrics))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
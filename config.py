@@ -6,7 +6,147 @@ load_dotenv()
 class Config:
     SQLALCHEMY_DATABASE_URI = 'sqlite:///sqlite.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # engine pools: DB_POOL_SIZE connections kept open, DB_MAX_OVERFLOW more under load,
+    # and seconds a request waits for a free one
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '4')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '8')),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', '30')),
+    }
+    # read-only connections metric queries run on in parallel with the writer (match the worker's threads),
+    # and seconds a metric query may run before it is cancelled with a 504 (0 never)
+    DB_READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', '8'))
+    DB_STATEMENT_TIMEOUT_SECONDS = float(os.getenv('DB_STATEMENT_TIMEOUT_SECONDS', '30'))
     SECRET_KEY = os.getenv('SECRET_KEY')
     GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
     GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
     OAUTHLIB_INSECURE_TRANSPORT = os.getenv('OAUTHLIB_INSECURE_TRANSPORT', '1')
+
+    # metric collection limits: fetches in flight overall, per server, and seconds allowed per cycle
+    COLLECTION_MAX_WORKERS = int(os.getenv('COLLECTION_MAX_WORKERS', '32'))
+    COLLECTION_PER_HOST_CONCURRENCY = int(os.getenv('COLLECTION_PER_HOST_CONCURRENCY', '4'))
+    COLLECTION_CYCLE_DEADLINE = float(os.getenv('COLLECTION_CYCLE_DEADLINE', '60'))
+    # fetch all charts of a server in one allmetrics request instead of one request per chart
+    NETDATA_BATCH_FETCH = os.getenv('NETDATA_BATCH_FETCH', '1') == '1'
+
+    # seconds between collections of a server without its own interval
+    COLLECTION_INTERVAL_SECONDS = int(os.getenv('COLLECTION_INTERVAL_SECONDS', '600'))
+    # seconds between runs of the collection job, each run collects the servers that are due
+    # (0 runs it every COLLECTION_INTERVAL_SECONDS; lower it when some servers have shorter intervals)
+    COLLECTION_TICK_SECONDS = int(os.getenv('COLLECTION_TICK_SECONDS', '0'))
+    # collect servers at or above HOST_HOT_CPU_PERCENT cpu HOST_INTERVAL_FACTOR times as often,
+    # and servers at or below HOST_IDLE_CPU_PERCENT that many times less often
+    ADAPTIVE_INTERVALS = os.getenv('ADAPTIVE_INTERVALS', '0') == '1'
+    HOST_HOT_CPU_PERCENT = float(os.getenv('HOST_HOT_CPU_PERCENT', '80'))
+    HOST_IDLE_CPU_PERCENT = float(os.getenv('HOST_IDLE_CPU_PERCENT', '5'))
+    HOST_INTERVAL_FACTOR = float(os.getenv('HOST_INTERVAL_FACTOR', '2'))
+    # skip a server after this many failed cycles in a row, probing it again after a backoff
+    # that doubles with every failed probe
+    CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '3'))
+    CIRCUIT_BACKOFF_SECONDS = float(os.getenv('CIRCUIT_BACKOFF_SECONDS', '60'))
+    CIRCUIT_MAX_BACKOFF_SECONDS = float(os.getenv('CIRCUIT_MAX_BACKOFF_SECONDS', '3600'))
+    # store every point Netdata holds since the last collection instead of one sample per cycle,
+    # going back at most HIGH_RESOLUTION_MAX_BACKFILL seconds for a server with no stored rows
+    HIGH_RESOLUTION = os.getenv('HIGH_RESOLUTION', '0') == '1'
+    HIGH_RESOLUTION_MAX_BACKFILL = int(os.getenv('HIGH_RESOLUTION_MAX_BACKFILL', '3600'))
+
+    # JSON list of extra Netdata charts to collect and how to derive a value from them (see app.metric_spec),
+    # stored as narrow series in metric_samples; unset collects only the built-in metric_logs columns
+    METRIC_SPEC_PATH = os.getenv('METRIC_SPEC_PATH')
+
+    # alert rules evaluated on every committed batch of rows (see app.alerting), ALERT_RULES_PATH is a JSON
+    # list of rules replacing the built-in disk and memory ones; ALERT_SINKS lists where alerts are sent
+    ALERTING = os.getenv('ALERTING', '1') == '1'
+    ALERT_RULES_PATH = os.getenv('ALERT_RULES_PATH')
+    ALERT_SINKS = os.getenv('ALERT_SINKS', 'log')
+    # samples per host kept for rate, zscore and ewma rules, and seconds between repeats of a firing alert (0 never)
+    ALERT_WINDOW = int(os.getenv('ALERT_WINDOW', '60'))
+    ALERT_REPEAT_SECONDS = int(os.getenv('ALERT_REPEAT_SECONDS', '0'))
+    ALERT_WEBHOOK_URL = os.getenv('ALERT_WEBHOOK_URL')
+    ALERT_EMAIL_HOST = os.getenv('ALERT_EMAIL_HOST')
+    ALERT_EMAIL_PORT = int(os.getenv('ALERT_EMAIL_PORT', '25'))
+    ALERT_EMAIL_STARTTLS = os.getenv('ALERT_EMAIL_STARTTLS', '0') == '1'
+    ALERT_EMAIL_USER = os.getenv('ALERT_EMAIL_USER')
+    ALERT_EMAIL_PASSWORD = os.getenv('ALERT_EMAIL_PASSWORD')
+    ALERT_EMAIL_FROM = os.getenv('ALERT_EMAIL_FROM')
+    # comma separated recipients
+    ALERT_EMAIL_TO = os.getenv('ALERT_EMAIL_TO')
+
+    # seconds between rollup compactions, and days each tier is kept (0 keeps it forever)
+    ROLLUP_INTERVAL_SECONDS = int(os.getenv('ROLLUP_INTERVAL_SECONDS', '60'))
+    RAW_RETENTION_DAYS = int(os.getenv('RAW_RETENTION_DAYS', '30'))
+    ROLLUP_1M_RETENTION_DAYS = int(os.getenv('ROLLUP_1M_RETENTION_DAYS', '90'))
+    ROLLUP_1H_RETENTION_DAYS = int(os.getenv('ROLLUP_1H_RETENTION_DAYS', '730'))
+    ROLLUP_1D_RETENTION_DAYS = int(os.getenv('ROLLUP_1D_RETENTION_DAYS', '0'))
+
+    # seconds a worker serves its latest metrics snapshot without re-reading it, in case it missed an update
+    LATEST_CACHE_TTL = int(os.getenv('LATEST_CACHE_TTL', '60'))
+    # serve /api/stream and /api/ws, and subscribe the dashboard to them: 'auto' only under an async (gevent)
+    # worker, where a waiting client holds a greenlet rather than a thread; otherwise the dashboard polls
+    # /api/current_metrics every DASHBOARD_POLL_SECONDS
+    LIVE_STREAM = os.getenv('LIVE_STREAM', 'auto')
+    DASHBOARD_POLL_SECONDS = int(os.getenv('DASHBOARD_POLL_SECONDS', '15'))
+
+    # newest HOT_TIER_POINTS samples of every server kept in memory for recent historical queries, within
+    # HOT_TIER_MEMORY_MB in total (0 turns it off); the last HOT_TIER_WARM_HOURS are loaded at startup, and
+    # the tier is only read while a batch arrived in the last HOT_TIER_MAX_AGE seconds (0: twice the collection
+    # tick plus INGEST_POLL_SECONDS)
+    HOT_TIER_MEMORY_MB = float(os.getenv('HOT_TIER_MEMORY_MB', '64'))
+    HOT_TIER_POINTS = int(os.getenv('HOT_TIER_POINTS', '8640'))
+    HOT_TIER_WARM_HOURS = float(os.getenv('HOT_TIER_WARM_HOURS', '24'))
+    HOT_TIER_MAX_AGE = int(os.getenv('HOT_TIER_MAX_AGE', '0'))
+
+    # capacity forecasts: FORECAST_LOOKBACK_DAYS of FORECAST_BUCKET_SECONDS averages, projected up to
+    # FORECAST_HORIZON_DAYS ahead with a FORECAST_SEASON_SECONDS season, towards the default thresholds (percent);
+    # cached until new rows are committed, or FORECAST_CACHE_TTL seconds
+    FORECAST_LOOKBACK_DAYS = float(os.getenv('FORECAST_LOOKBACK_DAYS', '14'))
+    FORECAST_BUCKET_SECONDS = int(os.getenv('FORECAST_BUCKET_SECONDS', '3600'))
+    FORECAST_SEASON_SECONDS = int(os.getenv('FORECAST_SEASON_SECONDS', '86400'))
+    FORECAST_HORIZON_DAYS = float(os.getenv('FORECAST_HORIZON_DAYS', '90'))
+    FORECAST_DISK_THRESHOLD = float(os.getenv('FORECAST_DISK_THRESHOLD', '90'))
+    FORECAST_MEMORY_THRESHOLD = float(os.getenv('FORECAST_MEMORY_THRESHOLD', '95'))
+    FORECAST_CACHE_TTL = int(os.getenv('FORECAST_CACHE_TTL', '600'))
+
+    # this collector's shard of the registered servers, out of COLLECTOR_SHARD_COUNT collectors
+    COLLECTOR_SHARD_COUNT = int(os.getenv('COLLECTOR_SHARD_COUNT', '1'))
+    COLLECTOR_SHARD_INDEX = int(os.getenv('COLLECTOR_SHARD_INDEX', '0'))
+    # seconds a scheduler lease is held without renewal, 0 uses twice the job's interval
+    LEASE_TTL = int(os.getenv('LEASE_TTL', '0'))
+
+    # start the scheduled jobs (ingest watch, collection, rollups, retention) in this process; 0 for processes
+    # that only serve requests next to one that runs them. `flask` commands other than `flask run` never do
+    RUN_SCHEDULER = os.getenv('RUN_SCHEDULER', '1') == '1'
+    # set up OAuth on the first login, Flask-Migrate only for `flask` commands, and the blueprints on the first
+    # request, instead of in create_app
+    LAZY_STARTUP = os.getenv('LAZY_STARTUP', '1') == '1'
+    # create missing tables with db.create_all at startup, instead of with `flask db upgrade`
+    CREATE_SCHEMA = os.getenv('CREATE_SCHEMA', '0') == '1'
+
+    # run collection inside the web app, set to 0 when `python -m app.collector` runs as its own process;
+    # every scheduler process checks for rows written by other processes every INGEST_POLL_SECONDS
+    RUN_COLLECTOR = os.getenv('RUN_COLLECTOR', '1') == '1'
+    INGEST_POLL_SECONDS = int(os.getenv('INGEST_POLL_SECONDS', '5'))
+
+    # buffer collected rows in a journaled queue drained by one writer thread in batches,
+    # instead of inserting them from the collection cycle; the journal defaults to instance/ingest.journal
+    # and is rewritten without its committed entries once they take INGEST_JOURNAL_COMPACT_MB
+    INGEST_QUEUE = os.getenv('INGEST_QUEUE', '1') == '1'
+    INGEST_JOURNAL_PATH = os.getenv('INGEST_JOURNAL_PATH')
+    INGEST_QUEUE_MAX_ROWS = int(os.getenv('INGEST_QUEUE_MAX_ROWS', '50000'))
+    INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '500'))
+    INGEST_FLUSH_SECONDS = float(os.getenv('INGEST_FLUSH_SECONDS', '1'))
+    INGEST_PUT_TIMEOUT = float(os.getenv('INGEST_PUT_TIMEOUT', '5'))
+    INGEST_JOURNAL_COMPACT_MB = float(os.getenv('INGEST_JOURNAL_COMPACT_MB', '16'))
+
+    # where metric samples are stored: 'sql' (metric_logs and rollup tables) or 'tsdb' (compressed chunks
+    # under TSDB_PATH, instance/tsdb by default, sealed every TSDB_CHUNK_POINTS samples per server)
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sql')
+    TSDB_PATH = os.getenv('TSDB_PATH')
+    TSDB_CHUNK_POINTS = int(os.getenv('TSDB_CHUNK_POINTS', '1024'))
+
+    # bearer token required by /metrics when set, /metrics/profile needs an admin login instead;
+    # cycle profiles are written to PROFILE_DIR (instance/profiles by default) with cProfile,
+    # or pyinstrument when PROFILER=pyinstrument
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    PROFILE_DIR = os.getenv('PROFILE_DIR')
+    PROFILER = os.getenv('PROFILER', 'cprofile')
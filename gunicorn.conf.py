@@ -0,0 +1,22 @@
+"""
+Gunicorn settings: `gunicorn -c gunicorn.conf.py "app:create_app()"`.
+
+* gthread workers: SQLite releases the GIL, so the threads of a worker read in parallel on the read-only
+  connection pool (DB_READ_POOL_SIZE, keep it at least GUNICORN_THREADS), and dashboards poll
+  /api/current_metrics rather than stream (LIVE_STREAM)
+* GUNICORN_WORKER_CLASS=gevent opts into live streams (/api/stream, /api/ws): each client waits in a
+  greenlet, but sqlite3 is not patched by gevent, so a metric query blocks every greenlet of its worker
+  while it runs, bounded by DB_STATEMENT_TIMEOUT_SECONDS
+* Collection jobs run in every worker, scheduler leases make sure only one of them runs each job
+"""
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', 'unix:/run/flask.sock')
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('GUNICORN_WORKERS', str(min(4, multiprocessing.cpu_count()))))
+# concurrent clients per gevent worker, open live streams included
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+# a little above DB_STATEMENT_TIMEOUT_SECONDS, so slow queries end with a 504 rather than a killed worker
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
@@ -0,0 +1,50 @@
+"""merge duplicate metric_logs samples and make machine_name timestamp unique
+
+Revision ID: 0008_metric_logs_unique_sample
+Revises: 0007_rollup_state
+Create Date: 2026-10-20 10:41:27.903816
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008_metric_logs_unique_sample'
+down_revision = '0007_rollup_state'
+branch_labels = None
+depends_on = None
+
+METRIC_COLUMNS = ('cpu_usage', 'memory_usage', 'disk_usage', 'network_received', 'network_sent')
+
+
+def upgrade():
+    # late high resolution points used to be stored as extra rows holding only their chart's columns,
+    # fold them into the first row of their sample before the index makes samples unique
+    duplicated = '''
+        SELECT MIN(id) FROM metric_logs GROUP BY machine_name, timestamp HAVING COUNT(*) > 1
+    '''
+    for column in METRIC_COLUMNS:
+        op.execute(f'''
+            UPDATE metric_logs SET {column} = (
+                SELECT late.{column} FROM metric_logs AS late
+                WHERE late.machine_name = metric_logs.machine_name AND late.timestamp = metric_logs.timestamp
+                AND late.{column} IS NOT NULL
+                ORDER BY late.id DESC LIMIT 1
+            )
+            WHERE {column} IS NULL AND id IN ({duplicated})
+        ''')
+    op.execute('''
+        DELETE FROM metric_logs
+        WHERE id NOT IN (SELECT MIN(id) FROM metric_logs GROUP BY machine_name, timestamp)
+    ''')
+
+    with op.batch_alter_table('metric_logs', schema=None) as batch_op:
+        batch_op.drop_index('ix_metric_logs_machine_name_timestamp')
+        batch_op.create_index('ix_metric_logs_machine_name_timestamp', ['machine_name', 'timestamp'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('metric_logs', schema=None) as batch_op:
+        batch_op.drop_index('ix_metric_logs_machine_name_timestamp')
+        batch_op.create_index('ix_metric_logs_machine_name_timestamp', ['machine_name', 'timestamp'], unique=False)
@@ -1,10 +1,6 @@
 from app import create_app
-from app.models import db
 
 app = create_app()
 
-with app.app_context():
-    db.create_all()
-
 if __name__ == '__main__':
-    app.run(debug=True, port=8000)
\ No newline at end of file
+    app.run(debug=True, port=8000)
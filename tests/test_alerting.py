@@ -0,0 +1,86 @@
+from app.alerting import AlertEngine, MemorySink, Rule, load_rules
+from datetime import datetime, timedelta
+import unittest
+
+
+def row(host, timestamp, **metrics):
+    return {'machine_name': host, 'timestamp': timestamp, 'cpu_usage': None, 'memory_usage': None,
+            'disk_usage': None, 'network_received': None, 'network_sent': None, **metrics}
+
+
+class TestAlerting(unittest.TestCase):
+    # setUp(): an engine notifying a memory sink
+    def setUp(self):
+        self.sink = MemorySink()
+        self.start = datetime(2025, 1, 1)
+
+    def feed(self, engine, values, column, step=10):
+        """ one batch per cycle, values is a list of {host: value} """
+        for i, cycle in enumerate(values):
+            timestamp = self.start + timedelta(seconds=i * step)
+            engine.on_rows([row(host, timestamp, **{column: value}) for host, value in cycle.items()])
+
+    ## threshold rule test
+    def test_threshold_hysteresis_and_dedup(self):
+        """
+        Tests:
+            * a threshold alert fires after `for` breaches and resolves below the hysteresis band
+
+        Asserts:
+            * a single breach does not fire, the second one in a row does, once
+            * values inside the hysteresis band keep it firing without new notifications
+            * a missing value leaves the alert as it is, falling below the band resolves it once
+        """
+        rule = Rule("disk_full", "disk_usage", "threshold", 90, hysteresis=5, **{"for": 2})
+        engine = AlertEngine([rule], [self.sink])
+
+        self.feed(engine, [{"a": 95, "b": 10}, {"a": 50, "b": 10}, {"a": 95, "b": 10}, {"a": 96, "b": 10},
+                           {"a": 92, "b": 10}, {"a": 86, "b": 10}, {"a": None, "b": 10}, {"a": 80, "b": 10},
+                           {"a": 70, "b": 10}], 'disk_usage')
+
+        self.assertEqual([(alert['host'], alert['state'], alert['observed']) for alert in self.sink.alerts],
+                         [("a", "firing", 96.0), ("a", "resolved", 80.0)])
+
+    ## rate, zscore and ewma rules test
+    def test_anomaly_rules(self):
+        """
+        Tests:
+            * rate, zscore and ewma rules judge every host from its own ring buffer
+
+        Asserts:
+            * only the host with a spike alerts, on every anomaly rule
+            * hosts with too little history are not judged
+        """
+        engine = AlertEngine([
+            Rule("cpu_jump", "cpu_usage", "rate", 1),
+            Rule("cpu_zscore", "cpu_usage", "zscore", 4),
+            Rule("cpu_ewma", "cpu_usage", "ewma", 4, alpha=0.2),
+        ], [self.sink], window=30)
+
+        steady = [{f"host_{h}": 20 + (i + h) % 3 for h in range(50)} for i in range(25)]
+        spike = {f"host_{h}": 20 + (25 + h) % 3 for h in range(50)}
+        spike["host_7"] = 95
+        spike["new_host"] = 99
+        self.feed(engine, steady + [spike], 'cpu_usage')
+
+        fired = sorted((alert['rule'], alert['host']) for alert in self.sink.alerts if alert['state'] == 'firing')
+        self.assertEqual(fired, [("cpu_ewma", "host_7"), ("cpu_jump", "host_7"), ("cpu_zscore", "host_7")])
+
+    ## load_rules() test
+    def test_invalid_rules(self):
+        """
+        Tests:
+            * rule definitions are validated when they are loaded
+
+        Asserts:
+            * the default rules load, an unknown column or kind is rejected
+        """
+        self.assertTrue(load_rules({}))
+        with self.assertRaises(ValueError):
+            Rule("bad", "load", "threshold", 1)
+        with self.assertRaises(ValueError):
+            Rule("bad", "cpu_usage", "median", 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+from app import create_app, scheduler
+from app.auth import google_client
+from app.models import db
+from config import Config
+from sqlalchemy import inspect
+import unittest
+
+
+class TestConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    GOOGLE_CLIENT_ID = 'client-id'
+    GOOGLE_CLIENT_SECRET = 'client-secret'
+    RUN_SCHEDULER = False
+
+
+class TestCreateApp(unittest.TestCase):
+
+    ## create_app() lazy startup test
+    def test_lazy_startup(self):
+        """
+        Tests:
+            * create_app with LAZY_STARTUP and without RUN_SCHEDULER, outside the flask CLI
+
+        Asserts:
+            * no scheduler, OAuth, Flask-Migrate or tables at startup
+            * the blueprints are registered by the first request
+            * the OAuth client is registered on first use
+        """
+        app = create_app(TestConfig)
+
+        self.assertFalse(scheduler.running)
+        self.assertNotIn('migrate', app.extensions)
+        self.assertNotIn('authlib.integrations.flask_client', app.extensions)
+        with app.app_context():
+            self.assertEqual(inspect(db.engine).get_table_names(), [])
+        self.assertNotIn('main', app.blueprints)
+
+        self.assertEqual(app.test_client().get('/').status_code, 200)
+        self.assertIn('api', app.blueprints)
+
+        with app.test_request_context():
+            self.assertEqual(google_client().client_id, 'client-id')
+            self.assertIs(google_client(), google_client())
+
+    ## create_app() eager startup test
+    def test_eager_startup(self):
+        """
+        Tests:
+            * create_app with LAZY_STARTUP off and CREATE_SCHEMA on
+
+        Asserts:
+            * extensions, blueprints and tables are all set up by create_app
+        """
+        config = type('EagerConfig', (TestConfig,), {'LAZY_STARTUP': False, 'CREATE_SCHEMA': True})
+        app = create_app(config)
+
+        self.assertIn('migrate', app.extensions)
+        self.assertIn('authlib.integrations.flask_client', app.extensions)
+        self.assertIn('api', app.blueprints)
+        with app.app_context():
+            self.assertIn('metric_logs', inspect(db.engine).get_table_names())
+
+    ## admin views access test
+    def test_admin_views_need_admin(self):
+        """
+        Tests:
+            * the Flask-Admin index, user and server views opened without logging in
+
+        Asserts:
+            * every view redirects to the unauthorized page instead of listing or editing rows
+        """
+        config = type('EagerConfig', (TestConfig,), {'LAZY_STARTUP': False, 'CREATE_SCHEMA': True})
+        client = create_app(config).test_client()
+
+        for path in ('/admin/', '/admin/user/', '/admin/server/', '/admin/server/new/'):
+            response = client.get(path)
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(response.location.endswith('/unauthorized'))
+
+
+if __name__ == "__main__":
+    unittest.main()
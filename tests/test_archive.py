@@ -0,0 +1,102 @@
+from app.archive import export_metrics, import_metrics, iter_export_tar
+from app.cli import metrics_cli
+from app.data_retrieval import build_row, write_rows
+from app.models import db
+from app.storage import get_storage
+from datetime import datetime, timedelta
+from flask import Flask
+from sqlalchemy import text
+import os
+import tempfile
+import unittest
+
+
+class TestArchive(unittest.TestCase):
+    # setUp(): two servers with a sample every 20 minutes over two days, some values missing
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.init_app(self.app)
+        self.app.cli.add_command(metrics_cli)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        self.start = datetime(2025, 4, 22)
+        self.end = datetime(2025, 4, 24)
+        write_rows([
+            build_row(server, self.start + timedelta(minutes=20 * i, microseconds=i),
+                      {'cpu_usage': i / 3, 'disk_usage': None if i % 7 else 50.0, 'network_sent': float(i)})
+            for i in range(144) for server in ("server_1", "web/2")
+        ])
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def stored(self):
+        columns = ['cpu_usage', 'memory_usage', 'disk_usage', 'network_received', 'network_sent']
+        return get_storage().raw(["server_1", "web/2"], columns, self.start, self.end)
+
+    def reset(self):
+        db.drop_all()
+        db.create_all()
+
+    ## export_metrics() and import_metrics() test
+    def test_round_trip(self):
+        """
+        Tests:
+            * every sample exported as Parquet and gzip CSV, then imported into an empty database
+
+        Asserts:
+            * one file per server and day, server names escaped into one path segment
+            * the imported samples equal the exported ones, missing values included
+            * the imported samples are compacted into the rollup tiers
+        """
+        original = self.stored()
+        for fmt, extension in (('parquet', '.parquet'), ('csv', '.csv.gz')):
+            directory = os.path.join(self.directory.name, fmt)
+            self.assertEqual(export_metrics(directory, fmt, chunk_size=50), {'files': 4, 'rows': 288})
+            self.assertTrue(os.path.exists(os.path.join(directory, 'machine_name=web%2F2', 'date=2025-04-23',
+                                                        f'part-0{extension}')))
+
+            self.reset()
+            self.assertEqual(import_metrics([directory], chunk_size=100), {'files': 4, 'rows': 288})
+            self.assertEqual(self.stored(), original)
+            self.assertEqual(db.session.execute(text('SELECT COUNT(*) FROM metric_rollup_1d')).scalar(), 4)
+
+    ## iter_export_tar() and the CLI test
+    def test_tar_stream_and_cli(self):
+        """
+        Tests:
+            * the tar stream of the export endpoint, imported with `flask metrics import`
+            * `flask metrics export` for one server
+
+        Asserts:
+            * the tar holds every partition and imports back to the same samples
+            * the CLI only exports the requested server
+        """
+        original = self.stored()
+        path = os.path.join(self.directory.name, 'metrics.tar')
+        with open(path, 'wb') as f:
+            for piece in iter_export_tar('csv', chunk_size=50):
+                f.write(piece)
+
+        self.reset()
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['metrics', 'import', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Imported 288 rows from 4 files", result.output)
+        self.assertEqual(self.stored(), original)
+
+        result = runner.invoke(args=['metrics', 'export', os.path.join(self.directory.name, 'one'),
+                                     '--format', 'csv', '--server', 'server_1'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(os.listdir(os.path.join(self.directory.name, 'one')), ['machine_name=server_1'])
+
+
+if __name__ == "__main__":
+    unittest.main()
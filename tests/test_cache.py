@@ -0,0 +1,83 @@
+from app.cache import SnapshotCache
+from app.data_retrieval import build_row, utc_from_epoch, write_rows
+from app.metric_collector import latest_cache
+from app.models import db
+from app.routes import api
+from flask import Flask
+from unittest.mock import MagicMock
+import unittest
+
+
+class TestSnapshotCache(unittest.TestCase):
+    ## SnapshotCache test
+    def test_snapshot_cache(self):
+        """
+        Tests:
+            * lazy loading, merging and ETags of the snapshot cache
+
+        Asserts:
+            * the loader only runs once while the snapshot is fresh
+            * merging new values changes the ETag, identical content keeps it
+        """
+        loader = MagicMock(return_value={"server_1": {"cpu_usage": 1.0}})
+        cache = SnapshotCache(loader)
+
+        snapshot, etag = cache.get()
+        self.assertEqual(cache.get(), (snapshot, etag))
+        loader.assert_called_once()
+
+        cache.update({"server_2": {"cpu_usage": 2.0}})
+        merged, merged_etag = cache.get()
+        self.assertEqual(set(merged), {"server_1", "server_2"})
+        self.assertNotEqual(merged_etag, etag)
+
+        cache.update({"server_2": {"cpu_usage": 2.0}})
+        self.assertEqual(cache.get()[1], merged_etag)
+
+
+class TestCurrentMetrics(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.init_app(self.app)
+        self.app.register_blueprint(api)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        latest_cache.invalidate()
+
+    def tearDown(self):
+        latest_cache.invalidate()
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    ## /api/current_metrics test
+    def test_current_metrics_etag(self):
+        """
+        Tests:
+            * conditional polling of /api/current_metrics
+
+        Asserts:
+            * a poll with the current ETag gets a 304 with no body
+            * committing new rows updates the snapshot and its ETag
+        """
+        write_rows([build_row("server_1", utc_from_epoch(1745376000), {'cpu_usage': 12.345})])
+        client = self.app.test_client()
+
+        first = client.get('/api/current_metrics')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.get_json()["server_1"]["cpu_usage"], 12.35)
+
+        unchanged = client.get('/api/current_metrics', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(unchanged.data, b'')
+
+        write_rows([build_row("server_1", utc_from_epoch(1745376600), {'cpu_usage': 50.0})])
+        changed = client.get('/api/current_metrics', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.get_json()["server_1"]["cpu_usage"], 50.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+from app import ingest
+from app.collector import run
+from app.data_retrieval import build_row, utc_from_epoch
+from app.models import MetricLogs, db
+from flask import Flask
+from unittest.mock import patch
+import os
+import subprocess
+import sys
+import threading
+import unittest
+
+
+class TestCollector(unittest.TestCase):
+    # setUp(): empty in-memory database and no ingest listeners
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        self.listeners = list(ingest.listeners)
+        self.local_listeners = list(ingest.local_listeners)
+        ingest.listeners.clear()
+        ingest.local_listeners.clear()
+        ingest.last_seen_id = None
+
+    def tearDown(self):
+        ingest.listeners[:] = self.listeners
+        ingest.local_listeners[:] = self.local_listeners
+        ingest.last_seen_id = None
+        ingest.own_rows.clear()
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    ## poll_committed_rows() test
+    def test_poll_committed_rows(self):
+        """
+        Tests:
+            * rows written by another process reach the web tier's ingest listeners
+
+        Asserts:
+            * the first poll only records the newest row
+            * later polls hand each new row to listeners once, in listener row format
+        """
+        received = []
+        ingest.register(received.extend)
+        table = MetricLogs.__table__
+
+        db.session.execute(table.insert(), [build_row("server_1", utc_from_epoch(1745366400), {'cpu_usage': 1.0})])
+        db.session.commit()
+        self.assertEqual(ingest.poll_committed_rows(), 0)
+
+        db.session.execute(table.insert(), [build_row("server_2", utc_from_epoch(1745366460), {'cpu_usage': 2.0})])
+        db.session.commit()
+        self.assertEqual(ingest.poll_committed_rows(), 1)
+        self.assertEqual(ingest.poll_committed_rows(), 0)
+
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0]['machine_name'], "server_2")
+        self.assertEqual(received[0]['timestamp'], utc_from_epoch(1745366460))
+        self.assertEqual(received[0]['cpu_usage'], 2.0)
+
+    ## writing() test
+    def test_poll_skips_own_rows(self):
+        """
+        Tests:
+            * a process both writing rows and polling for the rows of other processes
+
+        Asserts:
+            * rows written by the process reach its listeners once, when committed
+            * polls only hand over the rows other processes wrote
+            * local listeners never get polled rows
+        """
+        received, local = [], []
+        ingest.register(received.extend)
+        ingest.register(local.extend, local=True)
+        table = MetricLogs.__table__
+        self.assertEqual(ingest.poll_committed_rows(), 0)
+
+        own = [build_row("server_1", utc_from_epoch(1745366400), {'cpu_usage': 1.0})]
+        with ingest.writing() as written:
+            db.session.execute(table.insert(), own)
+            db.session.commit()
+            written.extend(own)
+        db.session.execute(table.insert(), [build_row("server_2", utc_from_epoch(1745366400), {'cpu_usage': 2.0})])
+        db.session.commit()
+
+        self.assertEqual(ingest.poll_committed_rows(), 1)
+        self.assertEqual([row['machine_name'] for row in received], ["server_1", "server_2"])
+        self.assertEqual([row['machine_name'] for row in local], ["server_1"])
+        self.assertEqual(ingest.own_rows, set())
+
+    ## run() test
+    @patch('app.collector.store_metrics')
+    def test_run_survives_failed_cycle(self, mock_store_metrics):
+        """
+        Tests:
+            * the collector loop keeps going after a cycle raises
+
+        Asserts:
+            * store_metrics is called with the collector's app until stop is set
+
+        Mocking:
+            * store_metrics - fails once, then stops the loop
+        """
+        stop = threading.Event()
+        calls = []
+
+        def cycle(app):
+            calls.append(app)
+            if len(calls) == 1:
+                raise RuntimeError("netdata down")
+            stop.set()
+
+        mock_store_metrics.side_effect = cycle
+        run(self.app, 0, stop)
+
+        self.assertEqual(mock_store_metrics.call_count, 2)
+        mock_store_metrics.assert_called_with(self.app)
+
+    ## collector import test
+    def test_import_stays_light(self):
+        """
+        Tests:
+            * importing the standalone collector in a fresh interpreter
+
+        Asserts:
+            * numpy, alerting, the hot tier and the tsdb backend are not imported until they are used
+        """
+        heavy = ('numpy', 'app.alerting', 'app.hot_tier', 'app.storage.tsdb')
+        code = f"import sys, app.collector; print(' '.join(m for m in {heavy!r} if m in sys.modules))"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '')
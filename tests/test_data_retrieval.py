@@ -1,6 +1,12 @@
-from app.data_retrieval import get_data, store_metrics
-from app.models import MetricLogs
+from app.data_retrieval import get_data, get_charts, store_metrics, collect_all, build_series_rows, due_servers
+from app.data_retrieval import advance_high_water_marks, load_high_water_marks, _high_water
+from app.host_health import CLOSED, HALF_OPEN, OPEN, HostHealth, health
+from datetime import datetime
+import time
+import requests
 from unittest.mock import patch, MagicMock
+import tempfile
+import threading
 import unittest
 
 
@@ -37,8 +43,8 @@ class TestDataRetrieval(unittest.TestCase):
 
     ## get_data() test
     ## patch decorates func with the method being mocked
-    @patch('app.data_retrieval.requests.get')   
-    def test_get_data(self, mock_get):
+    @patch('app.data_retrieval.get_session')
+    def test_get_data(self, mock_get_session):
         """ 
         Tests:
             * netapi data retrieval
@@ -48,8 +54,9 @@ class TestDataRetrieval(unittest.TestCase):
             * get_data correctly requesting the url 
 
         Mocking: 
-            * requests.get - mocking a url response, returning test data instead 
+            * get_session - mocking the pooled session's url response, returning test data instead 
         """
+        mock_get = mock_get_session.return_value.get
 
         mock_response = MagicMock()
         # set the mock responses json value to the test data
@@ -68,12 +75,45 @@ class TestDataRetrieval(unittest.TestCase):
         # assert mocked response came from the correct url 
         expected_url = "http://45.79.180.177:19999/api/v1/data?chart=system.cpu&points=1&format=json"
         mock_get.assert_called_with(expected_url, timeout=5)
+
+    ## get_charts() test
+    @patch('app.data_retrieval.get_session')
+    def test_get_charts(self, mock_get_session):
+        """
+        Tests:
+            * batched allmetrics retrieval of several charts in one request
+
+        Asserts:
+            * dimension values come back in the order the metric computations expect
+            * charts the host did not report are left out
+            * only one request is made
+
+        Mocking:
+            * get_session - returns an allmetrics style response
+        """
+        mock_response = MagicMock()
+        mock_response.json.return_value = {
+            "system.net": {"dimensions": {"sent": {"name": "sent", "value": -16.5},
+                                          "received": {"name": "received", "value": 15.5}}},
+            "system.cpu": {"dimensions": {"user": {"name": "user", "value": 6},
+                                          "system": {"name": "system", "value": 3}}}
+        }
+        mock_get = mock_get_session.return_value.get
+        mock_get.return_value = mock_response
+
+        test_output = get_charts("http://45.79.180.177:19999", ("system.cpu", "system.net", "system.ram"))
+
+        self.assertEqual(test_output, {"system.cpu": [6, 3], "system.net": [15.5, -16.5]})
+        mock_get.assert_called_once()
+        self.assertEqual(mock_get.call_args.args[0], "http://45.79.180.177:19999/api/v1/allmetrics")
     
     ## store_metrics() test
-    @patch('app.data_retrieval.scheduler.app.app_context')
+    @patch('app.data_retrieval.acquire_lease', return_value=True)
+    @patch('app.data_retrieval.get_servers')
+    @patch('app.data_retrieval.scheduler')
     @patch('app.data_retrieval.db.session')
     @patch('app.data_retrieval.get_data')
-    def test_store_metrics(self, mock_get_data, mock_db_session, mock_app_context):
+    def test_store_metrics(self, mock_get_data, mock_db_session, mock_scheduler, mock_get_servers, mock_acquire_lease):
         """
         Tests:
             * correct arithmetic is being done on data 
@@ -82,76 +122,220 @@ class TestDataRetrieval(unittest.TestCase):
         Asserts:
             * data operations are correct between test data and store metrics function
             # data is being stored correctly 
-            * db.session.add is called adding metric logs to db 
+            * one bulk insert adds a metric log row for every server
             * db session is being committed
         Mocking:
             * get_data function
             * db.session
-            * app_context
+            * scheduler app and its config
+            * get_servers and acquire_lease - two registered servers, lease always granted
         """
-        mock_context = MagicMock()
-        mock_app_context.return_value.__enter__.return_value = mock_context 
+        mock_scheduler.app.config = {'NETDATA_BATCH_FETCH': False, 'PROFILE_DIR': tempfile.gettempdir()}
+        mock_get_servers.return_value = [{"name": "server_1", "host": "secret"}, {"name": "server_2", "host": "secret"}]
 
-        # list to capture all created MetricLogs instances
-        mock_log_instances = []
-
-        def create_mock_log(*args, **kwargs):
-            mock = MagicMock()
-            mock.configure_mock(**kwargs)
-            mock_log_instances.append(mock)
-            return mock
-        
-        with patch('app.data_retrieval.MetricLogs', side_effect=create_mock_log):
         # configure mock_get_data to return different values based on chart parameter
-            def mock_get_data_side_effect(host, chart, points=1):
-                if chart == "system.cpu":
-                    return self.cpu_data['data'][0][1:]
-                elif chart == "system.net":
-                    return self.network_data['data'][0][1:]
-                elif chart == "system.ram":
-                    return self.mem_data['data'][0][1:]
-                elif chart == "disk_space./":
-                    return self.disk_data['data'][0][1:]
-                return None
-            
-        
+        def mock_get_data_side_effect(host, chart, points=1):
+            if chart == "system.cpu":
+                return self.cpu_data['data'][0][1:]
+            elif chart == "system.net":
+                return self.network_data['data'][0][1:]
+            elif chart == "system.ram":
+                return self.mem_data['data'][0][1:]
+            elif chart == "disk_space./":
+                return self.disk_data['data'][0][1:]
+            return None
+
         mock_get_data.side_effect = mock_get_data_side_effect
 
         store_metrics()
 
-        # check that appropriate metric logs were created for each server
-        self.assertEqual(len(mock_log_instances), 2)
-        self.assertEqual(mock_log_instances[0].machine_name, "server_1")
-        self.assertEqual(mock_log_instances[1].machine_name, "server_2")
+        # check that a single bulk insert was made with a row for each server
+        mock_db_session.execute.assert_called_once()
+        rows = mock_db_session.execute.call_args.args[1]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['machine_name'], "server_1")
+        self.assertEqual(rows[1]['machine_name'], "server_2")
         
         # Test CPU Usage calculation
         expected_cpu_usage = sum(self.cpu_data['data'][0][1:])
-        self.assertEqual(mock_log_instances[0].cpu_usage, expected_cpu_usage)
+        self.assertEqual(rows[0]['cpu_usage'], expected_cpu_usage)
         
         # Test Network metrics
         expected_received = self.network_data['data'][0][1] 
         expected_sent = abs(self.network_data['data'][0][2]) 
-        self.assertEqual(mock_log_instances[0].network_received, expected_received)
-        self.assertEqual(mock_log_instances[0].network_sent, expected_sent)
+        self.assertEqual(rows[0]['network_received'], expected_received)
+        self.assertEqual(rows[0]['network_sent'], expected_sent)
         
         # Test Memory Usage calculation
         used = self.mem_data['data'][0][2]  
         total = sum(self.mem_data['data'][0][1:])  
         expected_memory_percent = (used / total) * 100
-        self.assertAlmostEqual(mock_log_instances[0].memory_usage, expected_memory_percent, places=2)
+        self.assertAlmostEqual(rows[0]['memory_usage'], expected_memory_percent, places=2)
         
         # Test Disk Usage calculation
         disk_total = sum(self.disk_data['data'][0][1:])  
         disk_used = sum(self.disk_data['data'][0][2:])  
         expected_disk_percent = (disk_used / disk_total) * 100 
-        self.assertAlmostEqual(mock_log_instances[0].disk_usage, expected_disk_percent, places=2)
-        
-        # Check that db.session.add was called twice, once for each serevr 
-        self.assertEqual(mock_db_session.add.call_count, 2)
+        self.assertAlmostEqual(rows[0]['disk_usage'], expected_disk_percent, places=2)
         
         # Ensure commit was called 
         mock_db_session.commit.assert_called_once()
 
+    ## build_series_rows() test
+    def test_build_series_rows(self):
+        """
+        Tests:
+            * high resolution series from several charts are aligned by timestamp
+
+        Asserts:
+            * one row per distinct timestamp, oldest first
+            * charts missing at a timestamp leave their columns empty
+        """
+        chart_series = {
+            "system.cpu": [[1745376000, 1, 2], [1745376001, 3, 4]],
+            "system.net": [[1745376001, 15.5, -16.5]],
+            "system.ram": None
+        }
+
+        rows = build_series_rows("server_1", chart_series)
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['timestamp'], datetime(2025, 4, 23, 2, 40, 0))
+        self.assertEqual(rows[0]['cpu_usage'], 3)
+        self.assertIsNone(rows[0]['network_sent'])
+        self.assertEqual(rows[1]['cpu_usage'], 7)
+        self.assertEqual(rows[1]['network_sent'], 16.5)
+        self.assertIsNone(rows[1]['memory_usage'])
+
+    ## advance_high_water_marks() test
+    def test_high_water_marks_per_chart(self):
+        """
+        Tests:
+            * two high resolution cycles, the second one with a failed memory chart
+
+        Asserts:
+            * charts that returned points move on, the failed chart keeps its mark
+            * so the next cycle fetches the failed chart's gap again
+        """
+        _high_water.clear()
+        first, second = int(time.time()) - 120, int(time.time()) - 60
+        charts = ("system.cpu", "system.net", "system.ram", "disk_space./")
+        advance_high_water_marks({"server_1": {chart: [[first, 1]] for chart in charts}})
+        advance_high_water_marks({"server_1": {**{chart: [[second, 1]] for chart in charts}, "system.ram": None}})
+
+        since = load_high_water_marks([{"name": "server_1"}], max_backfill=3600)["server_1"]
+        self.assertEqual(since["system.cpu"], second)
+        self.assertEqual(since["disk_space./"], second)
+        self.assertEqual(since["system.ram"], first)
+        _high_water.clear()
+
+    ## collect_all() test
+    @patch('app.data_retrieval.get_data')
+    def test_collect_all_reports_timeouts(self, mock_get_data):
+        """
+        Tests:
+            * a hanging server does not stall the other servers past the cycle deadline
+
+        Asserts:
+            * the fast server has all of its charts
+            * the slow server reports its charts as timeouts
+
+        Mocking:
+            * get_data - blocks on an event for the slow host
+        """
+        release = threading.Event()
+
+        def mock_get_data_side_effect(host, chart, points=1):
+            if host == "slow":
+                release.wait(5)
+            return [1, 2, 3]
+
+        mock_get_data.side_effect = mock_get_data_side_effect
+        server_list = [{"name": "fast", "host": "fast"}, {"name": "slow", "host": "slow"}]
+
+        try:
+            results, report = collect_all(server_list, max_workers=8, per_host_concurrency=4, deadline=0.5,
+                                          batch=False)
+        finally:
+            release.set()
+
+        self.assertEqual(len(results["fast"]), 4)
+        self.assertEqual(report["fast"]["timeouts"], [])
+        self.assertEqual(len(report["slow"]["timeouts"]), 4)
+        self.assertEqual(results["slow"], {})
+
+    ## collect_all() short circuit test
+    @patch('app.data_retrieval.get_session')
+    def test_collect_all_short_circuits_dead_host(self, mock_get_session):
+        """
+        Tests:
+            * a host refusing connections costs one request per cycle, not one per chart
+
+        Asserts:
+            * in batch mode the failed allmetrics request is not followed by per chart requests
+            * one chart at a time, the first failed chart skips the remaining ones
+            * every chart of the dead host is reported as an error
+
+        Mocking:
+            * get_session - every request is refused
+        """
+        mock_get = mock_get_session.return_value.get
+        mock_get.side_effect = requests.ConnectionError("connection refused")
+        server_list = [{"name": "dead", "host": "http://dead.test:19999"}]
+
+        results, report = collect_all(server_list, deadline=5, batch=True)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertTrue(all(value is None for value in results["dead"].values()))
+
+        mock_get.reset_mock()
+        results, report = collect_all(server_list, per_host_concurrency=1, deadline=5, batch=False)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(len(report["dead"]["errors"]), 4)
+
+    ## HostHealth and due_servers() test
+    def test_circuit_breaker_and_intervals(self):
+        """
+        Tests:
+            * a failing host is skipped, probed with a doubling backoff and closed again once it answers
+            * servers are only due once their own interval has passed
+
+        Asserts:
+            * the circuit opens after the failure threshold and half opens when the backoff passed
+            * a failed probe doubles the backoff, a successful one closes the circuit
+            * a server with a long interval is not due on the next tick, one with an open circuit is left out
+
+        Mocking:
+            * time.monotonic - the clock a failure opens the circuit at
+        """
+        breaker = HostHealth(failure_threshold=2, backoff=10, max_backoff=15)
+        with patch('app.host_health.time.monotonic', return_value=100):
+            breaker.record("host", False, 100)
+            self.assertEqual(breaker.circuit("host", 100), CLOSED)
+            breaker.record("host", False, 100)
+        self.assertEqual(breaker.circuit("host", 105), OPEN)
+        self.assertEqual(breaker.circuit("host", 111), HALF_OPEN)
+        with patch('app.host_health.time.monotonic', return_value=111):
+            breaker.record("host", False, 111)
+        # the backoff doubles to 20s, capped at 15s
+        self.assertEqual(breaker.circuit("host", 125), OPEN)
+        self.assertEqual(breaker.circuit("host", 126), HALF_OPEN)
+        breaker.record("host", True, 126)
+        self.assertEqual(breaker.circuit("host", 127), CLOSED)
+
+        health.reset()
+        config = {'COLLECTION_INTERVAL_SECONDS': 60, 'COLLECTION_TICK_SECONDS': 60,
+                  'CIRCUIT_FAILURE_THRESHOLD': 1, 'CIRCUIT_BACKOFF_SECONDS': 600}
+        server_list = [{"name": "fast", "host": "fast"}, {"name": "slow", "host": "slow", "interval": 300},
+                       {"name": "dead", "host": "dead"}]
+        self.assertEqual(len(due_servers(server_list, config, 0)), 3)
+        health.record("fast", True, 0)
+        health.record("slow", True, 0)
+        with patch('app.host_health.time.monotonic', return_value=0):
+            health.record("dead", False, 0)
+        self.assertEqual([server['name'] for server in due_servers(server_list, config, 60)], ["fast"])
+        self.assertEqual([server['name'] for server in due_servers(server_list, config, 300)], ["fast", "slow"])
+        health.reset()
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,68 @@
+from app.downsampling import lttb, lttb_indices, epoch_seconds
+import numpy as np
+import unittest
+
+
+class TestDownsampling(unittest.TestCase):
+    def setUp(self):
+        # flat series with a single spike in the middle
+        self.x = np.arange(1000, dtype=np.float64)
+        self.y = np.zeros(1000)
+        self.y[500] = 100
+
+    ## lttb_indices() test
+    def test_lttb_indices(self):
+        """
+        Tests:
+            * LTTB point selection
+
+        Asserts:
+            * exactly threshold points are picked, in order
+            * the first and last points are kept
+            * the spike survives downsampling
+        """
+        indices = lttb_indices(self.x, self.y, 50)
+
+        self.assertEqual(len(indices), 50)
+        self.assertTrue(np.all(np.diff(indices) > 0))
+        self.assertEqual(indices[0], 0)
+        self.assertEqual(indices[-1], 999)
+        self.assertIn(500, indices)
+
+    ## lttb() test
+    def test_lttb_series(self):
+        """
+        Tests:
+            * downsampling a historical_metrics style network series
+
+        Asserts:
+            * both value keys share the picked timestamps
+            * short series are returned unchanged
+        """
+        series = {
+            'timestamps': [f'2025-04-23 02:{i // 60:02d}:{i % 60:02d}' for i in range(600)],
+            'sent': list(range(600)),
+            'received': [1] * 600
+        }
+
+        downsampled = lttb(series, ('sent', 'received'), 20)
+
+        self.assertEqual(len(downsampled['timestamps']), 20)
+        self.assertEqual(len(downsampled['sent']), 20)
+        self.assertEqual(len(downsampled['received']), 20)
+        self.assertEqual(downsampled['timestamps'][0], '2025-04-23 02:00:00')
+        self.assertEqual(lttb(series, ('sent', 'received'), 1000), series)
+
+    ## epoch_seconds() test
+    def test_epoch_seconds(self):
+        """
+        Asserts:
+            * SQLite timestamp strings are read as UTC
+        """
+        seconds = epoch_seconds(['2025-04-23 02:40:00', '2025-04-23 02:40:00.500000'])
+
+        self.assertEqual(list(seconds), [1745376000.0, 1745376000.5])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+from app.data_retrieval import build_row, write_rows
+from app.forecasting import (cached_forecast, fit_holt_winters, fit_linear, forecast, forecast_cache,
+                             holt_winters_time_to, linear_time_to)
+from app.models import Server, db
+from app.rollups import compact_rollups
+from datetime import datetime, timedelta
+from flask import Flask
+from unittest.mock import patch
+import numpy as np
+import unittest
+
+DAY = 86400
+
+
+class TestTrendFits(unittest.TestCase):
+    # setUp(): two weeks of hourly values for a growing host with a daily cycle, a flat one and one with gaps
+    def setUp(self):
+        hours = np.arange(14 * 24)
+        cycle = 5 * np.sin(2 * np.pi * hours / 24)
+        gaps = 30 + 2 * hours / 24
+        gaps[::3] = np.nan
+        self.values = np.stack([50 + hours / 24 + cycle, 40 + cycle, gaps])
+
+    ## fit_linear() test
+    def test_linear(self):
+        """
+        Tests:
+            * least squares trends of every host fitted at once
+
+        Asserts:
+            * slopes match the growth per day, buckets without a value are left out
+            * only growing hosts reach the threshold within the horizon
+        """
+        slope, fitted = fit_linear(self.values, 3600)
+        np.testing.assert_allclose(slope * DAY, [1, 0, 2], atol=0.05)
+
+        days = linear_time_to(slope, fitted, 90, 90 * DAY) / DAY
+        # the daily cycle tilts the fitted line a little
+        self.assertAlmostEqual(days[0], 90 - 50 - (14 * 24 - 1) / 24, delta=2)
+        self.assertTrue(np.isnan(days[1]))
+        self.assertAlmostEqual(days[2], (90 - 30 - 2 * (14 * 24 - 1) / 24) / 2, delta=1)
+
+    ## fit_holt_winters() test
+    def test_holt_winters(self):
+        """
+        Tests:
+            * additive Holt-Winters with a daily season over every host at once
+
+        Asserts:
+            * the growing host reaches the threshold around when its daily peaks do
+            * the flat host never does, and hosts with gaps are still projected
+        """
+        level, trend, seasonal = fit_holt_winters(self.values, 24)
+        days = holt_winters_time_to(level, trend, seasonal, self.values.shape[1] - 1, 90, 90 * 24, 3600) / DAY
+
+        # peaks 5 above the trend line reach 90 about 5 days before the line itself
+        self.assertAlmostEqual(days[0], 90 - 5 - 50 - (14 * 24 - 1) / 24, delta=0.5)
+        self.assertTrue(np.isnan(days[1]))
+        self.assertAlmostEqual(days[2], (90 - 30 - 2 * (14 * 24 - 1) / 24) / 2, delta=0.5)
+
+
+class TestForecast(unittest.TestCase):
+    # setUp(): three days of hourly disk usage for three servers, compacted into the rollup tiers
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'FORECAST_LOOKBACK_DAYS': 3})
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        self.now = datetime(2025, 4, 23, 12, 30)
+        start = datetime(2025, 4, 20, 13)
+        db.session.add_all(Server(name=name, host=f"http://{name}:19999") for name in ("filling", "flat", "full"))
+        db.session.commit()
+        write_rows([
+            row for i in range(72) for row in (
+                build_row("filling", start + timedelta(hours=i), {'disk_usage': 80 + i / 24}),
+                build_row("flat", start + timedelta(hours=i), {'disk_usage': 40.0}),
+                build_row("full", start + timedelta(hours=i), {'disk_usage': 93 + i / 240}),
+            )
+        ])
+        compact_rollups()
+
+    def tearDown(self):
+        forecast_cache.invalidate()
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    ## forecast() test
+    def test_fleet_ranking(self):
+        """
+        Tests:
+            * a disk forecast over every registered server
+
+        Asserts:
+            * servers are ranked by time to threshold, servers not reaching it come last
+            * a server already above the threshold is due now
+        """
+        result = forecast('disk', self.app.config, now=self.now)
+
+        self.assertEqual(result['threshold'], 90.0)
+        self.assertEqual([host['server'] for host in result['hosts']], ["full", "filling", "flat"])
+        full, filling, flat = result['hosts']
+        self.assertEqual(full['seconds_to_threshold'], 0)
+        self.assertAlmostEqual(filling['linear']['slope_per_day'], 1.0, places=2)
+        self.assertAlmostEqual(filling['seconds_to_threshold'] / DAY, 90 - 80 - 71 / 24, delta=0.1)
+        self.assertIsNone(flat['seconds_to_threshold'])
+
+        with self.assertRaises(ValueError):
+            forecast('cpu', self.app.config)
+
+    ## cached_forecast() test
+    def test_cached_between_ingest(self):
+        """
+        Tests:
+            * forecasts are cached until new rows are committed
+
+        Asserts:
+            * a repeated request does not query the database, one after a write does
+        """
+        cached_forecast('disk', self.app.config)
+        with patch('app.forecasting.read_bucketed') as read_bucketed:
+            cached_forecast('disk', self.app.config)
+            read_bucketed.assert_not_called()
+
+            write_rows([build_row("flat", datetime(2025, 4, 23, 13), {'disk_usage': 40.0})])
+            cached_forecast('disk', self.app.config)
+            read_bucketed.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+from app.data_retrieval import build_row, write_rows
+from app.hot_tier import RingBuffer, hot_tier, init_hot_tier
+from app.metric_collector import bucketed_metrics, historical_metrics, iter_historical_metrics
+from app.models import Server, db
+from app.storage import get_storage
+from datetime import datetime, timedelta, timezone
+from flask import Flask
+from unittest.mock import patch
+import numpy as np
+import unittest
+
+
+class TestRingBuffer(unittest.TestCase):
+    ## RingBuffer.append() test
+    def test_wraps_into_contiguous_views(self):
+        """
+        Tests:
+            * a buffer of 4 samples receiving 7, in batches that wrap around its end
+
+        Asserts:
+            * the newest samples are one contiguous view of the buffer, oldest first
+            * covered_from follows the oldest sample left, a duplicate fills in the held sample and
+              a missing older sample moves covered_from past it
+        """
+        buffer = RingBuffer(4, covered_from=0)
+        buffer.append(np.array([10, 20, 30]), np.arange(15, dtype=float).reshape(5, 3))
+        buffer.append(np.array([30, 40, 50, 60]), np.arange(20, dtype=float).reshape(5, 4))
+
+        times, values = buffer.view()
+        self.assertEqual(times.tolist(), [30, 40, 50, 60])
+        self.assertEqual(values[0].tolist(), [0.0, 1.0, 2.0, 3.0])
+        self.assertTrue(np.shares_memory(times, buffer.times))
+        self.assertEqual(buffer.covered_from, 30)
+
+        window_times, _ = buffer.window(35, 50)
+        self.assertEqual(window_times.tolist(), [40, 50])
+
+        buffer.append(np.array([45, 70]), np.zeros((5, 2)))
+        self.assertEqual(buffer.view()[0].tolist(), [40, 50, 60, 70])
+        self.assertEqual(buffer.covered_from, 46)
+
+
+class TestHotTier(unittest.TestCase):
+    # setUp(): an hour of minute samples for three servers written before the hot tier is warmed,
+    # with a budget that fits two of them
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'HOT_TIER_POINTS': 100,
+            'HOT_TIER_MEMORY_MB': 0.02,
+            'HOT_TIER_WARM_HOURS': 2,
+            'HOT_TIER_MAX_AGE': 600,
+        })
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        self.end = datetime.now(timezone.utc).replace(tzinfo=None, second=0, microsecond=0)
+        self.start = self.end - timedelta(hours=1)
+        db.session.add_all(Server(name=f"server_{n}", host=f"http://server_{n}:19999") for n in range(3))
+        db.session.commit()
+        write_rows([
+            build_row(f"server_{n}", self.start + timedelta(minutes=i),
+                      {'cpu_usage': float(n * 10 + i % 5), 'memory_usage': 50.0, 'network_received': float(i)})
+            for i in range(60) for n in range(3)
+        ])
+
+    def tearDown(self):
+        hot_tier.configure(0, 0, 0)
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    ## historical_metrics() from the hot tier test
+    def test_recent_ranges_from_memory(self):
+        """
+        Tests:
+            * historical_metrics with the hot tier warmed from the database and fed by new rows
+
+        Asserts:
+            * raw, bucketed and streamed series equal the ones read from the database
+            * servers within the budget never touch the database, the others and older ranges do
+        """
+        # bucketed from the raw samples, the rollup tiers a 600s bucket would read are not compacted here
+        expected = {server: (historical_metrics("cpu", server, self.start, self.end),
+                             bucketed_metrics("cpu", server, self.start, self.end, 600))
+                    for server in ("server_0", "server_2")}
+        init_hot_tier(self.app)
+        self.assertEqual(set(hot_tier.buffers), {"server_0", "server_1"})
+        # the tier is read once fed, rows committed after the warm load are appended through the ingest listener
+        write_rows([build_row("server_0", self.end + timedelta(minutes=1), {'cpu_usage': 99.0})])
+
+        with patch('app.storage.sql.get_connection', wraps=db.engine.connect) as connect:
+            self.assertEqual(historical_metrics("cpu", "server_0", self.start, self.end), expected["server_0"][0])
+            self.assertEqual(historical_metrics("cpu", "server_0", self.start, self.end, bucket=600),
+                             expected["server_0"][1])
+            chunks = list(iter_historical_metrics("network", "server_0", self.start, self.end, chunk_size=25))
+            self.assertEqual(connect.call_count, 0)
+
+            self.assertEqual(historical_metrics("cpu", "server_2", self.start, self.end), expected["server_2"][0])
+            self.assertEqual(bucketed_metrics("cpu", "server_2", self.start, self.end, 600), expected["server_2"][1])
+            self.assertEqual(connect.call_count, 2)
+
+            historical_metrics("cpu", "server_0", self.end - timedelta(hours=3), self.end)
+            self.assertEqual(connect.call_count, 3)
+
+        self.assertEqual([len(chunk) for chunk in chunks], [25, 25, 10])
+        epoch = int((self.start + timedelta(minutes=1) - datetime(1970, 1, 1)).total_seconds())
+        self.assertEqual(chunks[0][1], (epoch, None, 1.0))
+
+        series = historical_metrics("cpu", "server_0", self.start, self.end + timedelta(minutes=1))
+        self.assertEqual(series['values'][-1], 99.0)
+        self.assertEqual(len(series['timestamps']), 61)
+
+
+    ## init_hot_tier() freshness test
+    def test_unfed_tier_reads_storage(self):
+        """
+        Tests:
+            * init_hot_tier with no registered servers, then a first committed batch
+
+        Asserts:
+            * the servers with stored rows are warmed
+            * the warm load alone does not make the tier readable, the first batch does
+            * the tier goes stale again when no batch arrives within HOT_TIER_MAX_AGE
+        """
+        Server.query.delete()
+        db.session.commit()
+        init_hot_tier(self.app)
+        self.assertEqual(set(hot_tier.buffers), {"server_0", "server_1"})
+
+        with patch('app.storage.sql.get_connection', wraps=db.engine.connect) as connect:
+            historical_metrics("cpu", "server_0", self.start, self.end)
+            self.assertEqual(connect.call_count, 1)
+
+            write_rows([build_row("server_0", self.end + timedelta(minutes=1), {'cpu_usage': 99.0})])
+            historical_metrics("cpu", "server_0", self.start, self.end)
+            self.assertEqual(connect.call_count, 1)
+
+            with patch('app.hot_tier.time.monotonic', return_value=hot_tier.fed_at + hot_tier.max_age + 1):
+                historical_metrics("cpu", "server_0", self.start, self.end)
+            self.assertEqual(connect.call_count, 2)
+
+    ## HotTier.refill() test
+    def test_batch_after_gap_refills(self):
+        """
+        Tests:
+            * a batch arriving after a gap, while another process committed rows this one never received
+
+        Asserts:
+            * the held samples and the missed rows are read from the tier, without the database
+            * the rows of the new batch are there too
+
+        Mocking:
+            * time.monotonic - the next batch arrives past HOT_TIER_MAX_AGE
+        """
+        init_hot_tier(self.app)
+        write_rows([build_row("server_0", self.end + timedelta(minutes=1), {'cpu_usage': 99.0})])
+        # committed elsewhere: stored without reaching the ingest listeners
+        get_storage().write([build_row("server_0", self.end + timedelta(minutes=2), {'cpu_usage': 98.0})])
+        db.session.commit()
+
+        with patch('app.hot_tier.time.monotonic', return_value=hot_tier.fed_at + hot_tier.max_age + 1):
+            write_rows([build_row("server_0", self.end + timedelta(minutes=3), {'cpu_usage': 97.0})])
+
+        with patch('app.storage.sql.get_connection', wraps=db.engine.connect) as connect:
+            series = historical_metrics("cpu", "server_0", self.start, self.end + timedelta(minutes=3))
+            self.assertEqual(connect.call_count, 0)
+        self.assertEqual(series['values'][-3:], [99.0, 98.0, 97.0])
+        self.assertEqual(len(series['timestamps']), 63)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+from app.data_retrieval import build_row, utc_from_epoch
+from app.ingest_queue import IngestQueue, JournalLocked
+from app.models import db
+from flask import Flask
+from sqlalchemy import text
+import os
+import tempfile
+import unittest
+
+
+class TestIngestQueue(unittest.TestCase):
+    # setUp(): file database (shared by the writer thread) and a journal in a temporary directory
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(self.directory.name, 'test.db')
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        self.journal = os.path.join(self.directory.name, 'ingest.journal')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def rows(self, start, count):
+        return [build_row(f"server_{i}", utc_from_epoch(1745366400 + i), {'cpu_usage': float(i)})
+                for i in range(start, start + count)]
+
+    def stored(self):
+        return [row[0] for row in db.session.execute(text('SELECT machine_name FROM metric_logs ORDER BY id'))]
+
+    ## replay after a crash test
+    def test_replay_uncommitted_rows(self):
+        """
+        Tests:
+            * rows journaled but never written are replayed by the next queue on the same journal
+
+        Asserts:
+            * a second process cannot open a journal that is in use
+            * every row is written exactly once, in order, and the journal is emptied afterwards
+        """
+        crashed = IngestQueue(self.app, self.journal, fsync=False)
+        crashed.put(self.rows(0, 3))
+        crashed.put(self.rows(3, 2))
+        with self.assertRaises(JournalLocked):
+            IngestQueue(self.app, self.journal)
+        # the process dies before its writer thread ran
+        crashed.journal.close()
+
+        queue = IngestQueue(self.app, self.journal, flush_interval=0.01, fsync=False).start()
+        queue.close()
+
+        self.assertEqual(self.stored(), [f"server_{i}" for i in range(5)])
+        self.assertEqual(os.path.getsize(self.journal), 0)
+
+    ## backpressure and spill test
+    def test_spill_when_full(self):
+        """
+        Tests:
+            * puts beyond the in-memory bound spill to the journal and are written once the writer catches up
+
+        Asserts:
+            * a put on a full queue returns False after its timeout
+            * the spilled rows are written after the queued ones, in batches of at most batch_size
+        """
+        queue = IngestQueue(self.app, self.journal, max_rows=4, batch_size=4, flush_interval=0.01, fsync=False)
+        self.assertTrue(queue.put(self.rows(0, 4)))
+        self.assertFalse(queue.put(self.rows(4, 4), timeout=0))
+        self.assertFalse(queue.put(self.rows(8, 2), timeout=0))
+        self.assertEqual(queue.backlog(), (4, True))
+
+        queue.start()
+        queue.close()
+
+        self.assertEqual(self.stored(), [f"server_{i}" for i in range(10)])
+        self.assertEqual(queue.backlog(), (0, False))
+
+    ## journal compaction test
+    def test_compact_journal_under_load(self):
+        """
+        Tests:
+            * a batch committed while later entries are still queued, so the queue never drains
+
+        Asserts:
+            * the journal is rewritten without the committed entry once it takes compact_bytes, and stays locked
+            * the entries left are replayed by the next queue, every row is written exactly once
+        """
+        queue = IngestQueue(self.app, self.journal, batch_size=2, fsync=False, compact_bytes=1)
+        for start in (0, 2, 4):
+            queue.put(self.rows(start, 2))
+        size = os.path.getsize(self.journal)
+
+        count, rows = queue.next_batch()
+        self.assertTrue(queue.write(rows))
+        queue.committed_entries(count)
+        with open(self.journal, 'rb') as f:
+            self.assertEqual(len(f.readlines()), 2)
+        self.assertLess(os.path.getsize(self.journal), size)
+        with self.assertRaises(JournalLocked):
+            IngestQueue(self.app, self.journal)
+        # the process dies with two entries still queued
+        queue.journal.close()
+
+        queue = IngestQueue(self.app, self.journal, flush_interval=0.01, fsync=False).start()
+        queue.close()
+
+        self.assertEqual(self.stored(), [f"server_{i}" for i in range(6)])
+        self.assertEqual(os.path.getsize(self.journal), 0)
@@ -0,0 +1,93 @@
+from app.data_retrieval import get_data
+from app.instrumentation import Counter, Histogram, registry
+from app.routes import api, main_bp
+from flask import Flask
+from flask_login import LoginManager
+from unittest.mock import MagicMock, patch
+import requests
+import tempfile
+import unittest
+
+
+class TestInstrumentation(unittest.TestCase):
+    # setUp(): api and main blueprints on a bare app, admin 1 and user 2 to log in as, profiles in a temporary directory
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        self.app.config['PROFILE_DIR'] = self.directory.name
+        self.app.config['SECRET_KEY'] = 'test'
+        self.app.register_blueprint(api)
+        self.app.register_blueprint(main_bp)
+        login_manager = LoginManager(self.app)
+        login_manager.user_loader(lambda user_id: MagicMock(is_authenticated=True, is_active=True,
+                                                            type='Admin' if user_id == '1' else 'User'))
+        self.client = self.app.test_client()
+
+    def log_in(self, user_id):
+        with self.client.session_transaction() as session:
+            session['_user_id'] = user_id
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    ## exposition format test
+    def test_render_format(self):
+        """
+        Asserts:
+            * counters and histograms render with their labels, cumulative buckets, sum and count
+        """
+        counter = Counter('test_events_total', 'Test events', ['kind'])
+        histogram = Histogram('test_latency_seconds', 'Test latency', buckets=(0.1, 1))
+        registry.remove(counter)
+        registry.remove(histogram)
+
+        counter.inc(kind='a "quoted"')
+        counter.inc(2, kind='a "quoted"')
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+
+        self.assertIn('test_events_total{kind="a \\"quoted\\""} 3', counter.render())
+        lines = histogram.render().splitlines()
+        self.assertIn('# TYPE test_latency_seconds histogram', lines)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_latency_seconds_bucket{le="1.0"} 2', lines)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('test_latency_seconds_sum 5.55', lines)
+        self.assertIn('test_latency_seconds_count 3', lines)
+
+    ## /metrics test
+    @patch('app.data_retrieval.get_session')
+    def test_metrics_endpoint(self, mock_get_session):
+        """
+        Tests:
+            * fetch timeouts and API request latency show up on /metrics
+
+        Asserts:
+            * a timed out fetch is counted by kind and still timed
+            * requests are timed per endpoint, /metrics needs the token once one is configured
+            * the profile endpoint takes neither the token nor a non admin user
+            * an admin's profile request is accepted and there is no profile before a cycle ran
+
+        Mocking:
+            * get_session - every request times out
+        """
+        mock_get_session.return_value.get.side_effect = requests.Timeout("read timed out")
+        self.assertIsNone(get_data("http://timeout.test:19999", "system.cpu"))
+
+        self.client.get('/api/current_metrics')
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('resourceradar_fetch_errors_total{host="http://timeout.test:19999",chart="system.cpu",kind="timeout"} 1', body)
+        self.assertIn('resourceradar_fetch_seconds_count{host="http://timeout.test:19999",chart="system.cpu"} 1', body)
+        self.assertIn('resourceradar_request_seconds_count{endpoint="api.current_metrics",method="GET"', body)
+
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code, 200)
+
+        headers = {'Authorization': 'Bearer secret'}
+        self.assertEqual(self.client.post('/metrics/profile', headers=headers).status_code, 401)
+        self.log_in('2')
+        self.assertEqual(self.client.post('/metrics/profile').status_code, 302)
+        self.log_in('1')
+        self.assertEqual(self.client.get('/metrics/profile').status_code, 404)
+        self.assertEqual(self.client.post('/metrics/profile').status_code, 202)
@@ -0,0 +1,66 @@
+from app.data_retrieval import get_servers
+from app.leases import acquire_lease, release_lease
+from app.models import Server, db
+from app.sharding import shard_servers
+from flask import Flask
+import unittest
+
+
+class TestLeases(unittest.TestCase):
+    # setUp(): empty in-memory database
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    ## acquire_lease() test
+    def test_acquire_lease(self):
+        """
+        Tests:
+            * only one owner holds a lease at a time
+
+        Asserts:
+            * the holder can renew its lease, another owner cannot take it
+            * an expired or released lease can be taken over
+        """
+        self.assertTrue(acquire_lease('collect_metrics:0', 60, owner='a'))
+        self.assertTrue(acquire_lease('collect_metrics:0', 60, owner='a'))
+        self.assertFalse(acquire_lease('collect_metrics:0', 60, owner='b'))
+
+        # a lease with a negative ttl is already expired
+        self.assertTrue(acquire_lease('compact_rollups', -1, owner='a'))
+        self.assertTrue(acquire_lease('compact_rollups', 60, owner='b'))
+
+        release_lease('collect_metrics:0', owner='a')
+        self.assertTrue(acquire_lease('collect_metrics:0', 60, owner='b'))
+
+    ## get_servers() and shard_servers() test
+    def test_sharded_registry(self):
+        """
+        Tests:
+            * registered servers are split across collector shards
+
+        Asserts:
+            * the static list is used until servers are registered, disabled servers are skipped
+            * every server lands in exactly one shard
+        """
+        self.assertEqual([server['name'] for server in get_servers()], ["server_1", "server_2"])
+
+        db.session.add_all([Server(name=f"host_{i}", host=f"http://10.0.0.{i}:19999") for i in range(50)])
+        db.session.add(Server(name="retired", host="http://10.0.1.1:19999", enabled=False))
+        db.session.commit()
+
+        registered = get_servers()
+        self.assertEqual(len(registered), 50)
+        shards = [shard_servers(registered, index, 3) for index in range(3)]
+        self.assertEqual(sorted(server['name'] for shard in shards for server in shard),
+                         sorted(server['name'] for server in registered))
+        self.assertTrue(all(shards))
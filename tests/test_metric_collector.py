@@ -0,0 +1,81 @@
+from app.data_retrieval import build_row, write_rows
+from app.metric_collector import batch_historical_metrics, historical_metrics, latest_metrics
+from app.models import db
+from datetime import datetime, timedelta, timezone
+from flask import Flask
+from unittest.mock import patch
+import unittest
+
+
+class TestMetricCollector(unittest.TestCase):
+    # setUp(): an hour of minute samples for three servers, ending now
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        self.end = datetime.now(timezone.utc).replace(tzinfo=None, second=0, microsecond=0)
+        self.start = self.end - timedelta(hours=1)
+        write_rows([
+            build_row(f"server_{n}", self.start + timedelta(minutes=i),
+                      {'cpu_usage': float(n * 10 + i % 5), 'memory_usage': 50.0,
+                       'network_received': float(i), 'network_sent': None})
+            for i in range(60) for n in range(3)
+        ])
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    ## latest_metrics() test
+    def test_latest_metrics(self):
+        """
+        Asserts:
+            * the newest row of every server is returned, not just the last two rows written
+        """
+        latest = latest_metrics()
+
+        self.assertEqual(set(latest), {"server_0", "server_1", "server_2"})
+        self.assertEqual(latest["server_2"]["cpu_usage"], 24.0)
+        self.assertIsNone(latest["server_2"]["network_sent"])
+
+    ## batch_historical_metrics() test
+    def test_batch_matches_single_queries(self):
+        """
+        Tests:
+            * batch queries for several servers and metrics, raw and bucketed
+
+        Asserts:
+            * every series equals the one historical_metrics returns for it
+            * only one query is made for the whole batch
+        """
+        selectors = [{"server": "server_0", "metrics": ["cpu", "network"]},
+                     {"server": "server_2", "metrics": ["memory"]}]
+
+        for options in ({}, {'bucket': 600}):
+            with patch('app.storage.sql.get_connection', wraps=db.engine.connect) as connect:
+                batch = batch_historical_metrics(selectors, self.start, self.end, **options)
+            self.assertEqual(connect.call_count, 1)
+
+            self.assertEqual(set(batch), {"server_0", "server_2"})
+            for selector in selectors:
+                for metric in selector["metrics"]:
+                    expected = historical_metrics(metric, selector["server"], self.start, self.end, **options)
+                    self.assertEqual(batch[selector["server"]][metric], expected)
+
+    ## batch_historical_metrics() validation test
+    def test_batch_rejects_unknown_metric(self):
+        """
+        Asserts:
+            * an unknown metric type raises ValueError
+        """
+        with self.assertRaises(ValueError):
+            batch_historical_metrics([{"server": "server_0", "metrics": ["gpu"]}], self.start, self.end)
+
+
+if __name__ == "__main__":
+    unittest.main()
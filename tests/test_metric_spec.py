@@ -0,0 +1,157 @@
+from app.data_retrieval import CHARTS, collect_all, fetch_server
+from app.metric_collector import series_metrics
+from app.metric_spec import SUBSCRIPTIONS, derive_samples, parse_spec
+from app.models import db
+from app.storage import get_storage
+from datetime import datetime, timedelta
+from flask import Flask
+from unittest.mock import MagicMock, patch
+import unittest
+
+
+class TestMetricSpec(unittest.TestCase):
+    # setUp(): a spec with a plain chart, a per mount wildcard and a chart summed over every dimension
+    def setUp(self):
+        self.spec = parse_spec([
+            {"name": "load1", "chart": "system.load", "dimensions": ["load1"]},
+            {"name": "disk_used", "chart": "disk_space.*", "dimensions": ["avail", "used", "reserved for root"],
+             "expression": "(used + reserved_for_root) / total * 100", "unit": "%"},
+            {"name": "cgroup_cpu", "chart": "cgroup_*.cpu"},
+        ])
+
+    ## derive_samples() test
+    def test_derive_samples(self):
+        """
+        Tests:
+            * every spec metric is derived for the matching charts of every server
+
+        Asserts:
+            * wildcard charts become one series per instance
+            * charts without their dimensions, or a division by zero, produce no sample
+            * servers that returned nothing are skipped
+        """
+        charts_by_server = {
+            "server_1": {
+                "system.load": {"load1": 0.5, "load5": 0.25},
+                "disk_space./": {"avail": 80, "used": 15, "reserved for root": 5},
+                "disk_space./home": {"avail": 0, "used": 0, "reserved for root": 0},
+                "cgroup_nginx.cpu": {"user": 1.5, "system": 0.5},
+            },
+            "server_2": {"disk_space./": {"avail": 50, "used": 50, "reserved for root": 0}, "disk_space./boot": {}},
+            "server_3": None,
+        }
+
+        samples = derive_samples(self.spec, charts_by_server, datetime(2025, 1, 1))
+        values = {(sample['machine_name'], sample['series']): sample['value'] for sample in samples}
+
+        self.assertEqual(values, {
+            ("server_1", "load1"): 0.5,
+            ("server_1", "disk_used:/"): 20.0,
+            ("server_2", "disk_used:/"): 50.0,
+            ("server_1", "cgroup_cpu:nginx"): 2.0,
+        })
+
+    ## parse_spec() test
+    def test_parse_spec_rejects_code(self):
+        """
+        Tests:
+            * expressions are arithmetic only
+
+        Asserts:
+            * calls, attributes and unknown names are rejected when the spec is loaded
+        """
+        for expression in ("__import__('os').system('true')", "used.real", "unknown * 2", "min(used)"):
+            with self.assertRaises(ValueError):
+                parse_spec([{"name": "bad", "chart": "disk_space.*", "dimensions": ["used"], "expression": expression}])
+        with self.assertRaises(ValueError):
+            parse_spec([{"name": "twice", "chart": "a.*.*"}])
+
+    ## fetch_server() subscriptions test
+    @patch('app.data_retrieval.get_session')
+    def test_fetch_server_subscriptions(self, mock_get_session):
+        """
+        Tests:
+            * subscribed charts come with the same allmetrics request as the built-in charts
+
+        Asserts:
+            * one request asks for the built-in charts and the spec's chart patterns
+            * only the charts the spec reads are returned under SUBSCRIPTIONS
+
+        Mocking:
+            * get_session - an allmetrics answer with built-in and extra charts
+        """
+        mock_get = mock_get_session.return_value.get
+        mock_get.return_value.json.return_value = {
+            "system.cpu": {"dimensions": {"user": {"value": 5}, "system": {"value": 2}}},
+            "system.net": {"dimensions": {"received": {"value": 10}, "sent": {"value": -4}}},
+            "system.ram": {"dimensions": {"free": {"value": 1}, "used": {"value": 1}, "cached": {"value": 0},
+                                          "buffers": {"value": 0}}},
+            "disk_space./": {"dimensions": {"avail": {"value": 3}, "used": {"value": 1},
+                                            "reserved for root": {"value": 0}}},
+            "system.load": {"dimensions": {"load1": {"value": 0.5}}},
+            "system.io": {"dimensions": {"in": {"value": 1}}},
+        }
+
+        chart_data = fetch_server("http://server:19999", spec=self.spec)
+
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(mock_get.call_args.kwargs['params']['filter'].split()[-3:],
+                         ["system.load", "disk_space.*", "cgroup_*.cpu"])
+        self.assertEqual(chart_data["system.cpu"], [5, 2])
+        self.assertEqual(set(chart_data[SUBSCRIPTIONS]), {"system.load", "disk_space./"})
+
+    ## collect_all() subscriptions test
+    @patch('app.data_retrieval.get_series')
+    @patch('app.data_retrieval.get_allmetrics')
+    def test_collect_all_subscriptions_unbatched(self, mock_get_allmetrics, mock_get_series):
+        """
+        Tests:
+            * high resolution collection, where every built-in chart is fetched on its own
+
+        Asserts:
+            * the subscribed charts still come back under SUBSCRIPTIONS, from one allmetrics request per server
+            * the built-in charts are fetched as series
+
+        Mocking:
+            * get_allmetrics - an answer with a subscribed chart
+            * get_series - one point per chart
+        """
+        mock_get_allmetrics.return_value = {"system.load": {"dimensions": {"load1": {"value": 0.5}}}}
+        mock_get_series.return_value = [[100, 1.0]]
+        server = {"name": "server_1", "host": "http://server:19999"}
+
+        results, report = collect_all([server], since={"server_1": dict.fromkeys(CHARTS, 0)}, spec=self.spec)
+
+        mock_get_allmetrics.assert_called_once_with("http://server:19999", ("system.load", "disk_space.*", "cgroup_*.cpu"))
+        self.assertEqual(results["server_1"][SUBSCRIPTIONS], {"system.load": {"load1": 0.5}})
+        self.assertEqual(mock_get_series.call_count, len(CHARTS))
+        self.assertEqual(report["server_1"]['errors'], [])
+
+    ## write_samples() and series_metrics() test
+    def test_narrow_storage(self):
+        """
+        Tests:
+            * subscribed samples round trip through the metric_samples table
+
+        Asserts:
+            * a series is read back oldest first within the range, and listed for its server
+        """
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+            start = datetime(2025, 1, 1)
+            get_storage().write_samples([
+                {'machine_name': 'server_1', 'series': 'disk_used:/', 'timestamp': start + timedelta(minutes=i), 'value': i}
+                for i in (2, 0, 1)
+            ] + [{'machine_name': 'server_1', 'series': 'load1', 'timestamp': start, 'value': 0.5}])
+
+            series = series_metrics('server_1', 'disk_used:/', start, start + timedelta(seconds=90))
+            self.assertEqual(series['values'], [0, 1])
+            self.assertEqual(get_storage().series_names('server_1'), ['disk_used:/', 'load1'])
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+from app.data_retrieval import build_row, utc_from_epoch, write_rows
+from app.metric_collector import historical_metrics
+from app.models import db
+from app.rollups import TIERS, choose_tier, compact_rollups, prune_metrics
+from datetime import datetime, timedelta
+from flask import Flask
+from sqlalchemy import text
+import unittest
+
+
+class TestRollups(unittest.TestCase):
+    # setUp(): two hours of 10 second samples for one server in an in-memory database
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        self.start = 1745366400  # 2025-04-23 00:00:00 UTC
+        write_rows([
+            build_row("server_1", utc_from_epoch(self.start + i * 10), {'cpu_usage': float(i % 6), 'network_sent': 1.0})
+            for i in range(720)
+        ])
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def count(self, table):
+        return db.session.execute(text(f'SELECT COUNT(*) FROM {table}')).scalar()
+
+    ## compact_rollups() test
+    def test_compact_rollups(self):
+        """
+        Tests:
+            * raw rows are compacted into every tier
+
+        Asserts:
+            * one bucket per minute, hour and day
+            * min/avg/max and sample counts carry through the tiers
+            * compacting again is idempotent
+        """
+        compact_rollups()
+        compact_rollups()
+
+        self.assertEqual(self.count('metric_rollup_1m'), 120)
+        self.assertEqual(self.count('metric_rollup_1h'), 2)
+        self.assertEqual(self.count('metric_rollup_1d'), 1)
+
+        row = db.session.execute(text(
+            'SELECT sample_count, cpu_usage_min, cpu_usage_avg, cpu_usage_max FROM metric_rollup_1d'
+        )).one()
+        self.assertEqual(row.sample_count, 720)
+        self.assertEqual((row.cpu_usage_min, row.cpu_usage_max), (0.0, 5.0))
+        self.assertAlmostEqual(row.cpu_usage_avg, 2.5)
+
+    ## prune_metrics() test
+    def test_prune_metrics(self):
+        """
+        Tests:
+            * retention pruning of raw rows
+
+        Asserts:
+            * raw rows are kept until the one minute tier has compacted them
+            * raw rows past retention are deleted once compacted, rollups are kept
+        """
+        now = utc_from_epoch(self.start) + timedelta(days=60)
+
+        prune_metrics(now)
+        self.assertEqual(self.count('metric_logs'), 720)
+
+        compact_rollups()
+        prune_metrics(now)
+        # the newest minute bucket is recomputed from raw rows on every compaction, so those are kept
+        self.assertEqual(self.count('metric_logs'), 6)
+        self.assertEqual(self.count('metric_rollup_1m'), 120)
+
+    ## compact_rollups() late rows test
+    def test_late_rows_reach_tiers_before_pruning(self):
+        """
+        Tests:
+            * rows written for one server behind the tiers' newest buckets, like a high resolution backfill
+
+        Asserts:
+            * pruning keeps them until they are compacted
+            * the next compaction recomputes their buckets in every tier, then they can be pruned
+        """
+        compact_rollups()
+        write_rows([build_row("server_1", utc_from_epoch(self.start + 300 + i), {'cpu_usage': 100.0})
+                    for i in range(5)])
+        now = utc_from_epoch(self.start) + timedelta(days=60)
+
+        prune_metrics(now)
+        self.assertEqual(self.count('metric_logs'), 6 + 5)
+
+        compact_rollups()
+        minute = db.session.execute(text(
+            "SELECT sample_count, cpu_usage_avg, cpu_usage_max FROM metric_rollup_1m "
+            "WHERE bucket_start = '2025-04-23 00:05:00'"
+        )).one()
+        self.assertEqual((minute.sample_count, minute.cpu_usage_max), (11, 100.0))
+        self.assertAlmostEqual(minute.cpu_usage_avg, (15 + 500) / 11)
+        self.assertEqual(db.session.execute(text('SELECT sample_count FROM metric_rollup_1d')).scalar(), 725)
+
+        prune_metrics(now)
+        self.assertEqual(self.count('metric_logs'), 6)
+
+    ## compact_rollups() filled sample test
+    def test_filled_samples_recompute_buckets(self):
+        """
+        Tests:
+            * a late point filling in a sample that was already compacted, which moves the row to a new id
+
+        Asserts:
+            * recomputing from the sample's time counts it once, with the filled value
+        """
+        compact_rollups()
+        write_rows([build_row("server_1", utc_from_epoch(self.start), {'memory_usage': 50.0})])
+
+        compact_rollups(recompute_from=utc_from_epoch(self.start))
+        minute = db.session.execute(text(
+            "SELECT sample_count, memory_usage_max FROM metric_rollup_1m "
+            "WHERE bucket_start = '2025-04-23 00:00:00'"
+        )).one()
+        self.assertEqual((minute.sample_count, minute.memory_usage_max), (6, 50.0))
+        self.assertEqual(self.count('metric_logs'), 720)
+        self.assertEqual(db.session.execute(text('SELECT sample_count FROM metric_rollup_1d')).scalar(), 720)
+
+    ## choose_tier() test
+    def test_choose_tier(self):
+        """
+        Asserts:
+            * raw rows are read when every point is asked for
+            * the coarsest tier at or below the requested resolution is picked
+            * ranges older than raw retention fall back to a rollup tier
+        """
+        now = datetime(2025, 4, 23)
+
+        self.assertIsNone(choose_tier(now - timedelta(days=1), 0, now))
+        self.assertIsNone(choose_tier(now - timedelta(days=1), 30, now))
+        self.assertEqual(choose_tier(now - timedelta(days=1), 600, now).name, '1m')
+        self.assertEqual(choose_tier(now - timedelta(days=20), 7200, now).name, '1h')
+        self.assertEqual(choose_tier(now - timedelta(days=60), 0, now).name, '1m')
+        self.assertEqual(choose_tier(now - timedelta(days=3650), 0, now), TIERS[-1])
+
+    ## historical_metrics() routing test
+    def test_historical_metrics_from_rollups(self):
+        """
+        Asserts:
+            * a coarse request is answered from the rollup tier with the requested bucket
+        """
+        compact_rollups()
+
+        series = historical_metrics('cpu', 'server_1', datetime(2025, 4, 23), datetime(2025, 4, 23, 2), bucket=3600)
+
+        self.assertEqual(series['timestamps'], ['2025-04-23 00:00:00', '2025-04-23 01:00:00'])
+        self.assertEqual(series['values'], [2.5, 2.5])
+        self.assertEqual(series['max'], [5.0, 5.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+from app.serializers import encode, COLUMNAR, NDJSON
+from unittest.mock import patch
+import json
+import unittest
+
+
+class TestSerializers(unittest.TestCase):
+    def setUp(self):
+        # two chunks of (timestamp, sent, received) rows, as iter_historical_metrics yields them
+        self.chunks = [[(1745376000, 1.5, None), (1745376010, 2.5, 3.0)], [], [(1745376020, 3.5, 4.0)]]
+
+    ## encode_columnar_json() test
+    @patch('app.serializers.SPOOL_MAX_SIZE', 8)
+    def test_columnar_json(self):
+        """
+        Tests:
+            * incremental columnar JSON, with the spooled columns moved to disk
+
+        Asserts:
+            * the pieces join into one JSON object holding every column in order
+            * the first column is written before the cursor is exhausted
+        """
+        pieces = encode(COLUMNAR, ('timestamps', 'sent', 'received'), iter(self.chunks))
+
+        first = next(pieces) + next(pieces)
+        body = json.loads(first + ''.join(pieces))
+
+        self.assertIn('1745376010', first)
+        self.assertEqual(body, {
+            'timestamps': [1745376000, 1745376010, 1745376020],
+            'sent': [1.5, 2.5, 3.5],
+            'received': [None, 3.0, 4.0]
+        })
+
+    ## encode_ndjson() test
+    def test_ndjson(self):
+        """
+        Asserts:
+            * one JSON object per row
+            * an empty series gives an empty body, and columnar JSON gives empty columns
+        """
+        lines = ''.join(encode(NDJSON, ('timestamp', 'sent', 'received'), iter(self.chunks))).splitlines()
+
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0]), {'timestamp': 1745376000, 'sent': 1.5, 'received': None})
+        self.assertEqual(''.join(encode(NDJSON, ('timestamp', 'value'), iter([]))), '')
+        self.assertEqual(json.loads(''.join(encode(COLUMNAR, ('timestamps', 'values'), iter([])))),
+                         {'timestamps': [], 'values': []})
+
+
+if __name__ == "__main__":
+    unittest.main()
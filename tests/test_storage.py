@@ -0,0 +1,246 @@
+from app.data_retrieval import build_row, utc_from_epoch, write_rows
+from app.metric_collector import historical_metrics, iter_historical_metrics, latest_metrics
+from app.models import db
+from app.storage import QueryTimeout, get_storage
+from app.storage.sql import get_connection, iter_raw_sql, read_engine
+from app.storage.tsdb import TSDBStorage, decode_timestamps, decode_values, encode_timestamps, encode_values
+from datetime import timedelta
+from flask import Flask
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+import os
+import numpy as np
+import tempfile
+import threading
+import unittest
+
+
+class TestStorage(unittest.TestCase):
+    # setUp(): the same day of 10 second samples, with gaps and missing values, in both backends
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.start = utc_from_epoch(1745366400)
+        self.end = self.start + timedelta(days=1)
+        self.rows = []
+        for i in range(8640):
+            if i % 97 == 0:
+                continue
+            metrics = {'cpu_usage': 20 + (i % 50) * 0.25, 'memory_usage': 60.5, 'network_sent': float(i % 7)}
+            if i % 13 == 0:
+                metrics['cpu_usage'] = None
+            self.rows.append(build_row(f"server_{i % 2}", utc_from_epoch(1745366400 + i * 10 + (i % 3) * 0.25), metrics))
+
+        self.apps = {}
+        for backend in ('sql', 'tsdb'):
+            app = Flask(__name__)
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            app.config['STORAGE_BACKEND'] = backend
+            app.config['TSDB_PATH'] = self.directory.name
+            app.config['TSDB_CHUNK_POINTS'] = 1000
+            # keep raw samples forever, so the 2025 range is not routed to the (empty) rollup tiers
+            app.config['RAW_RETENTION_DAYS'] = 0
+            db.init_app(app)
+            with app.app_context():
+                db.create_all()
+                for i in range(0, len(self.rows), 500):
+                    write_rows(self.rows[i:i + 500])
+            self.apps[backend] = app
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def query(self, backend, function, *args, **kwargs):
+        with self.apps[backend].app_context():
+            return function(*args, **kwargs)
+
+    ## timestamp and value encoding test
+    def test_chunk_encoding_round_trip(self):
+        """
+        Asserts:
+            * irregular timestamps and floats (with NaN) decode to exactly what was encoded
+            * values with two decimal places are stored as scaled integers
+        """
+        timestamps = np.cumsum(np.random.default_rng(1).integers(-5, 10_000_000, 1000)).astype(np.int64)
+        values = np.random.default_rng(2).normal(50, 10, 1000)
+        values[::17] = np.nan
+        np.testing.assert_array_equal(decode_timestamps(encode_timestamps(timestamps), 1000), timestamps)
+        np.testing.assert_array_equal(decode_values(encode_values(values), 1000), values)
+        rounded = np.round(values, 2)
+        self.assertEqual(encode_values(rounded)[0], 3)
+        np.testing.assert_array_equal(decode_values(encode_values(rounded), 1000), rounded)
+
+    ## tsdb backend test
+    def test_tsdb_matches_sql(self):
+        """
+        Tests:
+            * the tsdb backend answers every query like the sql backend
+
+        Asserts:
+            * latest, raw, bucketed and streamed series are equal across backends
+            * samples past a sealed chunk come from the head
+        """
+        storage = self.query('tsdb', get_storage)
+        self.assertTrue(storage.series("server_0").index)
+        self.assertTrue(len(storage.series("server_0").read_head()))
+
+        self.assertEqual(self.query('tsdb', latest_metrics), self.query('sql', latest_metrics))
+        start, end = self.start + timedelta(hours=3), self.end
+        for metric in ('cpu', 'network'):
+            for options in ({}, {'bucket': 600}, {'max_points': 100, 'method': 'lttb'}):
+                self.assertEqual(self.query('tsdb', historical_metrics, metric, "server_1", start, end, **options),
+                                 self.query('sql', historical_metrics, metric, "server_1", start, end, **options))
+
+            for epoch in (True, False):
+                streamed = {backend: [row for chunk in self.query(backend, lambda: list(iter_historical_metrics(
+                                metric, "server_0", start, end, epoch=epoch, chunk_size=700))) for row in chunk]
+                            for backend in self.apps}
+                self.assertEqual(streamed['tsdb'], streamed['sql'])
+
+    ## late sample merge test
+    def test_late_points_fill_samples(self):
+        """
+        Tests:
+            * late high resolution points of one chart written for samples already stored, in a sealed
+              tsdb chunk and in the tsdb head
+
+        Asserts:
+            * both backends keep one sample per timestamp, holding the late values and the stored ones
+            * the sql row of a filled sample moves to a new id
+        """
+        stored = [row for row in self.rows if row['machine_name'] == "server_0"]
+        late = [build_row("server_0", row['timestamp'], {'disk_usage': 70.0}) for row in (stored[0], stored[-1])]
+        with self.apps['sql'].app_context():
+            ids = db.session.execute(text('SELECT MAX(id) FROM metric_logs')).scalar()
+        for backend in self.apps:
+            self.query(backend, write_rows, late)
+
+        for backend in self.apps:
+            for row in (stored[0], stored[-1]):
+                series = self.query(backend, historical_metrics, 'disk', "server_0", row['timestamp'], row['timestamp'])
+                memory = self.query(backend, historical_metrics, 'memory', "server_0", row['timestamp'], row['timestamp'])
+                self.assertEqual(series['values'], [70.0])
+                self.assertEqual(memory['values'], [60.5])
+            everything = self.query(backend, historical_metrics, 'disk', "server_0", self.start, self.end)
+            self.assertEqual(len(everything['timestamps']), len(stored))
+            self.assertEqual(everything['values'].count(None), len(stored) - 2)
+        with self.apps['sql'].app_context():
+            moved = db.session.execute(text('SELECT id FROM metric_logs WHERE disk_usage IS NOT NULL')).scalars()
+            self.assertTrue(all(id > ids for id in moved))
+
+    ## tsdb concurrent index test
+    def test_tsdb_index_under_concurrent_reads(self):
+        """
+        Tests:
+            * readers querying a server while the writer seals its chunks, through one TSDBStorage
+
+        Asserts:
+            * every reader gets the same Series
+            * the index holds each chunk once, in timestamp order
+        """
+        storage = TSDBStorage(os.path.join(self.directory.name, 'concurrent'), chunk_points=20)
+        stop = threading.Event()
+        seen = []
+
+        def read():
+            while not stop.is_set():
+                series = storage.series("server_0")
+                seen.append(series)
+                list(series.blocks(['cpu_usage'], 0, 2 ** 62))
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        try:
+            for i in range(0, 2000, 10):
+                storage.write(self.rows[i:i + 10])
+        finally:
+            stop.set()
+            for reader in readers:
+                reader.join()
+
+        series = storage.series("server_0")
+        self.assertTrue(all(other is series for other in seen))
+        firsts = [chunk[0] for chunk in series.refresh_index()[0]]
+        self.assertEqual(firsts, sorted(set(firsts)))
+        self.assertEqual(len(series.read(['cpu_usage'], 0, 2 ** 62)[0]),
+                         len({row['timestamp'] for row in self.rows[:2000] if row['machine_name'] == "server_0"}))
+
+
+class TestReadConnections(unittest.TestCase):
+    # setUp(): an app on a SQLite file, with one stored sample
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(self.directory.name, 'app.db')}"
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        write_rows([build_row("server_1", utc_from_epoch(1745366400), {'cpu_usage': 10.0})])
+        self.start = utc_from_epoch(1745366000)
+        self.end = utc_from_epoch(1745367000)
+
+    def tearDown(self):
+        db.session.remove()
+        read_engine().dispose()
+        db.engine.dispose()
+        self.context.pop()
+        self.directory.cleanup()
+
+    ## get_connection() test
+    def test_read_only_and_parallel_to_writer(self):
+        """
+        Tests:
+            * reads through the read-only pool while the writer commits
+
+        Asserts:
+            * read connections come from their own engine and cannot write
+            * the writer commits while a streamed read is half way through its rows
+        """
+        self.assertIsNot(read_engine(), db.engine)
+        with get_connection() as conn:
+            with self.assertRaises(OperationalError):
+                conn.execute(text("DELETE FROM metric_logs"))
+
+        write_rows([build_row("server_1", utc_from_epoch(1745366410), {'cpu_usage': 20.0})])
+        stream = get_storage().iter_raw("server_1", ['cpu_usage'], self.start, self.end, chunk_size=1)
+        self.assertEqual(next(stream), [(1745366400, 10.0)])
+        write_rows([build_row("server_1", utc_from_epoch(1745366420), {'cpu_usage': 30.0})])
+        self.assertEqual(list(stream), [[(1745366410, 20.0)]])
+
+        self.assertEqual(get_storage().latest()["server_1"]['cpu_usage'], 30.0)
+
+    ## iter_raw_sql() test
+    def test_stream_uses_index_order(self):
+        """
+        Tests:
+            * the query plan of a streamed raw range, epoch and stored timestamps
+
+        Asserts:
+            * rows come off the (machine_name, timestamp) index in order, without a sort before the first row
+        """
+        for epoch in (True, False):
+            with get_connection() as conn:
+                plan = conn.execute(text(f"EXPLAIN QUERY PLAN {iter_raw_sql(['cpu_usage'], epoch).text}"),
+                                    {'server_id': "server_1", 'start_time': self.start, 'end_time': self.end}).all()
+            details = ' '.join(row[-1] for row in plan)
+            self.assertIn('ix_metric_logs_machine_name_timestamp', details)
+            self.assertNotIn('TEMP B-TREE', details)
+
+    ## statement timeout test
+    def test_statement_timeout(self):
+        """
+        Tests:
+            * a query running past its timeout
+
+        Asserts:
+            * it is interrupted with QueryTimeout
+            * the connection goes back to the pool without the deadline
+        """
+        endless = text("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT MAX(i) FROM n")
+        with self.assertRaises(QueryTimeout):
+            with get_connection(timeout=0.05) as conn:
+                conn.execute(endless).scalar()
+
+        with get_connection(timeout=0) as conn:
+            self.assertEqual(conn.execute(text("SELECT COUNT(*) FROM metric_logs")).scalar(), 1)
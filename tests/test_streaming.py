@@ -0,0 +1,97 @@
+from app.streaming import Broadcaster, format_sse, iter_events, live_stream_enabled
+from unittest.mock import MagicMock, patch
+import unittest
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.broadcaster = Broadcaster(history=3)
+        self.patcher = patch('app.streaming.broadcaster', self.broadcaster)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def take(self, events, count):
+        return [next(events) for _ in range(count)]
+
+    ## Broadcaster.publish() test
+    def test_publish_deltas(self):
+        """
+        Asserts:
+            * only changed fields are published
+            * publishing unchanged values publishes nothing
+        """
+        self.broadcaster.publish({"server_1": {"cpu_usage": 1.0, "disk_usage": 50.0}})
+        delta = self.broadcaster.publish({"server_1": {"cpu_usage": 2.0, "disk_usage": 50.0}})
+
+        self.assertEqual(delta, {"server_1": {"cpu_usage": 2.0}})
+        self.assertEqual(self.broadcaster.publish({"server_1": {"cpu_usage": 2.0}}), {})
+        self.assertEqual(self.broadcaster.last_sequence, 2)
+
+    ## iter_events() test
+    def test_resume_from_last_event_id(self):
+        """
+        Tests:
+            * a new client, a resuming client and a client too far behind
+
+        Asserts:
+            * new clients start with a snapshot merged over the base snapshot
+            * resuming clients only get the events after their Last-Event-ID
+            * clients whose events fell out of the log get a fresh snapshot
+        """
+        self.broadcaster.publish({"server_1": {"cpu_usage": 1.0}})
+        first_id = self.broadcaster.event_id(1)
+        self.broadcaster.publish({"server_1": {"cpu_usage": 2.0}})
+
+        event, _, payload = next(iter_events({"server_2": {"cpu_usage": 9.0}}))
+        self.assertEqual(event, 'snapshot')
+        self.assertEqual(payload, {"server_1": {"cpu_usage": 2.0}, "server_2": {"cpu_usage": 9.0}})
+
+        resumed = next(iter_events({}, first_id))
+        self.assertEqual(resumed, ('delta', self.broadcaster.event_id(2), {"server_1": {"cpu_usage": 2.0}}))
+
+        for value in (3.0, 4.0, 5.0):
+            self.broadcaster.publish({"server_1": {"cpu_usage": value}})
+        self.assertEqual(next(iter_events({}, first_id))[0], 'snapshot')
+        self.assertEqual(next(iter_events({}, "restarted-1"))[0], 'snapshot')
+
+    ## iter_events() keep-alive test
+    def test_keep_alive(self):
+        """
+        Asserts:
+            * an idle stream yields keep-alive comments
+        """
+        events = iter_events({}, heartbeat=0.01)
+        snapshot, keep_alive = self.take(events, 2)
+
+        self.assertEqual(snapshot[0], 'snapshot')
+        self.assertTrue(format_sse(*keep_alive).startswith(': keep-alive'))
+        self.assertEqual(format_sse('delta', 'a-1', {"x": 1}), 'id: a-1\nevent: delta\ndata: {"x": 1}\n\n')
+
+
+    ## live_stream_enabled() test
+    def test_live_stream_only_for_async_workers(self):
+        """
+        Tests:
+            * LIVE_STREAM set to auto, 1 and 0, with and without gevent patching threading
+
+        Asserts:
+            * auto streams only once gevent patched threading
+            * 1 and 0 force the stream on and off
+
+        Mocking:
+            * gevent.monkey - reports threading as patched
+        """
+        self.assertFalse(live_stream_enabled({'LIVE_STREAM': 'auto'}))
+        self.assertTrue(live_stream_enabled({'LIVE_STREAM': '1'}))
+
+        monkey = MagicMock()
+        monkey.is_module_patched.return_value = True
+        with patch.dict('sys.modules', {'gevent.monkey': monkey}):
+            self.assertTrue(live_stream_enabled({}))
+            self.assertFalse(live_stream_enabled({'LIVE_STREAM': '0'}))
+        monkey.is_module_patched.assert_called_with('threading')
+
+if __name__ == "__main__":
+    unittest.main()